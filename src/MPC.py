@@ -1,11 +1,14 @@
 import numpy as np
 import osqp
 from scipy import sparse
-import matplotlib.pyplot as plt
 
 # Colors
 PREDICTION = '#BA4A00'
 
+# Solver statuses of usable solutions. Solutions returned after reaching the
+# iteration limit or detecting infeasibility are not valid control signals.
+SOLVED = ('solved', 'solved inaccurate')
+
 ##################
 # MPC Controller #
 ##################
@@ -13,7 +16,7 @@ PREDICTION = '#BA4A00'
 
 class MPC:
     def __init__(self, model, N, Q, R, QN, StateConstraints, InputConstraints,
-                 ay_max):
+                 ay_max, warm_start=True):
         """
         Constructor for the Model Predictive Controller.
         :param model: bicycle model object to be controlled
@@ -24,6 +27,8 @@ class MPC:
         :param StateConstraints: dictionary of state constraints
         :param InputConstraints: dictionary of input constraints
         :param ay_max: maximum allowed lateral acceleration in curves
+        :param warm_start: if True, set up the solver workspace once and only
+        update problem data and warm start in subsequent time steps
         """
 
         # Parameters
@@ -52,12 +57,89 @@ class MPC:
         # Counter for old control signals in case of infeasible problem
         self.infeasibility_counter = 0
 
+        # Status reported by the solver in the last time step
+        self.status = None
+
         # Current control signals
         self.current_control = np.zeros((self.nu*self.N))
 
         # Initialize Optimization Problem
         self.optimizer = osqp.OSQP()
 
+        # Persistent solver workspace
+        self.warm_start = warm_start
+        self.is_setup = False
+
+        # Cost vector and constraint bounds of the current time step
+        self.problem_data = None
+
+        # Previous solution and waypoint ID used for warm start
+        self.prev_solution = None
+        self.prev_wp_id = None
+
+        # Constraint matrix with fixed sparsity pattern and index map of the
+        # LTV blocks into its data array. Pattern is fixed for given horizon,
+        # so only the values of the LTV blocks change over time.
+        self.A, self.ltv_ids, self.ltv_order = self._init_constraint_matrix()
+
+    def _init_constraint_matrix(self):
+        """
+        Construct constraint matrix in CSC format with all structural
+        non-zero entries of the LTV blocks stored explicitly. Precompute the
+        positions of the LTV entries in the data array of the matrix to allow
+        for direct updates without re-assembling the matrix.
+        :return: constraint matrix, sorted positions of LTV entries in data
+        array and permutation from stacked LTV values (A blocks followed by B
+        blocks) to the order of these positions
+        """
+
+        # Number of state and input variables over horizon
+        n_x = self.nx * (self.N + 1)
+        n_u = self.nu * self.N
+
+        # Identity for equality constraints
+        eye_ids = np.arange(n_x)
+
+        # Indices of system matrix A for each step of the horizon
+        n, r, c = np.meshgrid(np.arange(self.N), np.arange(self.nx),
+                              np.arange(self.nx), indexing='ij')
+        a_rows = ((n + 1) * self.nx + r).ravel()
+        a_cols = (n * self.nx + c).ravel()
+
+        # Indices of input matrix B for each step of the horizon
+        n, r, c = np.meshgrid(np.arange(self.N), np.arange(self.nx),
+                              np.arange(self.nu), indexing='ij')
+        b_rows = ((n + 1) * self.nx + r).ravel()
+        b_cols = (n_x + n * self.nu + c).ravel()
+
+        # Identity for inequality constraints
+        ineq_ids = np.arange(n_x + n_u)
+
+        rows = np.hstack([eye_ids, a_rows, b_rows, n_x + ineq_ids])
+        cols = np.hstack([eye_ids, a_cols, b_cols, ineq_ids])
+        shape = (2 * n_x + n_u, n_x + n_u)
+
+        # Construct matrix with entry IDs as data to obtain the position of
+        # every entry in the data array of the CSC matrix
+        entry_ids = np.arange(1, len(rows) + 1, dtype=float)
+        A = sparse.coo_matrix((entry_ids, (rows, cols)), shape=shape).tocsc()
+        data_ids = np.empty(len(rows), dtype=int)
+        data_ids[A.data.astype(int) - 1] = np.arange(len(rows))
+
+        # Positions of LTV entries in data array
+        n_ltv = len(a_rows) + len(b_rows)
+        ltv_ids = data_ids[n_x:n_x + n_ltv]
+        ltv_order = np.argsort(ltv_ids)
+        ltv_ids = ltv_ids[ltv_order]
+
+        # Set values of identity blocks. LTV entries are set in every
+        # time step.
+        A.data[data_ids[:n_x]] = -1.0
+        A.data[data_ids[n_x + n_ltv:]] = 1.0
+        A.data[ltv_ids] = 0.0
+
+        return A, ltv_ids, ltv_order
+
     def _init_problem(self):
         """
         Initialize optimization problem for current time step.
@@ -69,14 +151,6 @@ class MPC:
         xmin = self.state_constraints['xmin']
         xmax = self.state_constraints['xmax']
 
-        # LTV System Matrices
-        A = np.zeros((self.nx * (self.N + 1), self.nx * (self.N + 1)))
-        B = np.zeros((self.nx * (self.N + 1), self.nu * (self.N)))
-        # Reference vector for state and input variables
-        ur = np.zeros(self.nu*self.N)
-        xr = np.zeros(self.nx*(self.N+1))
-        # Offset for equality constraint (due to B * (u - ur))
-        uq = np.zeros(self.N * self.nx)
         # Dynamic state constraints
         xmin_dyn = np.kron(np.ones(self.N + 1), xmin)
         xmax_dyn = np.kron(np.ones(self.N + 1), xmax)
@@ -86,31 +160,27 @@ class MPC:
         kappa_pred = np.tan(np.array(self.current_control[3::] +
                                      self.current_control[-1:])) / self.model.length
 
-        # Iterate over horizon
-        for n in range(self.N):
-
-            # Get information about current waypoint
-            current_waypoint = self.model.reference_path.get_waypoint(self.model.wp_id + n)
-            next_waypoint = self.model.reference_path.get_waypoint(self.model.wp_id + n + 1)
-            delta_s = next_waypoint - current_waypoint
-            kappa_ref = current_waypoint.kappa
-            v_ref = current_waypoint.v_ref
-
-            # Compute LTV matrices
-            f, A_lin, B_lin = self.model.linearize(v_ref, kappa_ref, delta_s)
-            A[(n+1) * self.nx: (n+2)*self.nx, n * self.nx:(n+1)*self.nx] = A_lin
-            B[(n+1) * self.nx: (n+2)*self.nx, n * self.nu:(n+1)*self.nu] = B_lin
-
-            # Set reference for input signal
-            ur[n*self.nu:(n+1)*self.nu] = np.array([v_ref, kappa_ref])
-            # Compute equality constraint offset (B*ur)
-            uq[n * self.nx:(n+1)*self.nx] = B_lin.dot(np.array
-                                            ([v_ref, kappa_ref])) - f
+        # Get information about waypoints over horizon
+        waypoints = self.model.reference_path.get_waypoints(
+            self.model.wp_id, self.N + 1)
+        delta_s = np.hypot(np.diff(waypoints.x), np.diff(waypoints.y))
+        kappa_ref = waypoints.kappa[:-1]
+        v_ref = waypoints.v_ref[:-1]
+
+        # Compute LTV matrices for entire horizon
+        f, A, B = self.model.linearize_horizon(v_ref, kappa_ref, delta_s)
+
+        # Reference vector for input signal
+        ur = np.stack((v_ref, kappa_ref), axis=1)
+        # Compute equality constraint offset (B*ur)
+        uq = (np.einsum('nij,nj->ni', B, ur) - f).ravel()
+        ur = ur.ravel()
+        # Reference vector for state variables
+        xr = np.zeros(self.nx*(self.N+1))
 
-            # Constrain maximum speed based on predicted car curvature
-            vmax_dyn = np.sqrt(self.ay_max / (np.abs(kappa_pred[n]) + 1e-12))
-            if vmax_dyn < umax_dyn[self.nu*n]:
-                umax_dyn[self.nu*n] = vmax_dyn
+        # Constrain maximum speed based on predicted car curvature
+        vmax_dyn = np.sqrt(self.ay_max / (np.abs(kappa_pred[:self.N]) + 1e-12))
+        umax_dyn[::self.nu] = np.minimum(umax_dyn[::self.nu], vmax_dyn)
 
         # Compute dynamic constraints on e_y
         ub, lb, _ = self.model.reference_path.update_path_constraints(
@@ -124,15 +194,9 @@ class MPC:
         # Set reference for state as center-line of drivable area
         xr[self.nx::self.nx] = (lb + ub) / 2
 
-        # Get equality matrix
-        Ax = sparse.kron(sparse.eye(self.N + 1),
-                         -sparse.eye(self.nx)) + sparse.csc_matrix(A)
-        Bu = sparse.csc_matrix(B)
-        Aeq = sparse.hstack([Ax, Bu])
-        # Get inequality matrix
-        Aineq = sparse.eye((self.N + 1) * self.nx + self.N * self.nu)
-        # Combine constraint matrices
-        A = sparse.vstack([Aeq, Aineq], format='csc')
+        # Write LTV matrices directly into data array of constraint matrix
+        A_ltv = np.hstack([A.ravel(), B.ravel()])[self.ltv_order]
+        self.A.data[self.ltv_ids] = A_ltv
 
         # Get upper and lower bound vectors for equality constraints
         lineq = np.hstack([xmin_dyn,
@@ -146,17 +210,91 @@ class MPC:
         l = np.hstack([leq, lineq])
         u = np.hstack([ueq, uineq])
 
-        # Set cost matrices
-        P = sparse.block_diag([sparse.kron(sparse.eye(self.N), self.Q), self.QN,
-             sparse.kron(sparse.eye(self.N), self.R)], format='csc')
+        # Set cost vector
         q = np.hstack(
-            [-np.tile(np.diag(self.Q.A), self.N) * xr[:-self.nx],
+            [-np.tile(self.Q.diagonal(), self.N) * xr[:-self.nx],
              -self.QN.dot(xr[-self.nx:]),
-             -np.tile(np.diag(self.R.A), self.N) * ur])
+             -np.tile(self.R.diagonal(), self.N) * ur])
+
+        # Keep problem data to set up a fresh workspace if the warm started
+        # solver fails
+        self.problem_data = (q, l, u)
+
+        # Update problem data of existing solver workspace
+        if self.warm_start and self.is_setup:
+            self.optimizer.update(q=q, l=l, u=u, Ax=A_ltv, Ax_idx=self.ltv_ids)
+            self._warm_start_solver()
 
         # Initialize optimizer
+        else:
+            self._setup_solver()
+
+    def _setup_solver(self):
+        """
+        Set up a fresh solver workspace for the problem data of the current
+        time step.
+        """
+
+        q, l, u = self.problem_data
+        P = sparse.block_diag([sparse.kron(sparse.eye(self.N), self.Q),
+                               self.QN, sparse.kron(sparse.eye(self.N),
+                                                    self.R)], format='csc')
         self.optimizer = osqp.OSQP()
-        self.optimizer.setup(P=P, q=q, A=A, l=l, u=u, verbose=False)
+        self.optimizer.setup(P=P, q=q, A=self.A, l=l, u=u, verbose=False)
+        self.is_setup = True
+
+    def _warm_start_solver(self):
+        """
+        Warm start solver with previous solution shifted by the number of
+        waypoints the car advanced since the last time step. Curvature
+        inputs start from zero.
+        """
+
+        # No solution available
+        if self.prev_solution is None:
+            return
+
+        # Number of waypoints to shift previous solution by
+        shift = self.model.wp_id - self.prev_wp_id
+        if shift < 0:
+            shift = np.mod(shift, self.model.reference_path.n_waypoints)
+
+        # Number of state variables over horizon
+        n_x = self.nx * (self.N + 1)
+
+        # Shift primal and dual solution block-wise
+        x, y = self.prev_solution
+        x = np.hstack([self._shift(x[:n_x], self.nx, shift),
+                       self._shift(x[n_x:], self.nu, shift)])
+        y = np.hstack([self._shift(y[:n_x], self.nx, shift),
+                       self._shift(y[n_x:2*n_x], self.nx, shift),
+                       self._shift(y[2*n_x:], self.nu, shift)])
+
+        # Start curvature from zero like a cold solve. The cost does not
+        # penalize curvature, so the previous solution would carry an
+        # arbitrary curvature over, which lowers the predicted speed limit
+        # and leads into infeasible problems.
+        x[n_x + 1::self.nu] = 0.0
+
+        self.optimizer.warm_start(x=x, y=y)
+
+    @staticmethod
+    def _shift(vector, block_size, shift):
+        """
+        Shift vector consisting of blocks of equal size by specified number of
+        blocks. Vacated blocks at the end are filled with the last block.
+        :param vector: vector to be shifted
+        :param block_size: size of a single block
+        :param shift: number of blocks to shift vector by
+        :return: shifted vector
+        """
+
+        blocks = np.reshape(vector, (-1, block_size))
+        shift = min(shift, blocks.shape[0] - 1)
+        blocks = np.vstack([blocks[shift:],
+                            np.repeat(blocks[-1:], shift, axis=0)])
+
+        return blocks.ravel()
 
     def get_control(self):
         """
@@ -179,10 +317,20 @@ class MPC:
         # Initialize optimization problem
         self._init_problem()
 
-        # Solve optimization problem
+        # Solve optimization problem. If the warm started solver fails,
+        # solve again in a fresh workspace.
         dec = self.optimizer.solve()
+        if dec.info.status not in SOLVED and self.warm_start and \
+                self.prev_solution is not None:
+            self._setup_solver()
+            dec = self.optimizer.solve()
+        self.status = dec.info.status
 
         try:
+            # Only accept solutions of solved problems
+            if dec.info.status not in SOLVED:
+                raise ValueError(dec.info.status)
+
             # Get control signals
             control_signals = np.array(dec.x[-self.N*nu:])
             control_signals[1::2] = np.arctan(control_signals[1::2] *
@@ -202,6 +350,10 @@ class MPC:
             # Get current control signal
             u = np.array([v, delta])
 
+            # Store solution to warm start next time step
+            self.prev_solution = (np.array(dec.x), np.array(dec.y))
+            self.prev_wp_id = self.model.wp_id
+
             # if problem solved, reset infeasibility counter
             self.infeasibility_counter = 0
 
@@ -209,6 +361,12 @@ class MPC:
 
             print('Infeasible problem. Previously predicted'
                   ' control signal used!')
+
+            # Do not warm start from the previous solution and set up a
+            # fresh workspace in the next time step
+            self.prev_solution = None
+            self.is_setup = False
+
             id = nu * (self.infeasibility_counter + 1)
             u = np.array(self.current_control[id:id+2])
 
@@ -223,35 +381,50 @@ class MPC:
 
     def update_prediction(self, spatial_state_prediction):
         """
-        Transform the predicted states to predicted x and y coordinates.
-        Mainly for visualization purposes.
+        Transform the predicted states to predicted x and y coordinates and
+        yaw angles. Used for visualization and collision checking.
         :param spatial_state_prediction: list of predicted state variables
-        :return: lists of predicted x and y coordinates
+        :return: arrays of predicted x and y coordinates and yaw angles
         """
 
-        # Containers for x and y coordinates of predicted states
-        x_pred, y_pred = [], []
+        # Get associated waypoints over prediction horizon
+        waypoints = self.model.reference_path.get_waypoints(
+            self.model.wp_id + 2, self.N - 2)
+        e_y = spatial_state_prediction[2:self.N, 0]
+        e_psi = spatial_state_prediction[2:self.N, 1]
 
-        # Iterate over prediction horizon
-        for n in range(2, self.N):
-            # Get associated waypoint
-            associated_waypoint = self.model.reference_path.\
-                get_waypoint(self.model.wp_id+n)
-            # Transform predicted spatial state to temporal state
-            predicted_temporal_state = self.model.s2t(associated_waypoint,
-                                            spatial_state_prediction[n, :])
+        # Transform predicted spatial states to x and y coordinates in world
+        # coordinate frame
+        x_pred = waypoints.x - e_y * np.sin(waypoints.psi)
+        y_pred = waypoints.y + e_y * np.cos(waypoints.psi)
+        psi_pred = waypoints.psi + e_psi
 
-            # Save predicted coordinates in world coordinate frame
-            x_pred.append(predicted_temporal_state.x)
-            y_pred.append(predicted_temporal_state.y)
+        return x_pred, y_pred, psi_pred
 
-        return x_pred, y_pred
+    def check_collision(self, map):
+        """
+        Check predicted car footprints for collisions with obstacles using
+        the signed distance field of the map.
+        :param map: map object
+        :return: True for every predicted state in collision
+        """
+
+        if self.current_prediction is None:
+            return np.zeros(0, dtype=bool)
+
+        # Approximate predicted footprints by circles and check all of them
+        # at once
+        c_x, c_y, radius = self.model.get_footprint(*self.current_prediction)
+        return np.any(map.check_collision(c_x, c_y, radius), axis=-1)
 
     def show_prediction(self):
         """
         Display predicted car trajectory in current axis.
         """
 
+        # Import plotting library only when needed
+        import matplotlib.pyplot as plt
+
         if self.current_prediction is not None:
             plt.scatter(self.current_prediction[0], self.current_prediction[1],
                     c=PREDICTION, s=30)
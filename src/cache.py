@@ -0,0 +1,79 @@
+import numpy as np
+import hashlib
+import os
+
+
+#########
+# Cache #
+#########
+
+def hash_file(file_path, chunk_size=2**20):
+    """
+    Compute hash of the content of a file.
+    :param file_path: path to file
+    :param chunk_size: number of bytes read at once
+    :return: hex digest of file content
+    """
+
+    file_hash = hashlib.sha1()
+    with open(file_path, 'rb') as f:
+        for chunk in iter(lambda: f.read(chunk_size), b''):
+            file_hash.update(chunk)
+
+    return file_hash.hexdigest()
+
+
+def get_cache_key(*items):
+    """
+    Compute key identifying a cache entry from all parameters the cached data
+    depends on. Numpy arrays are hashed by shape, type and content, all other
+    items by their representation.
+    :param items: parameters the cached data depends on
+    :return: hex digest of parameters
+    """
+
+    key = hashlib.sha1()
+    for item in items:
+        if isinstance(item, np.ndarray):
+            key.update(repr((item.shape, item.dtype.str)).encode())
+            key.update(np.ascontiguousarray(item).tobytes())
+        else:
+            key.update(repr(item).encode())
+        key.update(b'|')
+
+    return key.hexdigest()
+
+
+def load_cache(cache_dir, name, key):
+    """
+    Load cache entry.
+    :param cache_dir: directory containing cache files
+    :param name: type of cached data, e.g. 'map'
+    :param key: key of cache entry, see get_cache_key
+    :return: dict of cached arrays or None if entry does not exist
+    """
+
+    file_path = os.path.join(cache_dir, '{}_{}.npz'.format(name, key))
+    if not os.path.exists(file_path):
+        return None
+
+    with np.load(file_path) as archive:
+        return dict(archive)
+
+
+def save_cache(cache_dir, name, key, **arrays):
+    """
+    Save cache entry. The archive is written to a temporary file first, so
+    concurrent readers never see incomplete entries.
+    :param cache_dir: directory containing cache files
+    :param name: type of cached data, e.g. 'map'
+    :param key: key of cache entry, see get_cache_key
+    :param arrays: arrays to cache
+    """
+
+    os.makedirs(cache_dir, exist_ok=True)
+    file_path = os.path.join(cache_dir, '{}_{}.npz'.format(name, key))
+    tmp_path = '{}.{}.tmp'.format(file_path, os.getpid())
+    with open(tmp_path, 'wb') as f:
+        np.savez_compressed(f, **arrays)
+    os.replace(tmp_path, file_path)
@@ -1,9 +1,10 @@
 import numpy as np
-import matplotlib.pyplot as plt
-from skimage.morphology import remove_small_holes
 from PIL import Image
-from skimage.draw import line_aa
-import matplotlib.patches as plt_patches
+import tempfile
+import hashlib
+from multiprocessing import shared_memory
+from cache import hash_file, get_cache_key, load_cache, save_cache
+from scipy.ndimage import distance_transform_edt, label
 
 # Colors
 OBSTACLE = '#2E4053'
@@ -30,6 +31,10 @@ class Obstacle:
         Display obstacle on current axis.
         """
 
+        # Import plotting libraries only when needed
+        import matplotlib.pyplot as plt
+        import matplotlib.patches as plt_patches
+
         # Draw circle
         circle = plt_patches.Circle(xy=(self.cx, self.cy), radius=
                                         self.radius, color=OBSTACLE, zorder=20)
@@ -37,35 +42,210 @@ class Obstacle:
         ax.add_patch(circle)
 
 
+################
+# Line Drawing #
+################
+
+def line_aa_batch(x0, y0, x1, y1):
+    """
+    Get the cells of anti-aliased lines between arrays of start and end
+    cells. Yields the same cells in the same order as skimage's line_aa
+    applied to every line. All lines are traced simultaneously, one step of
+    the line algorithm per iteration, lines are dropped once finished.
+    :param x0: x coordinates of start cells in map coordinates
+    :param y0: y coordinates of start cells in map coordinates
+    :param x1: x coordinates of end cells in map coordinates
+    :param y1: y coordinates of end cells in map coordinates
+    :return: x and y coordinates of cells on all lines and offsets of the
+    cells of every line into these arrays, i.e. the cells of line i are
+    stored at offsets[i]:offsets[i+1]
+    """
+
+    x0, y0, x1, y1 = [np.asarray(a, dtype=int).ravel()
+                      for a in (x0, y0, x1, y1)]
+
+    # Parameters of line algorithm
+    dx, dy = np.abs(x1 - x0), np.abs(y1 - y0)
+    sign_x = np.where(x0 < x1, 1, -1)
+    sign_y = np.where(y0 < y1, 1, -1)
+    ed = np.where(dx + dy == 0, 1.0, np.hypot(dx, dy))
+
+    # State of unfinished lines
+    ids = np.arange(len(x0))
+    x, y = x0.copy(), y0.copy()
+    err = (dy - dx).astype(float)
+
+    # Every step emits the current cell and up to two neighbors weighted
+    # by anti-aliasing. The position of every cell on its line is counted,
+    # so cells can be grouped by line without sorting.
+    n_cells = np.zeros(len(x0), dtype=int)
+    empty = np.zeros(0, dtype=int)
+    cells_x, cells_y, cell_ids, cell_pos = [empty], [empty], [empty], [empty]
+
+    def emit(ids, x, y):
+        cells_x.append(x)
+        cells_y.append(y)
+        cell_ids.append(ids)
+        cell_pos.append(n_cells[ids])
+        n_cells[ids] += 1
+
+    while len(ids) > 0:
+        emit(ids, x, y)
+
+        # Step along y unless at end cell
+        step_y = 2 * err >= -dy
+        active = ~(step_y & (y == y1))
+        step_y &= active
+        neighbor = step_y & (err + dx < ed)
+        emit(ids[neighbor], x[neighbor] + sign_x[neighbor], y[neighbor])
+
+        # Step along x unless at end cell
+        step_x = active & (2 * err <= dx)
+        active &= ~(step_x & (x == x1))
+        step_x &= active
+        neighbor = step_x & (dy - err < ed)
+        emit(ids[neighbor], x[neighbor], y[neighbor] + sign_y[neighbor])
+
+        x = x + sign_x * step_x
+        y = y + sign_y * step_y
+        err = err - dx * step_y + dy * step_x
+
+        # Drop finished lines
+        if not np.all(active):
+            ids, x, y, err = ids[active], x[active], y[active], err[active]
+            x1, y1, dx, dy = x1[active], y1[active], dx[active], dy[active]
+            sign_x, sign_y, ed = sign_x[active], sign_y[active], \
+                ed[active]
+
+    # Group cells by line
+    offsets = np.concatenate([[0], np.cumsum(n_cells)])
+    index = offsets[np.hstack(cell_ids)] + np.hstack(cell_pos)
+    line_x = np.empty(offsets[-1], dtype=int)
+    line_y = np.empty(offsets[-1], dtype=int)
+    line_x[index] = np.hstack(cells_x)
+    line_y[index] = np.hstack(cells_y)
+
+    return line_x, line_y, offsets
+
+
 #######
 # Map #
 #######
 
 class Map:
-    def __init__(self, file_path, origin, resolution, threshold_occupied=100):
+    def __init__(self, file_path, origin, resolution, threshold_occupied=100,
+                 packed=False, tile_size=None, cache_dir=None,
+                 sdf_max_distance=2.0, dirty_history=1024):
         """
         Constructor for map object. Map contains occupancy grid map data of
         environment as well as meta information.
-        :param file_path: path to image of map
+        :param file_path: path to image of map. Images stored as .npy file
+        (grayscale or first channel used) are memory-mapped.
         :param threshold_occupied: threshold value for binarization of map
         image
         :param origin: x and y coordinates of map origin in world coordinates
         [m]
         :param resolution: resolution in m/px
+        :param packed: if True, store map data bit-packed with 8 cells per
+        byte. Map data must then be accessed via get_cells, get_window and
+        get_data.
+        :param tile_size: if specified, map data is stored in a memory-mapped
+        file and processed lazily in square tiles of tile_size px on first
+        access via get_cells, get_window, get_data or set_occupied.
+        :param cache_dir: if specified, processed map data is stored in and
+        loaded from this directory. Not used for tiled maps.
+        :param sdf_max_distance: distance in m at which the signed distance
+        field is truncated. Limits the region updated after a change.
+        :param dirty_history: maximum number of changed regions kept, see
+        get_dirty_regions
+        """
+
+        if tile_size is not None and packed:
+            print('Tiled maps cannot be packed!')
+            exit(1)
+
+        # Set up all attributes, map data is loaded below
+        self._init_attributes(file_path, origin, resolution,
+                              threshold_occupied, packed, tile_size,
+                              cache_dir, sdf_max_distance, dirty_history)
+
+        # Load processed map data from cache
+        cached = None
+        if cache_dir is not None and tile_size is None:
+            cache_key = get_cache_key(self.get_file_hash(),
+                                      threshold_occupied)
+            cached = load_cache(cache_dir, 'map', cache_key)
+        if cached is not None:
+            self.height, self.width = cached['shape']
+            if packed:
+                self.packed_data = cached['packed_data']
+                self.data = None
+            else:
+                self.data = np.unpackbits(cached['packed_data'], axis=1,
+                                          count=self.width).view(np.int8)
+        else:
+            # Load raw map image
+            if file_path.endswith('.npy'):
+                raw_data = np.load(file_path, mmap_mode='r')
+            else:
+                raw_data = np.array(Image.open(file_path).getchannel(0))
+            if raw_data.ndim == 3:
+                raw_data = raw_data[:, :, 0]
+
+            # Store meta information
+            self.height = raw_data.shape[0]  # height of the map in px
+            self.width = raw_data.shape[1]  # width of the map in px
+            self.data = raw_data
+
+            # Tiled map. Raw map image is kept and processed map data is
+            # stored in a temporary memory-mapped file. Tiles are processed
+            # on first access.
+            if tile_size is not None:
+                self.raw_data = raw_data
+                self.data = np.memmap(tempfile.TemporaryFile(), dtype=np.int8,
+                                      mode='w+', shape=raw_data.shape)
+                self.tiles_loaded = np.zeros((-(-self.height // tile_size),
+                                              -(-self.width // tile_size)),
+                                             dtype=bool)
+            # Process raw map image and store result in cache
+            else:
+                self.process_map()
+                if cache_dir is not None:
+                    packed_data = self.packed_data if packed else \
+                        np.packbits(self.data, axis=1)
+                    save_cache(cache_dir, 'map', cache_key,
+                               shape=np.array([self.height, self.width]),
+                               packed_data=packed_data)
+
+    def _init_attributes(self, file_path, origin, resolution,
+                         threshold_occupied, packed, tile_size, cache_dir,
+                         sdf_max_distance, dirty_history=1024):
+        """
+        Set up all attributes of the map with empty map data. Shared by the
+        constructor and from_shared_memory, which subsequently set the map
+        data. See constructor for parameters.
         """
 
         # Set binarization threshold
         self.threshold_occupied = threshold_occupied
 
-        # Numpy array containing map data
-        self.data = np.array(Image.open(file_path))[:, :, 0]
+        # Path to image of map and hash of its content, computed on demand
+        self.file_path = file_path
+        self.file_hash = None
 
-        # Process raw map image
-        self.process_map()
+        # Directory of cache for processed map data
+        self.cache_dir = cache_dir
+
+        # Numpy array containing map data and its shape, set when loaded. If
+        # packed, map data is stored in self.packed_data with cells of a row
+        # packed into bytes from the most significant bit and self.data is
+        # None.
+        self.packed = packed
+        self.packed_data = None
+        self.tile_size = tile_size
+        self.data = None
+        self.height, self.width = None, None
 
-        # Store meta information
-        self.height = self.data.shape[0]  # height of the map in px
-        self.width = self.data.shape[1]  # width of the map in px
         self.resolution = resolution  # resolution of the map in m/px
         self.origin = origin  # x and y coordinates of map origin
         # (bottom-left corner) in m
@@ -74,25 +254,113 @@ class Map:
         self.obstacles = list()
         self.boundaries = list()
 
-    def w2m(self, x, y):
+        # Version of map data. Incremented with every change of the map
+        # data. Bounding boxes (x_min, y_min, x_max, y_max) in px of the
+        # most recent changed regions in a preallocated array, the region at
+        # index i was changed in version dirty_base + i + 1. Hash of all
+        # changed regions since creation of the map.
+        self.version = 0
+        self.dirty_regions = np.zeros((dirty_history, 4), dtype=int)
+        self.dirty_base = 0
+        self.dirty_hash = hashlib.sha1()
+
+        # Dynamic obstacle layer. Cells covered by every obstacle as flat map
+        # indices y * width + x and number of obstacles and scans covering
+        # every cell, allocated on the first change of the dynamic layer.
+        self.obstacle_cells = dict()
+        self.dynamic_counts = None
+
+        # Sensor layer. Log-odds of occupancy of all cells, allocated on the
+        # first integrated scan, and sorted flat map indices of cells
+        # considered occupied due to scans. Zero-initialized memory is only
+        # committed for pages of the map actually observed.
+        self.log_odds = None
+        self.scan_cells = np.zeros(0, dtype=int)
+
+        # Euclidean distance transform of map data. Computed on demand for
+        # the current map version.
+        self.distance_transform = None
+        self.distance_transform_version = None
+
+        # Occupancy pyramid of map data. Level k contains one cell per block
+        # of 2^k x 2^k px, occupied if any px within the block is occupied.
+        # Updated on demand within regions changed since its version.
+        self.pyramid = None
+        self.pyramid_version = None
+
+        # Signed distance field of map data in m, positive in free and
+        # negative in occupied space, truncated at sdf_max_distance. Updated
+        # on demand within regions changed since its version.
+        self.sdf_max_distance = sdf_max_distance
+        self.sdf = None
+        self.sdf_version = None
+
+    def get_file_hash(self):
+        """
+        Get hash of the content of the map image. Computed on first call.
+        :return: hex digest of map image
+        """
+
+        if self.file_hash is None:
+            self.file_hash = hash_file(self.file_path)
+
+        return self.file_hash
+
+    def get_cache_key(self):
+        """
+        Get key identifying the current map data including all added
+        obstacles, boundaries and changed regions, e.g. to cache data derived
+        from the map.
+        :return: hex digest
+        """
+
+        return get_cache_key(self.get_file_hash(), self.threshold_occupied,
+                             np.array(self.origin, dtype=float),
+                             self.resolution,
+                             np.array([[obstacle.cx, obstacle.cy,
+                                        obstacle.radius]
+                                       for obstacle in self.obstacles],
+                                      dtype=float),
+                             np.array(self.boundaries, dtype=float),
+                             self.dirty_hash.hexdigest())
+
+    def w2m(self, x, y, return_mask=False):
         """
         World2Map. Transform coordinates from global coordinate system to
-        map coordinates.
-        :param x: x coordinate in global coordinate system
-        :param y: y coordinate in global coordinate system
-        :return: discrete x and y coordinates in px
+        map coordinates. Accepts single points or arrays of points.
+        :param x: x coordinate in global coordinate system | float or array
+        :param y: y coordinate in global coordinate system | float or array
+        :param return_mask: if True, additionally return mask of points
+        inside the map
+        :return: discrete x and y coordinates in px, ints for single points
         """
-        dx = int(np.floor((x - self.origin[0]) / self.resolution))
-        dy = int(np.floor((y - self.origin[1]) / self.resolution))
+        dx = np.floor((np.asarray(x, dtype=float) - self.origin[0]) /
+                      self.resolution).astype(int)
+        dy = np.floor((np.asarray(y, dtype=float) - self.origin[1]) /
+                      self.resolution).astype(int)
+        if dx.ndim == 0:
+            dx, dy = int(dx), int(dy)
+
+        if return_mask:
+            return dx, dy, self.is_inside(dx, dy)
 
         return dx, dy
 
+    def is_inside(self, dx, dy):
+        """
+        Check whether cells are inside the map.
+        :param dx: x coordinate in map coordinate system | int or array
+        :param dy: y coordinate in map coordinate system | int or array
+        :return: True for cells inside the map
+        """
+        return (dx >= 0) & (dx < self.width) & (dy >= 0) & (dy < self.height)
+
     def m2w(self, dx, dy):
         """
         Map2World. Transform coordinates from map coordinate system to
-        global coordinates.
-        :param dx: x coordinate in map coordinate system
-        :param dy: y coordinate in map coordinate system
+        global coordinates. Accepts single cells or arrays of cells.
+        :param dx: x coordinate in map coordinate system | int or array
+        :param dy: y coordinate in map coordinate system | int or array
         :return: x and y coordinates of cell center in global coordinate system
         """
         x = (dx + 0.5) * self.resolution + self.origin[0]
@@ -100,6 +368,660 @@ class Map:
 
         return x, y
 
+    def get_static_cells(self, x, y):
+        """
+        Get map data of cells of the static layer.
+        :param x: x coordinates of cells in px | int or array
+        :param y: y coordinates of cells in px | int or array
+        :return: 1 for free and 0 for occupied cells
+        """
+
+        if self.tile_size is not None:
+            self.load_cells(x, y)
+
+        if not self.packed:
+            return self.data[y, x]
+
+        return (self.packed_data[y, x >> 3] >> (7 - (x & 7))) & 1
+
+    def get_static_window(self, x_min, y_min, x_max, y_max):
+        """
+        Get map data of the static layer within a rectangular region.
+        :param x_min: minimum x coordinate of region in px
+        :param y_min: minimum y coordinate of region in px
+        :param x_max: maximum x coordinate of region in px
+        :param y_max: maximum y coordinate of region in px
+        :return: map data of region | (y_max - y_min + 1, x_max - x_min + 1)
+        """
+
+        if self.tile_size is not None:
+            self.load_region(x_min, y_min, x_max, y_max)
+
+        if not self.packed:
+            return self.data[y_min:y_max+1, x_min:x_max+1]
+
+        # Unpack all bytes covering the region and crop to region
+        window = np.unpackbits(self.packed_data[y_min:y_max+1,
+                                                x_min >> 3:(x_max >> 3) + 1],
+                               axis=1)
+        offset = x_min & 7
+        return window[:, offset:offset + x_max - x_min + 1].view(np.int8)
+
+    def get_cells(self, x, y):
+        """
+        Get map data of cells. Composed of static layer and dynamic
+        obstacles.
+        :param x: x coordinates of cells in px | int or array
+        :param y: y coordinates of cells in px | int or array
+        :return: 1 for free and 0 for occupied cells
+        """
+
+        cells = self.get_static_cells(x, y)
+
+        # Clear cells covered by dynamic obstacles
+        if self.dynamic_counts is None:
+            return cells
+        return np.where(self.dynamic_counts[y, x] > 0, 0,
+                        cells).astype(np.int8)
+
+    def get_window(self, x_min, y_min, x_max, y_max):
+        """
+        Get map data within a rectangular region. Composed of static layer
+        and dynamic obstacles.
+        :param x_min: minimum x coordinate of region in px
+        :param y_min: minimum y coordinate of region in px
+        :param x_max: maximum x coordinate of region in px
+        :param y_max: maximum y coordinate of region in px
+        :return: map data of region | (y_max - y_min + 1, x_max - x_min + 1)
+        """
+
+        window = self.get_static_window(x_min, y_min, x_max, y_max)
+
+        # Clear cells covered by dynamic obstacles within region
+        if self.dynamic_counts is None:
+            return window
+        covered = self.dynamic_counts[y_min:y_max+1, x_min:x_max+1] > 0
+        if np.any(covered):
+            window = np.where(covered, 0, window).astype(np.int8)
+
+        return window
+
+    def get_data(self):
+        """
+        Get map data of the entire map. Composed of static layer and dynamic
+        obstacles.
+        :return: map data | (height, width)
+        """
+
+        return self.get_window(0, 0, self.width - 1, self.height - 1)
+
+    def _update_dynamic_counts(self, cells, increment):
+        """
+        Update number of obstacles and scans covering cells of the dynamic
+        layer. Zero-initialized memory is only committed for pages of the
+        map actually covered.
+        :param cells: flat map indices y * width + x of cells, may contain
+        duplicates | array
+        :param increment: 1 for added and -1 for removed cells
+        """
+
+        if self.dynamic_counts is None:
+            self.dynamic_counts = np.zeros((self.height, self.width),
+                                           dtype=np.uint16)
+        counts = self.dynamic_counts.reshape(-1)
+        if increment > 0:
+            np.add.at(counts, cells, 1)
+        else:
+            np.subtract.at(counts, cells, 1)
+
+    def set_occupied(self, x, y):
+        """
+        Mark cells of the static layer as occupied. Does not register the
+        change, see mark_dirty.
+        :param x: x coordinates of cells in px | int or array
+        :param y: y coordinates of cells in px | int or array
+        """
+
+        # Process tiles first, processing would overwrite changes otherwise
+        if self.tile_size is not None:
+            self.load_cells(x, y)
+
+        if not self.packed:
+            self.data[y, x] = 0
+            return
+
+        # Clear bit of every cell, several cells may share a byte
+        x = np.asarray(x)
+        masks = (0x80 >> (x & 7)).astype(np.uint8)
+        np.bitwise_and.at(self.packed_data, (y, x >> 3), ~masks)
+
+    def load_region(self, x_min, y_min, x_max, y_max):
+        """
+        Process all tiles of a tiled map intersecting a rectangular region.
+        :param x_min: minimum x coordinate of region in px
+        :param y_min: minimum y coordinate of region in px
+        :param x_max: maximum x coordinate of region in px
+        :param y_max: maximum y coordinate of region in px
+        """
+
+        # Get range of tiles clipped to map
+        ty_min, tx_min = max(y_min, 0) // self.tile_size, \
+            max(x_min, 0) // self.tile_size
+        ty_max, tx_max = min(y_max, self.height - 1) // self.tile_size, \
+            min(x_max, self.width - 1) // self.tile_size
+
+        # Process tiles not processed yet
+        ty, tx = np.nonzero(~self.tiles_loaded[ty_min:ty_max+1,
+                                               tx_min:tx_max+1])
+        for tile_y, tile_x in zip(ty + ty_min, tx + tx_min):
+            self.load_tile(tile_x, tile_y)
+
+    def load_cells(self, x, y):
+        """
+        Process all tiles of a tiled map containing the specified cells.
+        :param x: x coordinates of cells in px | int or array
+        :param y: y coordinates of cells in px | int or array
+        """
+
+        ty = np.asarray(y) // self.tile_size
+        tx = np.asarray(x) // self.tile_size
+        missing = ~self.tiles_loaded[ty, tx]
+        if np.any(missing):
+            tiles = np.unique(np.stack((tx[missing], ty[missing])), axis=1)
+            for tile_x, tile_y in tiles.T:
+                self.load_tile(tile_x, tile_y)
+
+    def load_tile(self, tile_x, tile_y):
+        """
+        Process raw map image of a single tile. Holes are removed within the
+        tile extended by a margin, such that holes crossing tile borders are
+        treated as if the entire map was processed at once.
+        :param tile_x: column of tile
+        :param tile_y: row of tile
+        """
+
+        # Get region of tile
+        x_min, y_min = tile_x * self.tile_size, tile_y * self.tile_size
+        x_max = min(x_min + self.tile_size, self.width)
+        y_max = min(y_min + self.tile_size, self.height)
+
+        # Get region of tile extended by margin. Every hole touching the tile
+        # and the border of the extended region is not a small hole.
+        area_threshold = 5
+        margin = area_threshold
+        wx_min, wy_min = max(x_min - margin, 0), max(y_min - margin, 0)
+        wx_max = min(x_max + margin, self.width)
+        wy_max = min(y_max + margin, self.height)
+
+        # Binarization using specified threshold
+        # 1 corresponds to free, 0 to occupied
+        data = self.raw_data[wy_min:wy_max, wx_min:wx_max] >= \
+            self.threshold_occupied
+
+        # Remove small holes in map corresponding to spurious measurements
+        self.remove_small_holes(data, area_threshold)
+
+        # Store processed tile
+        self.data[y_min:y_max, x_min:x_max] = \
+            data[y_min - wy_min:y_max - wy_min, x_min - wx_min:x_max - wx_min]
+        self.tiles_loaded[tile_y, tile_x] = True
+
+    def get_distance_transform(self):
+        """
+        Get Euclidean distance transform of the map. Every cell contains the
+        distance between its center and the center of the nearest occupied
+        cell in px. Occupied cells have a distance of 0.
+        :return: distance transform as numpy array of same shape as map data
+        """
+
+        if self.distance_transform_version != self.version:
+            self.distance_transform = distance_transform_edt(
+                self.get_data()).astype(np.float32)
+            self.distance_transform_version = self.version
+
+        return self.distance_transform
+
+    def get_occupancy_pyramid(self):
+        """
+        Get occupancy pyramid of the map. Level 0 marks occupied px, every
+        following level is obtained by max-pooling 2 x 2 blocks of the
+        previous level. The last level consists of a single cell. Built on
+        first call, only regions changed since are updated afterwards.
+        :return: list of boolean arrays, True for occupied blocks
+        """
+
+        # Build all levels from map data, also if changes since last update
+        # are no longer known
+        regions = self.get_dirty_regions(self.pyramid_version)
+        if self.pyramid is None or regions is None:
+            levels = [self.get_data() == 0]
+            while levels[-1].shape != (1, 1):
+                levels.append(self._pool_blocks(levels[-1]))
+            self.pyramid = levels
+            self.pyramid_version = self.version
+            regions = self.get_dirty_regions(self.version)
+
+        # Update regions changed since last update
+        for region in regions:
+            self._update_pyramid(*region)
+        self.pyramid_version = self.version
+
+        return self.pyramid
+
+    def _update_pyramid(self, x_min, y_min, x_max, y_max):
+        """
+        Update all levels of the occupancy pyramid within a rectangular
+        region.
+        :param x_min: minimum x coordinate of region in px
+        :param y_min: minimum y coordinate of region in px
+        :param x_max: maximum x coordinate of region in px
+        :param y_max: maximum y coordinate of region in px
+        """
+
+        # Clip region to map
+        x_min, y_min = max(x_min, 0), max(y_min, 0)
+        x_max, y_max = min(x_max, self.width - 1), min(y_max, self.height - 1)
+        if x_min > x_max or y_min > y_max:
+            return
+
+        # Update occupied px
+        self.pyramid[0][y_min:y_max+1, x_min:x_max+1] = \
+            self.get_window(x_min, y_min, x_max, y_max) == 0
+
+        # Update blocks containing region on all following levels
+        for k in range(1, len(self.pyramid)):
+            x_min, y_min, x_max, y_max = x_min >> 1, y_min >> 1, \
+                x_max >> 1, y_max >> 1
+            self.pyramid[k][y_min:y_max+1, x_min:x_max+1] = \
+                self._pool_blocks(self.pyramid[k-1][2*y_min:2*y_max+2,
+                                                    2*x_min:2*x_max+2])
+
+    @staticmethod
+    def _pool_blocks(level):
+        """
+        Max-pool 2 x 2 blocks of a pyramid level. Odd shapes are padded with
+        free cells.
+        :param level: boolean array of pyramid level
+        :return: boolean array of half the size rounded up
+        """
+
+        height, width = level.shape
+        padded = np.zeros((height + height % 2, width + width % 2),
+                          dtype=bool)
+        padded[:height, :width] = level
+        return padded.reshape(padded.shape[0] // 2, 2, padded.shape[1] // 2,
+                              2).any(axis=(1, 3))
+
+    def get_occupied_cells(self, x_min, y_min, x_max, y_max):
+        """
+        Get all occupied cells within a rectangular region. The occupancy
+        pyramid is descended from the coarsest level covering the region,
+        only occupied blocks are refined. Cost scales with the number of
+        occupied cells rather than the size of the region.
+        :param x_min: minimum x coordinate of region in px
+        :param y_min: minimum y coordinate of region in px
+        :param x_max: maximum x coordinate of region in px
+        :param y_max: maximum y coordinate of region in px
+        :return: x and y coordinates of occupied cells in px
+        """
+
+        return self._descend_pyramid(x_min, y_min, x_max, y_max, False)
+
+    def is_free(self, x_min, y_min, x_max, y_max):
+        """
+        Check whether all cells within a rectangular region are free. Stops
+        at the first occupied block fully contained in the region. Cells
+        outside the map are treated as occupied.
+        :param x_min: minimum x coordinate of region in px
+        :param y_min: minimum y coordinate of region in px
+        :param x_max: maximum x coordinate of region in px
+        :param y_max: maximum y coordinate of region in px
+        :return: True if no cell within region is occupied
+        """
+
+        if x_min < 0 or y_min < 0 or x_max >= self.width or \
+                y_max >= self.height:
+            return False
+
+        return self._descend_pyramid(x_min, y_min, x_max, y_max, True)
+
+    def _descend_pyramid(self, x_min, y_min, x_max, y_max, check_free):
+        """
+        Descend occupancy pyramid within a rectangular region.
+        :param x_min: minimum x coordinate of region in px
+        :param y_min: minimum y coordinate of region in px
+        :param x_max: maximum x coordinate of region in px
+        :param y_max: maximum y coordinate of region in px
+        :param check_free: return whether region is free instead of occupied
+        cells
+        :return: x and y coordinates of occupied cells in px or True if
+        region is free
+        """
+
+        # Clip region to map
+        x_min, y_min = max(x_min, 0), max(y_min, 0)
+        x_max, y_max = min(x_max, self.width - 1), min(y_max, self.height - 1)
+        if x_min > x_max or y_min > y_max:
+            return True if check_free else (np.zeros(0, dtype=int),
+                                            np.zeros(0, dtype=int))
+
+        # Tiled maps are processed lazily, building the pyramid would process
+        # all tiles. Scan map data of region instead.
+        if self.tile_size is not None:
+            y, x = np.nonzero(self.get_window(x_min, y_min, x_max, y_max) == 0)
+            if check_free:
+                return len(x) == 0
+            return x + x_min, y + y_min
+
+        levels = self.get_occupancy_pyramid()
+
+        # Get coarsest level whose blocks are not larger than the region.
+        # Depending on its alignment, the region overlaps at most 3 x 3
+        # blocks on this level.
+        size = int(max(x_max - x_min, y_max - y_min)) + 1
+        k = min(size.bit_length() - 1, len(levels) - 1)
+
+        # Get occupied blocks intersecting region on start level
+        bx, by = np.meshgrid(np.arange(x_min >> k, (x_max >> k) + 1),
+                             np.arange(y_min >> k, (y_max >> k) + 1))
+        bx, by = bx.ravel(), by.ravel()
+
+        # Refine occupied blocks down to px
+        child_x = np.array([0, 1, 0, 1])
+        child_y = np.array([0, 0, 1, 1])
+        while True:
+            level = levels[k]
+            occupied = level[by, bx]
+            bx, by = bx[occupied], by[occupied]
+
+            # Occupied block fully contained in region
+            if check_free and len(bx) > 0:
+                inside = (bx << k >= x_min) & ((bx + 1) << k <= x_max + 1) & \
+                    (by << k >= y_min) & ((by + 1) << k <= y_max + 1)
+                if np.any(inside):
+                    return False
+
+            if k == 0 or len(bx) == 0:
+                break
+
+            # Get children intersecting region and map
+            k -= 1
+            bx = (2 * bx[:, None] + child_x).ravel()
+            by = (2 * by[:, None] + child_y).ravel()
+            keep = (bx >= x_min >> k) & (bx <= x_max >> k) & \
+                (by >= y_min >> k) & (by <= y_max >> k)
+            bx, by = bx[keep], by[keep]
+
+        if check_free:
+            return len(bx) == 0
+        return bx, by
+
+    def get_signed_distance_field(self):
+        """
+        Get signed distance field of the map. Every cell contains the
+        distance between its center and the border of the nearest occupied
+        (free) cell in m, positive for free and negative for occupied cells.
+        Distances are truncated at sdf_max_distance. Computed on first call,
+        only regions changed since are updated afterwards.
+        :return: signed distance field | (height, width)
+        """
+
+        # Compute entire field, also if changes since last update are no
+        # longer known
+        regions = self.get_dirty_regions(self.sdf_version)
+        if self.sdf is None or regions is None:
+            self.sdf = self._compute_signed_distance_field(
+                0, 0, self.width - 1, self.height - 1)
+            self.sdf_version = self.version
+            regions = self.get_dirty_regions(self.version)
+
+        # Update regions changed since last update. Distances of cells
+        # farther than the truncation distance from a changed region can not
+        # change.
+        margin = int(np.ceil(self.sdf_max_distance / self.resolution)) + 1
+        for x_min, y_min, x_max, y_max in regions:
+            x_min, y_min = max(x_min - margin, 0), max(y_min - margin, 0)
+            x_max = min(x_max + margin, self.width - 1)
+            y_max = min(y_max + margin, self.height - 1)
+            if x_min <= x_max and y_min <= y_max:
+                self.sdf[y_min:y_max+1, x_min:x_max+1] = \
+                    self._compute_signed_distance_field(x_min, y_min,
+                                                        x_max, y_max)
+        self.sdf_version = self.version
+
+        return self.sdf
+
+    def _compute_signed_distance_field(self, x_min, y_min, x_max, y_max):
+        """
+        Compute signed distance field within a rectangular region. Map data
+        within the truncation distance around the region is taken into
+        account.
+        :param x_min: minimum x coordinate of region in px
+        :param y_min: minimum y coordinate of region in px
+        :param x_max: maximum x coordinate of region in px
+        :param y_max: maximum y coordinate of region in px
+        :return: signed distance field of region | (y_max - y_min + 1,
+        x_max - x_min + 1)
+        """
+
+        # Get map data of region extended by truncation distance
+        margin = int(np.ceil(self.sdf_max_distance / self.resolution)) + 1
+        wx_min, wy_min = max(x_min - margin, 0), max(y_min - margin, 0)
+        wx_max = min(x_max + margin, self.width - 1)
+        wy_max = min(y_max + margin, self.height - 1)
+        free = self.get_window(wx_min, wy_min, wx_max, wy_max) != 0
+
+        # Distance of free cells to nearest occupied cell and of occupied
+        # cells to nearest free cell. Subtract half a cell to obtain the
+        # distance to the cell border.
+        if np.all(free) or not np.any(free):
+            distances = np.full(free.shape, np.inf)
+        else:
+            distances = np.where(free, distance_transform_edt(free),
+                                 distance_transform_edt(~free)) - 0.5
+        sdf = np.where(free, 1, -1) * np.minimum(
+            distances * self.resolution, self.sdf_max_distance)
+
+        return sdf[y_min - wy_min:y_max - wy_min + 1,
+                   x_min - wx_min:x_max - wx_min + 1].astype(np.float32)
+
+    def get_signed_distance(self, x, y, return_gradient=False):
+        """
+        Get signed distance of points to the nearest obstacle border by
+        bilinear interpolation of the signed distance field between cell
+        centers. Points outside the map are clamped to the map border.
+        :param x: x coordinates of points in m | float or array
+        :param y: y coordinates of points in m | float or array
+        :param return_gradient: if True, also return gradient of signed
+        distance w.r.t. x and y
+        :return: signed distance in m and, optionally, its gradient as
+        arrays of same shape as x
+        """
+
+        sdf = self.get_signed_distance_field()
+
+        # Get continuous map coordinates relative to cell centers
+        fx = np.clip((np.asarray(x, dtype=float) - self.origin[0]) /
+                     self.resolution - 0.5, 0, self.width - 1)
+        fy = np.clip((np.asarray(y, dtype=float) - self.origin[1]) /
+                     self.resolution - 0.5, 0, self.height - 1)
+
+        # Get surrounding cell centers and interpolation weights
+        x0 = np.minimum(np.floor(fx).astype(int), max(self.width - 2, 0))
+        y0 = np.minimum(np.floor(fy).astype(int), max(self.height - 2, 0))
+        x1 = np.minimum(x0 + 1, self.width - 1)
+        y1 = np.minimum(y0 + 1, self.height - 1)
+        wx, wy = fx - x0, fy - y0
+
+        # Bilinear interpolation
+        d00, d01 = sdf[y0, x0], sdf[y0, x1]
+        d10, d11 = sdf[y1, x0], sdf[y1, x1]
+        distance = (d00 * (1 - wx) + d01 * wx) * (1 - wy) + \
+            (d10 * (1 - wx) + d11 * wx) * wy
+
+        if not return_gradient:
+            return distance
+
+        # Partial derivatives of interpolation in m/m
+        grad_x = ((d01 - d00) * (1 - wy) + (d11 - d10) * wy) / \
+            self.resolution
+        grad_y = ((d10 - d00) * (1 - wx) + (d11 - d01) * wx) / \
+            self.resolution
+
+        return distance, (grad_x, grad_y)
+
+    def check_collision(self, x, y, radius=0.0):
+        """
+        Check whether circles collide with any obstacle.
+        :param x: x coordinates of circle centers in m | float or array
+        :param y: y coordinates of circle centers in m | float or array
+        :param radius: radius of circles in m | float or array
+        :return: True for colliding circles | bool or array
+        """
+
+        return self.get_signed_distance(x, y) < radius
+
+    def to_shared_memory(self):
+        """
+        Copy map data composed of static layer and dynamic obstacles as well
+        as the occupancy pyramid into shared memory blocks, such that worker
+        processes can access the map without copying it. The blocks must be
+        closed and unlinked by the caller once all workers are done.
+        :return: picklable description of the shared map, see
+        from_shared_memory, and list of shared memory blocks
+        """
+
+        # Copy arrays into shared memory blocks
+        arrays = [self.get_data()] + self.get_occupancy_pyramid()
+        blocks, layout = [], []
+        for array in arrays:
+            block = shared_memory.SharedMemory(create=True,
+                                               size=max(array.nbytes, 1))
+            np.ndarray(array.shape, dtype=array.dtype,
+                       buffer=block.buf)[:] = array
+            blocks.append(block)
+            layout.append((block.name, array.shape, array.dtype.str))
+
+        spec = {'origin': self.origin, 'resolution': self.resolution,
+                'sdf_max_distance': self.sdf_max_distance, 'layout': layout}
+
+        return spec, blocks
+
+    @classmethod
+    def from_shared_memory(cls, spec):
+        """
+        Attach to a map copied into shared memory by to_shared_memory. The
+        map is read-only and contains no obstacle objects, dynamic
+        obstacles are part of its map data.
+        :param spec: description of the shared map
+        :return: map object and list of attached shared memory blocks, which
+        must be kept alive as long as the map is used
+        """
+
+        # Attach to shared memory blocks
+        blocks, arrays = [], []
+        for name, shape, dtype in spec['layout']:
+            block = shared_memory.SharedMemory(name=name)
+            array = np.ndarray(shape, dtype=dtype, buffer=block.buf)
+            array.flags.writeable = False
+            blocks.append(block)
+            arrays.append(array)
+
+        # Set up untiled, unpacked map on shared arrays without processing
+        map = cls.__new__(cls)
+        map._init_attributes(None, spec['origin'], spec['resolution'], None,
+                             False, None, None, spec['sdf_max_distance'])
+        map.data = arrays[0]
+        map.height, map.width = map.data.shape
+        map.pyramid, map.pyramid_version = arrays[1:], 0
+
+        return map, blocks
+
+    def mark_dirty(self, x_min, y_min, x_max, y_max):
+        """
+        Register a change of the map data within the specified region and
+        increment the map version.
+        :param x_min: minimum x coordinate of changed region in px
+        :param y_min: minimum y coordinate of changed region in px
+        :param x_max: maximum x coordinate of changed region in px
+        :param y_max: maximum y coordinate of changed region in px
+        """
+
+        self.mark_dirty_regions([[x_min, y_min, x_max, y_max]])
+
+    def mark_dirty_regions(self, regions):
+        """
+        Register changes of the map data within several regions at once.
+        The map version is incremented once per region, as if every region
+        was registered by mark_dirty.
+        :param regions: bounding boxes (x_min, y_min, x_max, y_max) in px of
+        changed regions | (n_regions, 4)
+        """
+
+        regions = np.asarray(regions, dtype=int).reshape(-1, 4)
+        n_new = len(regions)
+        if n_new == 0:
+            return
+
+        # Drop older regions of the history if the new regions do not fit.
+        # At most half of the history is kept, so single regions only shift
+        # the history every other half of its size.
+        capacity = len(self.dirty_regions)
+        n = self.version - self.dirty_base
+        if n + n_new > capacity:
+            keep = min(n, max(min(capacity // 2, capacity - n_new), 0))
+            self.dirty_regions[:keep] = self.dirty_regions[n-keep:n]
+            self.dirty_base += n - keep
+            n = keep
+
+            # Keep only the most recent of the new regions
+            if n_new > capacity:
+                self.dirty_base += n_new - capacity
+
+        self.dirty_regions[n:n+n_new] = regions[-capacity:]
+        self.dirty_hash.update(np.ascontiguousarray(regions).tobytes())
+        self.version += n_new
+
+    def get_dirty_regions(self, version):
+        """
+        Get regions changed since the given map version. Only the most
+        recent changes are kept, consumers whose version is older have to
+        consider the entire map as changed.
+        :param version: map version to compare against
+        :return: view of bounding boxes (x_min, y_min, x_max, y_max) in px
+        of changed regions | (n_regions, 4) or None if changes since version
+        are no longer known
+        """
+
+        if version is None or version < self.dirty_base:
+            return None
+
+        return self.dirty_regions[version - self.dirty_base:
+                                  self.version - self.dirty_base]
+
+    def is_dirty(self, region, version):
+        """
+        Check whether the map data within the specified region changed since
+        the given map version.
+        :param region: bounding box (x_min, y_min, x_max, y_max) in px
+        :param version: map version to compare against
+        :return: True if region intersects any region changed since version
+        """
+
+        # No changes since version
+        if version >= self.version:
+            return False
+
+        # Changes since version no longer known
+        dirty = self.get_dirty_regions(version)
+        if dirty is None:
+            return True
+
+        # Check for intersection with all regions changed since version
+        x_min, y_min, x_max, y_max = region
+        return bool(np.any((dirty[:, 0] <= x_max) & (dirty[:, 2] >= x_min) &
+                           (dirty[:, 1] <= y_max) & (dirty[:, 3] >= y_min)))
+
     def process_map(self):
         """
         Process raw map image. Binarization and removal of small holes in map.
@@ -107,34 +1029,280 @@ class Map:
 
         # Binarization using specified threshold
         # 1 corresponds to free, 0 to occupied
-        self.data = np.where(self.data >= self.threshold_occupied, 1, 0)
+        data = self.data >= self.threshold_occupied
 
         # Remove small holes in map corresponding to spurious measurements
-        self.data = remove_small_holes(self.data, area_threshold=5,
-                                       connectivity=8).astype(np.int8)
+        self.remove_small_holes(data, area_threshold=5)
+
+        # Store map data with one byte per cell or bit-packed
+        if self.packed:
+            self.packed_data = np.packbits(data, axis=1)
+            self.data = None
+        else:
+            self.data = data.view(np.int8)
+
+    @staticmethod
+    def remove_small_holes(data, area_threshold, block_size=256):
+        """
+        Fill 8-connected regions of occupied cells with an area of at most
+        the area threshold. Equivalent to remove_small_holes of skimage 0.26
+        with full connectivity, which fills regions of exactly the threshold
+        as well, but labels are stored as int32 and counted in blocks of
+        rows to avoid 64-bit intermediates of the size of the map.
+        :param data: boolean map data, True for free cells. Modified in-place.
+        :param area_threshold: maximum area of filled regions in px
+        :param block_size: number of rows processed at once
+        """
+
+        # Label connected regions of occupied cells
+        labels = np.empty(data.shape, dtype=np.int32)
+        n_labels = label(~data, structure=np.ones((3, 3)), output=labels)
+
+        # Count cells of every region
+        sizes = np.zeros(n_labels + 1, dtype=np.int64)
+        for row in range(0, data.shape[0], block_size):
+            sizes += np.bincount(labels[row:row+block_size].ravel(),
+                                 minlength=n_labels + 1)
+
+        # Mark cells of small regions as free, label 0 corresponds to free
+        # cells
+        small = sizes <= area_threshold
+        small[0] = False
+        for row in range(0, data.shape[0], block_size):
+            data[row:row+block_size] |= small[labels[row:row+block_size]]
 
     def add_obstacles(self, obstacles):
         """
-        Add obstacles to the map.
+        Add obstacles to the dynamic obstacle layer of the map.
         :param obstacles: list of obstacle objects
         """
 
         # Extend list of obstacles
         self.obstacles.extend(obstacles)
 
-        # Iterate over list of new obstacles
+        # Rasterize all new obstacles at once
+        cells, offsets, regions = self.rasterize_circles(
+            [obstacle.cx for obstacle in obstacles],
+            [obstacle.cy for obstacle in obstacles],
+            [obstacle.radius for obstacle in obstacles])
+
+        # Add circular objects to dynamic layer and register changed regions
+        offsets = offsets.tolist()
+        for i, obstacle in enumerate(obstacles):
+            self.obstacle_cells[obstacle] = cells[offsets[i]:offsets[i+1]]
+        self._update_dynamic_counts(cells, 1)
+        self.mark_dirty_regions(np.asarray(regions).reshape(-1, 4)[
+            np.diff(offsets) > 0])
+
+    def remove_obstacles(self, obstacles):
+        """
+        Remove obstacles from the dynamic obstacle layer of the map.
+        :param obstacles: list of obstacle objects
+        """
+
+        removed_cells = [np.zeros(0, dtype=int)]
         for obstacle in obstacles:
+            self.obstacles.remove(obstacle)
+            cells = self.obstacle_cells.pop(obstacle)
+            removed_cells.append(cells)
 
-            # Compute radius of circular object in pixels
-            radius_px = int(np.ceil(obstacle.radius / self.resolution))
-            # Get center coordinates of obstacle in map coordinates
-            cx_px, cy_px = self.w2m(obstacle.cx, obstacle.cy)
+            # Register changed region
+            self._mark_cells_dirty(cells)
 
-            # Add circular object to map
-            y, x = np.ogrid[-radius_px: radius_px, -radius_px: radius_px]
-            index = x ** 2 + y ** 2 <= radius_px ** 2
-            self.data[cy_px-radius_px:cy_px+radius_px, cx_px-radius_px:
-                                                cx_px+radius_px][index] = 0
+        # Remove all cells from dynamic layer at once
+        self._update_dynamic_counts(np.hstack(removed_cells), -1)
+
+    def move_obstacle(self, obstacle, cx, cy):
+        """
+        Move obstacle of the dynamic obstacle layer to a new position.
+        :param obstacle: obstacle object
+        :param cx: new x coordinate of center of obstacle in world coordinates
+        :param cy: new y coordinate of center of obstacle in world coordinates
+        """
+
+        obstacle.cx = cx
+        obstacle.cy = cy
+
+        # Replace cells covered by obstacle
+        previous_cells = self.obstacle_cells[obstacle]
+        cells, _, _ = self.rasterize_circles([cx], [cy], [obstacle.radius])
+        self.obstacle_cells[obstacle] = cells
+        self._update_dynamic_counts(previous_cells, -1)
+        self._update_dynamic_counts(cells, 1)
+
+        # Register region covering previous and new position
+        self._mark_cells_dirty(np.hstack([previous_cells, cells]))
+
+    def rasterize_circles(self, cx, cy, radius):
+        """
+        Get cells covered by circles, clipped to the map. Circles of equal
+        radius in px share the same template of cell offsets, which is
+        shifted to all centers at once.
+        :param cx: x coordinates of centers in world coordinates | array
+        :param cy: y coordinates of centers in world coordinates | array
+        :param radius: radii in m | array
+        :return: flat map indices y * width + x of covered cells ordered by
+        circle, offsets such that cells[offsets[i]:offsets[i+1]] are the
+        cells of circle i, and bounding boxes (x_min, y_min, x_max, y_max)
+        of circles clipped to the map in px as array of shape (n_circles, 4)
+        """
+
+        # Compute radii in pixels
+        radius_px = np.ceil(np.asarray(radius, dtype=float) /
+                            self.resolution).astype(int)
+        if len(radius_px) == 0:
+            return np.zeros(0, dtype=int), np.zeros(1, dtype=int), \
+                np.zeros((0, 4), dtype=int)
+
+        # Get center coordinates in map coordinates
+        cx_px, cy_px = self.w2m(cx, cy)
+
+        # Bounding boxes clipped to map
+        regions = np.stack([np.maximum(cx_px - radius_px, 0),
+                            np.maximum(cy_px - radius_px, 0),
+                            np.minimum(cx_px + radius_px - 1, self.width - 1),
+                            np.minimum(cy_px + radius_px - 1,
+                                       self.height - 1)], axis=1)
+
+        # Get cells of all circles inside the map, one batch per radius
+        cells, order = [], []
+        counts = np.zeros(len(radius_px), dtype=int)
+        for r in np.unique(radius_px):
+
+            # Get cell offsets of circle template
+            template_y, template_x = np.ogrid[-r: r, -r: r]
+            dy, dx = np.nonzero(template_x ** 2 + template_y ** 2 <= r ** 2)
+            dx -= r
+            dy -= r
+
+            # Shift template to centers of all circles with this radius
+            ids = np.flatnonzero(radius_px == r)
+            batch_x = cx_px[ids, None] + dx
+            batch_y = cy_px[ids, None] + dy
+
+            # Discard cells outside of map, remaining cells stay ordered by
+            # circle
+            inside = self.is_inside(batch_x, batch_y)
+            cells.append((batch_y * self.width + batch_x)[inside])
+            counts[ids] = np.count_nonzero(inside, axis=1)
+            order.append(ids)
+
+        # Reorder cells from batches to circles
+        order = np.hstack(order)
+        batch_starts = np.zeros(len(radius_px), dtype=int)
+        batch_starts[order] = np.cumsum(counts[order]) - counts[order]
+        starts = np.cumsum(counts) - counts
+        cell_ids = np.repeat(batch_starts - starts, counts) + \
+            np.arange(np.sum(counts))
+        cells = np.hstack(cells)[cell_ids]
+
+        return cells, np.hstack([starts, len(cells)]), regions
+
+    def _mark_cells_dirty(self, cells):
+        """
+        Register change of map data within bounding box of cells.
+        :param cells: flat map indices y * width + x of changed cells
+        """
+
+        if len(cells) == 0:
+            return
+        y, x = np.divmod(cells, self.width)
+        self.mark_dirty(np.min(x), np.min(y), np.max(x), np.max(y))
+
+    def integrate_scan(self, x, y, psi, angles, ranges, max_range,
+                       l_hit=0.85, l_miss=-0.4, l_min=-2.0, l_max=3.5):
+        """
+        Integrate a lidar scan into the sensor layer of the map using a
+        log-odds occupancy update. Cells traversed by a beam are updated as
+        free, cells containing the endpoint of a beam as occupied. Beams at
+        maximum range only clear cells. Every cell is updated at most once
+        per scan. Cells with positive log-odds are part of the dynamic layer
+        of the map. All beams are sampled at once at half a cell, i.e.
+        n_beams * 2 * max_range / resolution samples, taking about 40 to 55
+        bytes each at peak. For 361 beams on a map of 0.005 m resolution,
+        this is about 11 MB for 1.5 m and 29 MB for 5 m range.
+        :param x: x coordinate of sensor in m
+        :param y: y coordinate of sensor in m
+        :param psi: heading of sensor in rad
+        :param angles: angles of beams relative to heading in rad | array
+        :param ranges: measured distances of beams in m | array
+        :param max_range: range of sensor in m
+        :param l_hit: log-odds increment of occupied cells
+        :param l_miss: log-odds increment of free cells
+        :param l_min: lower bound of log-odds
+        :param l_max: upper bound of log-odds
+        :return: bounding box (x_min, y_min, x_max, y_max) in px of cells
+        whose occupancy changed or None if no cell changed
+        """
+
+        if self.log_odds is None:
+            self.log_odds = np.zeros((self.height, self.width),
+                                     dtype=np.float32)
+
+        # Get continuous map coordinates of sensor and beam directions
+        sx = (x - self.origin[0]) / self.resolution
+        sy = (y - self.origin[1]) / self.resolution
+        beam_angles = psi + np.asarray(angles, dtype=float)
+        dx, dy = np.cos(beam_angles), np.sin(beam_angles)
+        ranges_px = np.minimum(np.asarray(ranges, dtype=float),
+                               max_range) / self.resolution
+
+        # Sample all beams at half a cell up to their measured distance
+        step = 0.5
+        t = np.arange(int(np.ceil(np.max(ranges_px) / step))) * step
+        traversed = t[None, :] < ranges_px[:, None]
+        free_x = np.floor(sx + t[None, :] * dx[:, None])[traversed]
+        free_y = np.floor(sy + t[None, :] * dy[:, None])[traversed]
+
+        # Get endpoints of beams hitting an obstacle
+        hit = ranges_px < max_range / self.resolution
+        hit_x = np.floor(sx + ranges_px[hit] * dx[hit])
+        hit_y = np.floor(sy + ranges_px[hit] * dy[hit])
+
+        # Get unique cells inside the map, endpoints take precedence
+        free_cells = self._get_flat_cells(free_x, free_y)
+        hit_cells = self._get_flat_cells(hit_x, hit_y)
+        free_cells = free_cells[~np.isin(free_cells, hit_cells,
+                                         assume_unique=True)]
+
+        # Update log-odds of observed cells
+        log_odds = self.log_odds.reshape(-1)
+        cells = np.hstack([free_cells, hit_cells])
+        previous = log_odds[cells] > 0
+        log_odds[free_cells] = np.maximum(log_odds[free_cells] + l_miss,
+                                          l_min)
+        log_odds[hit_cells] = np.minimum(log_odds[hit_cells] + l_hit, l_max)
+
+        # Update occupied cells of sensor layer
+        changed = cells[previous != (log_odds[cells] > 0)]
+        if len(changed) == 0:
+            return None
+        occupied = log_odds[changed] > 0
+        self.scan_cells = np.union1d(
+            np.setdiff1d(self.scan_cells, changed, assume_unique=True),
+            changed[occupied])
+        self._update_dynamic_counts(changed[occupied], 1)
+        self._update_dynamic_counts(changed[~occupied], -1)
+
+        # Register changed region
+        y, x = np.divmod(changed, self.width)
+        region = (int(np.min(x)), int(np.min(y)), int(np.max(x)),
+                  int(np.max(y)))
+        self.mark_dirty(*region)
+
+        return region
+
+    def _get_flat_cells(self, x, y):
+        """
+        Get unique flat map indices of cells inside the map.
+        :param x: x coordinates of cells in px | array
+        :param y: y coordinates of cells in px | array
+        :return: sorted flat map indices y * width + x
+        """
+
+        x, y = x.astype(int), y.astype(int)
+        inside = self.is_inside(x, y)
+        return np.unique(y[inside] * self.width + x[inside])
 
     def add_boundary(self, boundaries):
         """
@@ -146,17 +1314,209 @@ class Map:
         # Extend list of boundaries
         self.boundaries.extend(boundaries)
 
-        # Iterate over list of boundaries
-        for boundary in boundaries:
-            sx = self.w2m(boundary[0][0], boundary[0][1])
-            gx = self.w2m(boundary[1][0], boundary[1][1])
-            path_x, path_y, _ = line_aa(sx[0], sx[1], gx[0], gx[1])
-            for x, y in zip(path_x, path_y):
-                self.data[y, x] = 0
+        # Rasterize all boundaries at once and add them to static layer
+        x, y, regions = self.rasterize_segments(
+            np.asarray(boundaries, dtype=float).reshape(-1, 2, 2))
+        self.set_occupied(x, y)
+
+        # Register changed regions
+        self.mark_dirty_regions(regions)
+
+    def rasterize_segments(self, segments):
+        """
+        Get cells covered by anti-aliased line segments, clipped to the map.
+        :param segments: start and end points of segments in world
+        coordinates | (n_segments, 2, 2)
+        :return: x and y coordinates of covered cells in px and bounding
+        boxes (x_min, y_min, x_max, y_max) in px of all segments covering any
+        cell as array of shape (n_covering_segments, 4)
+        """
+
+        # No segments given
+        if len(segments) == 0:
+            return np.zeros(0, dtype=int), np.zeros(0, dtype=int), \
+                np.zeros((0, 4), dtype=int)
+
+        # Transform start and end points of all segments to map coordinates
+        points_x, points_y = self.w2m(segments[:, :, 0], segments[:, :, 1])
+
+        # Get cells of all segments at once
+        x, y, offsets = line_aa_batch(points_x[:, 0], points_y[:, 0],
+                                      points_x[:, 1], points_y[:, 1])
+
+        # Discard cells outside of map
+        inside = self.is_inside(x, y)
+        segment_ids = np.repeat(np.arange(len(segments)),
+                                np.diff(offsets))[inside]
+        x, y = x[inside], y[inside]
+
+        # Bounding boxes of remaining cells of every segment, cells are
+        # ordered by segment
+        counts = np.bincount(segment_ids, minlength=len(segments))
+        regions = np.zeros((np.count_nonzero(counts), 4), dtype=int)
+        if len(regions) > 0:
+            starts = (np.cumsum(counts) - counts)[counts > 0]
+            regions[:, 0] = np.minimum.reduceat(x, starts)
+            regions[:, 1] = np.minimum.reduceat(y, starts)
+            regions[:, 2] = np.maximum.reduceat(x, starts)
+            regions[:, 3] = np.maximum.reduceat(y, starts)
+
+        return x, y, regions
+
+
+#############
+# Local Map #
+#############
+
+class LocalMap:
+    def __init__(self, map, x, y, psi, angles, ranges, max_range,
+                 shadow_depth=0.1, max_gap=0.1):
+        """
+        Robot-centric occupancy grid built from a single lidar scan. Covers
+        the square of the sensor's range around the sensor using the grid of
+        the global map, which is not modified. Beams hitting the static layer
+        of the map are ignored, the static layer is looked up in the global
+        map instead, so later changes of it are taken into account. Other
+        obstacles are only observed at their surface, hence every beam
+        hitting an obstacle shadows the cells from its endpoint up to
+        shadow_depth behind it. Each cell is shadowed by the beam closest to
+        its bearing, so shadows have no gaps between beams. Between adjacent
+        beams whose endpoints are closer than max_gap, the shadow starts at
+        the line connecting the endpoints. Shadowed cells are occupied, all
+        other cells of the grid are free if not occupied in the static
+        layer. Cells outside the grid are taken from the global map.
+        :param map: global map object defining origin and resolution of grid
+        :param x: x coordinate of sensor in m
+        :param y: y coordinate of sensor in m
+        :param psi: heading of sensor in rad
+        :param angles: ascending angles of beams relative to heading in rad |
+        array
+        :param ranges: measured distances of beams in m | array
+        :param max_range: range of sensor in m
+        :param shadow_depth: depth in m of occupied region behind endpoints
+        :param max_gap: maximum distance in m between endpoints of adjacent
+        beams considered to lie on the same surface
+        """
+
+        # Global map
+        self.map = map
+
+        # Global map coordinates of grid origin (minimum x and y)
+        range_px = int(np.ceil((max_range + shadow_depth) / map.resolution))
+        sensor_x, sensor_y = map.w2m(x, y)
+        self.x_min = sensor_x - range_px
+        self.y_min = sensor_y - range_px
+
+        # Map data of grid. 1 corresponds to free, 0 to occupied
+        size = 2 * range_px + 1
+        self.data = np.ones((size, size), dtype=np.int8)
+
+        # Get beams hitting an obstacle
+        angles = np.asarray(angles, dtype=float)
+        ranges = np.asarray(ranges, dtype=float)
+        hit = ranges < max_range
+        dx, dy = np.cos(psi + angles), np.sin(psi + angles)
+
+        # Ignore beams ending at the static layer, i.e. in or up to a cell
+        # in front of a static obstacle
+        end_x, end_y = map.w2m(x + (ranges + map.resolution) * dx,
+                               y + (ranges + map.resolution) * dy)
+        hit &= map.is_inside(end_x, end_y)
+        hit[hit] = map.get_static_cells(end_x[hit], end_y[hit]) != 0
+        if not np.any(hit):
+            return
+
+        # Shadows start at the endpoint of the beam closest to the bearing
+        # of a cell. Shadows of adjacent beams on the same surface start at
+        # the line connecting their endpoints.
+        start = np.where(hit, ranges, np.inf)
+        connected = hit[:-1] & hit[1:] & (np.hypot(
+            np.diff(ranges * dx), np.diff(ranges * dy)) < max_gap)
+
+        # Shadows are confined to the sectors of runs of adjacent beams
+        # hitting an obstacle. Only cells within the bounding box of each
+        # run are tested.
+        ids = np.flatnonzero(hit)
+        half_step = np.max(np.diff(angles)) / 2 if len(angles) > 1 else 0.0
+        for run in np.split(ids, np.flatnonzero(np.diff(ids) > 1) + 1):
+
+            # Bounding box of sectors from one cell in front of the
+            # endpoints up to one cell behind the shadows
+            run_angles = psi + np.hstack(
+                [angles[run] - half_step, angles[run] + half_step] * 2)
+            run_ranges = np.hstack(
+                [ranges[run] - map.resolution] * 2 +
+                [ranges[run] + shadow_depth + map.resolution] * 2)
+            bx, by = map.w2m(x + run_ranges * np.cos(run_angles),
+                             y + run_ranges * np.sin(run_angles))
+            bx_min = max(np.min(bx) - self.x_min, 0)
+            by_min = max(np.min(by) - self.y_min, 0)
+            bx_max = min(np.max(bx) - self.x_min, size - 1)
+            by_max = min(np.max(by) - self.y_min, size - 1)
+            if bx_min > bx_max or by_min > by_max:
+                continue
+
+            # Bearing relative to heading and distance of cells in box
+            cell_x, cell_y = map.m2w(
+                self.x_min + np.arange(bx_min, bx_max + 1),
+                self.y_min + np.arange(by_min, by_max + 1))
+            cell_x, cell_y = np.meshgrid(cell_x - x, cell_y - y)
+            distances = np.hypot(cell_x, cell_y)
+            bearings = np.mod(np.arctan2(cell_y, cell_x) - psi + np.pi,
+                              2 * np.pi) - np.pi
+
+            # Get adjacent beams enclosing the bearing of every cell and the
+            # relative position of the bearing between them. Cells outside
+            # the field of view are not observed.
+            right = np.clip(np.searchsorted(angles, bearings), 1,
+                            len(angles) - 1)
+            left = right - 1
+            t = (bearings - angles[left]) / (angles[right] - angles[left])
+            in_fov = (t >= 0) & (t <= 1)
+
+            # Start of shadow at bearing of every cell
+            cell_start = start[np.where(t < 0.5, left, right)]
+            cell_connected = connected[left]
+            cell_start[cell_connected] = (ranges[left] * (1 - t) + ranges[
+                right] * t)[cell_connected]
+
+            # Mark shadowed cells as occupied, including the cells
+            # containing the endpoints
+            self.data[by_min:by_max+1, bx_min:bx_max+1][
+                in_fov & (distances >= cell_start - map.resolution / 2) &
+                (distances <= cell_start + shadow_depth)] = 0
+
+    def get_cells(self, x, y):
+        """
+        Get map data of cells. Cells inside the grid are occupied if
+        occupied in the grid or in the static layer of the global map. Cells
+        outside the grid are taken from the global map.
+        :param x: x coordinates of cells in px of the global map | array
+        :param y: y coordinates of cells in px of the global map | array
+        :return: 1 for free and 0 for occupied cells
+        """
+
+        x, y = np.asarray(x), np.asarray(y)
+        grid_x, grid_y = x - self.x_min, y - self.y_min
+        size = self.data.shape[0]
+        inside = (grid_x >= 0) & (grid_x < size) & (grid_y >= 0) & \
+            (grid_y < size)
+
+        # Cells outside the grid from global map
+        cells = np.empty(x.shape, dtype=np.int8)
+        cells[~inside] = self.map.get_cells(x[~inside], y[~inside])
+
+        # Cells inside the grid combined with static layer
+        cells[inside] = np.minimum(
+            self.data[grid_y[inside], grid_x[inside]],
+            self.map.get_static_cells(x[inside], y[inside]))
+
+        return cells
 
 
 if __name__ == '__main__':
-    map = Map('maps/real_map.png')
-    # map = Map('maps/sim_map.png')
-    plt.imshow(np.flipud(map.data), cmap='gray')
+    import matplotlib.pyplot as plt
+    map = Map('maps/real_map.png', origin=(-30.0, -24.0), resolution=0.06)
+    # map = Map('maps/sim_map.png', origin=(-1, -2), resolution=0.005)
+    plt.imshow(np.flipud(map.get_data()), cmap='gray')
     plt.show()
@@ -0,0 +1,330 @@
+from map import Map, Obstacle
+import numpy as np
+from reference_path import ReferencePath
+from spatial_bicycle_models import BicycleModel
+from MPC import MPC, SOLVED
+from scipy import sparse
+import multiprocessing
+import contextlib
+import time
+import io
+
+
+##########
+# Tracks #
+##########
+
+# Map, reference path and car of all tracks available for scenarios
+TRACKS = {
+    # Mini-Car on track specifically designed to showcase time-optimal
+    # driving
+    'Sim_Track': {'file_path': 'maps/sim_map.png', 'origin': (-1, -2),
+                  'resolution': 0.005,
+                  'wp_x': [-0.75, -0.25, -0.25, 0.25, 0.25, 1.25, 1.25, 0.75,
+                           0.75, 1.25, 1.25, -0.75, -0.75, -0.25],
+                  'wp_y': [-1.5, -1.5, -0.5, -0.5, -1.5, -1.5, -1, -1, -0.5,
+                           -0.5, 0, 0, -1.5, -1.5],
+                  'path_resolution': 0.05, 'smoothing_distance': 5,
+                  'max_width': 0.23, 'circular': True,
+                  'length': 0.12, 'width': 0.06, 'Ts': 0.05},
+    # Track used for testing the algorithm on a 1:12 RC car
+    'Real_Track': {'file_path': 'maps/real_map.png', 'origin': (-30.0, -24.0),
+                   'resolution': 0.06,
+                   'wp_x': [-9.169, 11.9, 7.3, -6.95],
+                   'wp_y': [-15.678, 10.9, 14.5, -3.31],
+                   'path_resolution': 0.20, 'smoothing_distance': 5,
+                   'max_width': 1.50, 'circular': False,
+                   'length': 0.30, 'width': 0.20, 'Ts': 0.05},
+}
+
+# Parameters of a scenario not specified by the user
+DEFAULT_SCENARIO = {
+    'track': 'Sim_Track',
+    'obstacles': [],  # list of (cx, cy, radius) in m
+    'perturbation': (0.0, 0.0, 0.0),  # offset of initial x, y and psi
+    'Q': [1.0, 0.0, 0.0],  # diagonal of state cost matrix
+    'R': [0.5, 0.0],  # diagonal of input cost matrix
+    'QN': [1.0, 0.0, 0.0],  # diagonal of final state cost matrix
+    'N': 30,  # horizon
+    'v_max': 1.0,  # m/s
+    'delta_max': 0.66,  # rad
+    'ay_max': 4.0,  # m/s^2
+    'a_min': -0.1,  # m/s^2
+    'a_max': 0.5,  # m/s^2
+    'max_time': 60.0,  # s, runs not finished until then are aborted
+}
+
+
+######################
+# Monte Carlo Runner #
+######################
+
+def run_batch(scenarios, n_workers=None, cache_dir=None):
+    """
+    Run closed-loop simulations of MPC and bicycle model for a batch of
+    scenarios in a pool of worker processes. Every worker sets up map and
+    reference path of a track once and reuses them for all its scenarios on
+    that track.
+    :param scenarios: list of dicts overriding entries of DEFAULT_SCENARIO
+    :param n_workers: number of worker processes, number of CPUs if None.
+    Scenarios are run in this process if 1.
+    :param cache_dir: if specified, processed maps and reference paths are
+    shared between workers via the cache in this directory
+    :return: list of results of all scenarios, see run_scenario, and
+    aggregated metrics, see aggregate_results
+    """
+
+    if n_workers is None:
+        n_workers = multiprocessing.cpu_count()
+
+    if n_workers <= 1:
+        _init_worker(cache_dir)
+        results = [_run_scenario(scenario) for scenario in scenarios]
+    else:
+        # Use fresh interpreters to not inherit state of the caller. Small
+        # chunks balance the load of scenarios of different duration.
+        context = multiprocessing.get_context('spawn')
+        chunk_size = max(len(scenarios) // (4 * n_workers), 1)
+        with context.Pool(n_workers, initializer=_init_worker,
+                          initargs=(cache_dir, )) as pool:
+            results = pool.map(_run_scenario, scenarios,
+                               chunksize=chunk_size)
+
+    return results, aggregate_results(results)
+
+
+def aggregate_results(results):
+    """
+    Aggregate metrics of a batch of closed-loop runs.
+    :param results: list of results of all scenarios
+    :return: dict of aggregated metrics
+    """
+
+    finished = [result for result in results if result['finished']]
+    lap_times = np.array([result['lap_time'] for result in finished])
+    solve_times = np.hstack([np.zeros(0)] + [result['solve_times']
+                                             for result in results])
+
+    return {
+        'n_scenarios': len(results),
+        'n_finished': len(finished),
+        'n_failed': sum(result['failed'] for result in results),
+        'mean_lap_time': np.mean(lap_times) if len(finished) else np.nan,
+        'max_lap_time': np.max(lap_times) if len(finished) else np.nan,
+        'min_clearance': min([result['min_clearance'] for result in results],
+                             default=np.nan),
+        'n_collisions': sum(result['min_clearance'] < 0
+                            for result in results),
+        'n_infeasible': sum(result['n_infeasible'] for result in results),
+        'mean_solve_time': np.mean(solve_times) if len(solve_times)
+        else np.nan,
+        'p95_solve_time': np.percentile(solve_times, 95) if len(solve_times)
+        else np.nan,
+        'max_solve_time': np.max(solve_times) if len(solve_times)
+        else np.nan,
+    }
+
+
+def run_scenario(scenario, map, reference_path):
+    """
+    Run closed-loop simulation of a single scenario on a prepared track.
+    Obstacles of the scenario are added to the map for the duration of the
+    run.
+    :param scenario: dict of scenario parameters, see DEFAULT_SCENARIO
+    :param map: map object of track
+    :param reference_path: reference path object of track
+    :return: dict containing lap time, whether the end of the path was
+    reached, whether the controller failed, minimum clearance between car
+    footprint and obstacles in m, number of problems not solved and solve
+    time of every step in s
+    """
+
+    # Add obstacles of scenario. The map is shared by all scenarios of a
+    # worker, so they are removed again however the run ends.
+    obstacles = [Obstacle(cx=cx, cy=cy, radius=radius)
+                 for cx, cy, radius in scenario['obstacles']]
+    map.add_obstacles(obstacles)
+    try:
+        return _simulate(scenario, map, reference_path)
+    finally:
+        map.remove_obstacles(obstacles)
+
+
+def _simulate(scenario, map, reference_path):
+    """
+    Run closed-loop simulation of a single scenario on a map already
+    containing its obstacles.
+    :param scenario: dict of scenario parameters, see DEFAULT_SCENARIO
+    :param map: map object of track
+    :param reference_path: reference path object of track
+    :return: result of scenario, see run_scenario
+    """
+
+    track = TRACKS[scenario['track']]
+
+    # Instantiate motion model with perturbed initial pose
+    car = BicycleModel(length=track['length'], width=track['width'],
+                       reference_path=reference_path, Ts=track['Ts'])
+    dx, dy, dpsi = scenario['perturbation']
+    car.temporal_state.x += dx
+    car.temporal_state.y += dy
+    car.temporal_state.psi += dpsi
+
+    # Instantiate controller
+    N = scenario['N']
+    InputConstraints = {
+        'umin': np.array([0.0, -np.tan(scenario['delta_max']) / car.length]),
+        'umax': np.array([scenario['v_max'],
+                          np.tan(scenario['delta_max']) / car.length])}
+    StateConstraints = {'xmin': np.array([-np.inf, -np.inf, -np.inf]),
+                        'xmax': np.array([np.inf, np.inf, np.inf])}
+    mpc = MPC(car, N, sparse.diags(scenario['Q']), sparse.diags(scenario['R']),
+              sparse.diags(scenario['QN']), StateConstraints,
+              InputConstraints, scenario['ay_max'])
+
+    # Metrics
+    t = 0.0
+    solve_times = []
+    min_clearance = np.inf
+    n_infeasible = 0
+    finished = False
+    failed = False
+
+    # Until arrival at end of path or timeout
+    while t < scenario['max_time']:
+
+        # Stop at end of path. On a non-circular path, the horizon of the
+        # controller must not exceed the last waypoint.
+        if car.s >= reference_path.length:
+            finished = True
+            break
+        if not reference_path.circular:
+            car.get_current_waypoint()
+            if car.wp_id + N + 1 > reference_path.n_waypoints:
+                finished = True
+                break
+
+        # Get control signals. The controller exits if no control signal
+        # can be computed.
+        start = time.time()
+        try:
+            u = mpc.get_control()
+        except SystemExit:
+            failed = True
+            break
+        solve_times.append(time.time() - start)
+        n_infeasible += mpc.status not in SOLVED
+
+        # The controller failed if it returns a speed outside of its input
+        # constraints, up to the tolerance of the solver
+        umin, umax = InputConstraints['umin'], InputConstraints['umax']
+        if not umin[0] - 1e-2 <= u[0] <= umax[0] + 1e-2:
+            failed = True
+            break
+
+        # Simulate car
+        car.drive(u)
+        t += car.Ts
+        if not np.all(np.isfinite([car.temporal_state.x, car.temporal_state.y,
+                                   car.temporal_state.psi])):
+            failed = True
+            break
+
+        # Get clearance of car footprint
+        c_x, c_y, radius = car.get_footprint(car.temporal_state.x,
+                                             car.temporal_state.y,
+                                             car.temporal_state.psi)
+        min_clearance = min(min_clearance, float(np.min(
+            map.get_signed_distance(c_x, c_y) - radius)))
+
+    return {'lap_time': t, 'finished': finished, 'failed': failed,
+            'min_clearance': min_clearance, 'n_infeasible': int(n_infeasible),
+            'solve_times': np.array(solve_times)}
+
+
+###########
+# Workers #
+###########
+
+# state of worker processes, set up once per process
+_worker = dict()
+
+
+def _init_worker(cache_dir):
+    """
+    Set up worker process. Tracks are loaded on first use.
+    :param cache_dir: directory of cache for maps and reference paths
+    """
+
+    _worker['cache_dir'] = cache_dir
+    _worker['tracks'] = dict()
+
+
+def _get_track(name, scenario):
+    """
+    Get map and reference path of a track. Created on first use in this
+    process, the speed profile is recomputed if the speed limits of the
+    scenario differ from the previous scenario.
+    :param name: name of track, see TRACKS
+    :param scenario: dict of scenario parameters
+    :return: map object and reference path object
+    """
+
+    if name not in _worker['tracks']:
+        track = TRACKS[name]
+        cache_dir = _worker['cache_dir']
+        map = Map(file_path=track['file_path'], origin=track['origin'],
+                  resolution=track['resolution'], cache_dir=cache_dir)
+        reference_path = ReferencePath(
+            map, track['wp_x'], track['wp_y'], track['path_resolution'],
+            smoothing_distance=track['smoothing_distance'],
+            max_width=track['max_width'], circular=track['circular'],
+            cache_dir=cache_dir)
+        _worker['tracks'][name] = [map, reference_path, None]
+
+    map, reference_path, speed_profile = _worker['tracks'][name]
+
+    # Compute speed profile for speed limits of scenario
+    SpeedProfileConstraints = {'a_min': scenario['a_min'],
+                               'a_max': scenario['a_max'], 'v_min': 0.0,
+                               'v_max': scenario['v_max'],
+                               'ay_max': scenario['ay_max']}
+    if speed_profile != SpeedProfileConstraints:
+        reference_path.compute_speed_profile(SpeedProfileConstraints)
+        _worker['tracks'][name][2] = SpeedProfileConstraints
+
+    return map, reference_path
+
+
+def _run_scenario(scenario):
+    """
+    Run a single scenario in a worker process. Output of the controller is
+    suppressed.
+    :param scenario: dict overriding entries of DEFAULT_SCENARIO
+    :return: result of scenario, see run_scenario
+    """
+
+    scenario = dict(DEFAULT_SCENARIO, **scenario)
+    map, reference_path = _get_track(scenario['track'], scenario)
+    with contextlib.redirect_stdout(io.StringIO()):
+        return run_scenario(scenario, map, reference_path)
+
+
+if __name__ == '__main__':
+
+    # Perturb initial pose of car on simulation track with and without
+    # obstacles
+    rng = np.random.default_rng(0)
+    obstacles = [(0.0, 0.0, 0.05), (-0.8, -0.5, 0.08), (-0.3, -1.0, 0.08),
+                 (0.73, -0.9, 0.07), (1.2, 0.0, 0.08)]
+    scenarios = [{'obstacles': obstacles if i % 2 else [],
+                  'perturbation': (0.0, rng.uniform(-0.03, 0.03),
+                                   rng.uniform(-0.2, 0.2))}
+                 for i in range(8)]
+
+    start = time.time()
+    results, summary = run_batch(scenarios)
+    print('Ran {} scenarios in {:.2f} s'.format(len(scenarios),
+                                                time.time() - start))
+    for name, value in summary.items():
+        print('{}: {}'.format(name, value))
@@ -1,8 +1,8 @@
 import numpy as np
 import math
-from map import Map, Obstacle
+from map import Map, Obstacle, line_aa_batch
+from cache import get_cache_key, load_cache, save_cache
 from skimage.draw import line_aa
-import matplotlib.pyplot as plt
 from scipy import sparse
 import osqp
 
@@ -17,35 +17,58 @@ OBSTACLE = '#2E4053'
 # Waypoint #
 ############
 
+def _column(name):
+    """
+    Create property providing access to the entry of a waypoint in the
+    specified column of its waypoint store.
+    :param name: name of the column in the waypoint store
+    :return: property object
+    """
+
+    def getter(self):
+        return getattr(self.store, name)[self.wp_id]
+
+    def setter(self, value):
+        getattr(self.store, name)[self.wp_id] = value
+
+    return property(getter, setter)
+
+
 class Waypoint:
-    def __init__(self, x, y, psi, kappa):
+    def __init__(self, store, wp_id):
         """
         Waypoint object containing x, y location in global coordinate system,
         orientation of waypoint psi and local curvature kappa. Waypoint further
         contains an associated reference velocity computed by the speed profile
-        and a path width specified by upper and lower bounds.
-        :param x: x position in global coordinate system | [m]
-        :param y: y position in global coordinate system | [m]
-        :param psi: orientation of waypoint | [rad]
-        :param kappa: local curvature | [1 / m]
-        """
-        self.x = x
-        self.y = y
-        self.psi = psi
-        self.kappa = kappa
-
-        # Reference velocity at this waypoint according to speed profile
-        self.v_ref = None
-
-        # Information about drivable area at waypoint
-        # upper and lower bound of drivable area orthogonal to
-        # waypoint orientation.
-        # Upper bound: free drivable area to the left of center-line in m
-        # Lower bound: free drivable area to the right of center-line in m
-        self.lb = None
-        self.ub = None
-        self.static_border_cells = None
-        self.dynamic_border_cells = None
+        and a path width specified by upper and lower bounds. The waypoint is
+        a view on a single entry of a waypoint store, i.e. all attributes are
+        read from and written to the columns of the store.
+        :param store: waypoint store containing the data of the waypoint
+        :param wp_id: index of the waypoint in the store
+        """
+        self.store = store
+        self.wp_id = wp_id
+
+    # x and y position in global coordinate system | [m]
+    x = _column('x')
+    y = _column('y')
+    # Orientation of waypoint | [rad]
+    psi = _column('psi')
+    # Local curvature | [1 / m]
+    kappa = _column('kappa')
+
+    # Reference velocity at this waypoint according to speed profile
+    v_ref = _column('v_ref')
+
+    # Information about drivable area at waypoint
+    # upper and lower bound of drivable area orthogonal to
+    # waypoint orientation.
+    # Upper bound: free drivable area to the left of center-line in m
+    # Lower bound: free drivable area to the right of center-line in m
+    lb = _column('lb')
+    ub = _column('ub')
+    static_border_cells = _column('static_border_cells')
+    dynamic_border_cells = _column('dynamic_border_cells')
 
     def __sub__(self, other):
         """
@@ -57,6 +80,82 @@ class Waypoint:
         return ((self.x - other.x)**2 + (self.y - other.y)**2)**0.5
 
 
+##################
+# Waypoint Store #
+##################
+
+class WaypointStore:
+    def __init__(self, x, y, psi, kappa):
+        """
+        Columnar store for the waypoints of a reference path. Every attribute
+        of the waypoints is kept in a contiguous numpy array. Border cells
+        are stored as arrays of shape (n_waypoints, 2, 2) containing the
+        x and y coordinates of the upper and lower bound cell.
+        :param x: x positions in global coordinate system | [m]
+        :param y: y positions in global coordinate system | [m]
+        :param psi: orientations of waypoints | [rad]
+        :param kappa: local curvatures | [1 / m]
+        """
+        self.x = np.ascontiguousarray(x, dtype=float)
+        self.y = np.ascontiguousarray(y, dtype=float)
+        self.psi = np.ascontiguousarray(psi, dtype=float)
+        self.kappa = np.ascontiguousarray(kappa, dtype=float)
+
+        # Number of waypoints
+        n = len(self.x)
+
+        # Reference velocity according to speed profile
+        self.v_ref = np.full(n, np.nan)
+
+        # Upper and lower bound of drivable area
+        self.lb = np.full(n, np.nan)
+        self.ub = np.full(n, np.nan)
+        self.static_border_cells = np.full((n, 2, 2), np.nan)
+        self.dynamic_border_cells = np.full((n, 2, 2), np.nan)
+
+        # Distance to next waypoint and cumulative distance along path
+        self.segment_lengths = np.hstack([0.0, np.hypot(np.diff(self.x),
+                                                        np.diff(self.y))])
+        self.s = np.cumsum(self.segment_lengths)
+
+    def __len__(self):
+        return len(self.x)
+
+    def __getitem__(self, item):
+        """
+        Get waypoint view(s) for the given index or slice.
+        :param item: waypoint ID or slice of waypoint IDs
+        :return: waypoint object or list of waypoint objects
+        """
+        if isinstance(item, slice):
+            return [Waypoint(self, wp_id) for wp_id in
+                    range(*item.indices(len(self)))]
+        if item < 0:
+            item += len(self)
+        if not 0 <= item < len(self):
+            raise IndexError('Waypoint index out of range!')
+        return Waypoint(self, int(item))
+
+    def __iter__(self):
+        for wp_id in range(len(self)):
+            yield Waypoint(self, wp_id)
+
+    def take(self, ids):
+        """
+        Get a new store containing the waypoints at the given indices. The
+        columns of the new store are views on the columns of this store if
+        ids is a slice and copies otherwise.
+        :param ids: slice or array of waypoint IDs
+        :return: waypoint store
+        """
+        store = WaypointStore.__new__(WaypointStore)
+        for name in ['x', 'y', 'psi', 'kappa', 'v_ref', 'lb', 'ub',
+                     'static_border_cells', 'dynamic_border_cells',
+                     'segment_lengths', 's']:
+            setattr(store, name, getattr(self, name)[ids])
+        return store
+
+
 ##################
 # Reference Path #
 ##################
@@ -64,7 +163,8 @@ class Waypoint:
 
 class ReferencePath:
     def __init__(self, map, wp_x, wp_y, resolution, smoothing_distance,
-                 max_width, circular):
+                 max_width, circular, use_distance_transform=False,
+                 cache_dir=None):
         """
         Reference Path object. Create a reference trajectory from specified
         corner points with given resolution. Smoothing around corners can be
@@ -78,6 +178,10 @@ class ReferencePath:
         path by averaging neighborhood of waypoints
         :param max_width: maximum width of path to both sides in m
         :param circular: True if path circular
+        :param use_distance_transform: if True, compute path width for all
+        waypoints at once using the distance transform of the map
+        :param cache_dir: if specified, waypoints including path width and
+        speed profile are stored in and loaded from this directory
         """
 
         # Precision
@@ -95,8 +199,26 @@ class ReferencePath:
         # Circular flag
         self.circular = circular
 
-        # List of waypoint objects
-        self.waypoints = self._construct_path(wp_x, wp_y)
+        # Compute width using distance transform flag
+        self.use_distance_transform = use_distance_transform
+
+        # Directory of cache and key identifying path on current map
+        self.cache_dir = cache_dir
+        self.cache_key = None
+        cached = None
+        if cache_dir is not None:
+            self.cache_key = get_cache_key(
+                map.get_cache_key(), np.array(wp_x, dtype=float),
+                np.array(wp_y, dtype=float), resolution, smoothing_distance,
+                max_width, circular, use_distance_transform)
+            cached = load_cache(cache_dir, 'path', self.cache_key)
+
+        # Waypoint store containing all waypoints of the path
+        if cached is not None:
+            self.waypoints = WaypointStore(cached['x'], cached['y'],
+                                           cached['psi'], cached['kappa'])
+        else:
+            self.waypoints = self._construct_path(wp_x, wp_y)
 
         # Number of waypoints
         self.n_waypoints = len(self.waypoints)
@@ -104,15 +226,65 @@ class ReferencePath:
         # Length of path
         self.length, self.segment_lengths = self._compute_length()
 
-        # Compute path width (attribute of each waypoint)
-        self._compute_width(max_width=max_width)
+        # Restore path width and cross-sections from cache
+        if cached is not None:
+            for name in ['lb', 'ub', 'static_border_cells',
+                         'dynamic_border_cells']:
+                getattr(self.waypoints, name)[:] = cached[name]
+            self.cross_section_cells = cached['cross_section_cells']
+            self.cross_section_offsets = cached['cross_section_offsets']
+            self.cross_sections = cached['cross_sections']
+        else:
+            # Compute path width (attribute of each waypoint)
+            if self.use_distance_transform:
+                self._compute_width_distance_transform(max_width=max_width)
+            else:
+                self._compute_width(max_width=max_width)
+
+            # Cells on cross-sections between static border cells as flat
+            # map indices. Cells of waypoint i are stored in
+            # cross_section_cells[cross_section_offsets[i]:
+            # cross_section_offsets[i+1]], ordered from upper to lower
+            # bound. Bounding boxes of cross-sections in px.
+            self.cross_section_cells, self.cross_section_offsets, \
+                self.cross_sections = self._compute_cross_sections()
+
+            # Store path in cache
+            if cache_dir is not None:
+                waypoints = self.waypoints
+                save_cache(cache_dir, 'path', self.cache_key,
+                           x=waypoints.x, y=waypoints.y, psi=waypoints.psi,
+                           kappa=waypoints.kappa, lb=waypoints.lb,
+                           ub=waypoints.ub,
+                           static_border_cells=waypoints.static_border_cells,
+                           dynamic_border_cells=
+                           waypoints.dynamic_border_cells,
+                           cross_section_cells=self.cross_section_cells,
+                           cross_section_offsets=self.cross_section_offsets,
+                           cross_sections=self.cross_sections)
+
+        # Cache of free segments per waypoint. Contains minimum segment
+        # width and list of free segments as well as map version the
+        # segments are valid for.
+        self.free_segments = [None] * self.n_waypoints
+        self.free_segments_version = np.full(self.n_waypoints, -1)
+
+        # Local map built from the latest sensor scan. If set, free segments
+        # are computed from the local map instead of the map, see LocalMap.
+        self.local_map = None
+
+        # Persistent solver for windowed re-optimization of speed profile
+        # and size of the window it was set up for, including whether the
+        # window is followed by a waypoint
+        self.speed_profile_solver = None
+        self.speed_profile_window = None
 
     def _construct_path(self, wp_x, wp_y):
         """
         Construct path from given waypoints.
         :param wp_x: x coordinates of waypoints in global coordinates
         :param wp_y: y coordinates of waypoints in global coordinates
-        :return: list of waypoint objects
+        :return: waypoint store
         """
 
         # Number of waypoints
@@ -139,7 +311,7 @@ class ReferencePath:
             wp_ys.append(np.mean(wp_y[wp_id - self.smoothing_distance:wp_id
                                             + self.smoothing_distance + 1]))
 
-        # Construct list of waypoint objects
+        # Construct waypoint store
         waypoints = list(zip(wp_xs, wp_ys))
         waypoints = self._construct_waypoints(waypoints)
 
@@ -148,59 +320,42 @@ class ReferencePath:
     def _construct_waypoints(self, waypoint_coordinates):
         """
         Reformulate conventional waypoints (x, y) coordinates into waypoint
-        objects containing (x, y, psi, kappa, ub, lb)
+        store containing (x, y, psi, kappa, ub, lb)
         :param waypoint_coordinates: list of (x, y) coordinates of waypoints in
         global coordinates
-        :return: list of waypoint objects for entire reference path
+        :return: waypoint store for entire reference path
         """
 
-        # List containing waypoint objects
-        waypoints = []
-
-        # Iterate over all waypoints
-        for wp_id in range(len(waypoint_coordinates) - 1):
-
-            # Get start and goal waypoints
-            current_wp = np.array(waypoint_coordinates[wp_id])
-            next_wp = np.array(waypoint_coordinates[wp_id + 1])
-
-            # Difference vector
-            dif_ahead = next_wp - current_wp
-
-            # Angle ahead
-            psi = np.arctan2(dif_ahead[1], dif_ahead[0])
+        # Waypoint coordinates as array of shape (n, 2)
+        coordinates = np.array(waypoint_coordinates, dtype=float)
 
-            # Distance to next waypoint
-            dist_ahead = np.linalg.norm(dif_ahead, 2)
+        # Difference vector to next waypoint
+        dif_ahead = coordinates[1:] - coordinates[:-1]
 
-            # Get x and y coordinates of current waypoint
-            x, y = current_wp[0], current_wp[1]
+        # Angle ahead
+        psi = np.arctan2(dif_ahead[:, 1], dif_ahead[:, 0])
 
-            # Compute local curvature at waypoint
-            # first waypoint
-            if wp_id == 0:
-                kappa = 0
-            else:
-                prev_wp = np.array(waypoint_coordinates[wp_id - 1])
-                dif_behind = current_wp - prev_wp
-                angle_behind = np.arctan2(dif_behind[1], dif_behind[0])
-                angle_dif = np.mod(psi - angle_behind + math.pi, 2 * math.pi) \
-                            - math.pi
-                kappa = angle_dif / (dist_ahead + self.eps)
+        # Distance to next waypoint
+        dist_ahead = np.linalg.norm(dif_ahead, 2, axis=1)
 
-            waypoints.append(Waypoint(x, y, psi, kappa))
+        # Compute local curvature at waypoints. First waypoint has zero
+        # curvature, all following waypoints use the angle to the
+        # previous waypoint.
+        angle_dif = np.mod(psi[1:] - psi[:-1] + math.pi, 2 * math.pi) \
+                    - math.pi
+        kappa = np.hstack([0.0, angle_dif / (dist_ahead[1:] + self.eps)])
 
-        return waypoints
+        return WaypointStore(coordinates[:-1, 0], coordinates[:-1, 1], psi,
+                             kappa)
 
     def _compute_length(self):
         """
         Compute length of center-line path as sum of euclidean distance between
         waypoints.
-        :return: length of center-line path in m
+        :return: length of center-line path in m and array of segment lengths
         """
-        segment_lengths = [0.0] + [self.waypoints[wp_id+1] - self.waypoints
-                    [wp_id] for wp_id in range(len(self.waypoints)-1)]
-        s = sum(segment_lengths)
+        segment_lengths = self.waypoints.segment_lengths
+        s = self.waypoints.s[-1]
         return s, segment_lengths
 
     def _compute_width(self, max_width):
@@ -210,24 +365,31 @@ class ReferencePath:
         :param max_width: maximum width of the path.
         """
 
+        # Get angles orthogonal to path to the left and right of all
+        # waypoints
+        wps = self.waypoints
+        angles = np.stack([np.mod(wps.psi + math.pi / 2 + math.pi,
+                                  2 * math.pi) - math.pi,
+                           np.mod(wps.psi - math.pi / 2 + math.pi,
+                                  2 * math.pi) - math.pi], axis=1)
+
+        # Get closest cells to orthogonal vectors
+        t_x, t_y = self.map.w2m(wps.x[:, None] + max_width * np.cos(angles),
+                                wps.y[:, None] + max_width * np.sin(angles))
+
+        # Get pixel coordinates of waypoints
+        wp_x, wp_y = self.map.w2m(wps.x, wps.y)
+
         # Iterate over all waypoints
         for wp_id, wp in enumerate(self.waypoints):
             # List containing information for current waypoint
             width_info = []
             # Check width left and right of the center-line
-            for i, dir in enumerate(['left', 'right']):
-                # Get angle orthogonal to path in current direction
-                if dir == 'left':
-                    angle = np.mod(wp.psi + math.pi / 2 + math.pi,
-                                 2 * math.pi) - math.pi
-                else:
-                    angle = np.mod(wp.psi - math.pi / 2 + math.pi,
-                                   2 * math.pi) - math.pi
-                # Get closest cell to orthogonal vector
-                t_x, t_y = self.map.w2m(wp.x + max_width * np.cos(angle), wp.y
-                                        + max_width * np.sin(angle))
+            for i in range(2):
                 # Compute distance to orthogonal cell on path border
-                b_value, b_cell = self._get_min_width(wp, t_x, t_y, max_width)
+                b_value, b_cell = self._get_min_width(
+                    wp, (wp_x[wp_id], wp_y[wp_id]), t_x[wp_id, i],
+                    t_y[wp_id, i], max_width)
                 # Add information to list for current waypoint
                 width_info.append(b_value)
                 width_info.append(b_cell)
@@ -240,11 +402,106 @@ class ReferencePath:
             wp.static_border_cells = (width_info[1], width_info[3])
             wp.dynamic_border_cells = (width_info[1], width_info[3])
 
-    def _get_min_width(self, wp, t_x, t_y, max_width):
+    def _compute_width_distance_transform(self, max_width):
+        """
+        Compute the width of the path by checking the maximum free space to
+        the left and right of the center-line. Yields the same result as
+        _compute_width. Sides of waypoints whose distance to the closest
+        occupied cell, given by the distance transform of the map, exceeds
+        the extent of the searched lines are free up to the maximum width.
+        The lines of all remaining sides are traced and checked for occupied
+        cells at once using the distance transform.
+        :param max_width: maximum width of the path.
+        """
+
+        # Distance transform of map. Occupied cells have a distance of 0.
+        edt = self.map.get_distance_transform()
+
+        # Get angles orthogonal to path to the left and right of all
+        # waypoints
+        wps = self.waypoints
+        n = len(wps)
+        angles = np.stack([np.mod(wps.psi + math.pi / 2 + math.pi,
+                                  2 * math.pi) - math.pi,
+                           np.mod(wps.psi - math.pi / 2 + math.pi,
+                                  2 * math.pi) - math.pi], axis=1)
+
+        # Get closest cells to orthogonal vectors and pixel coordinates of
+        # waypoints for all sides, left sides first
+        t_x, t_y = self.map.w2m(wps.x[:, None] + max_width * np.cos(angles),
+                                wps.y[:, None] + max_width * np.sin(angles))
+        t_x, t_y = t_x.T.ravel(), t_y.T.ravel()
+        wp_x, wp_y = self.map.w2m(np.tile(wps.x, 2), np.tile(wps.y, 2))
+
+        # Width and border cell of sides without occupied cell, i.e. the
+        # last inspected cell at maximum width
+        width = np.full(2 * n, float(max_width))
+        border_cells = np.stack(self.map.m2w(t_x + 1, t_y + 1), axis=1)
+
+        # Sides whose lines to the neighborhood of the orthogonal cell lie
+        # within the map and within the distance of the waypoint's cell to
+        # the closest occupied cell are free
+        inside = self.map.is_inside(np.minimum(wp_x, t_x - 1),
+                                    np.minimum(wp_y, t_y - 1)) & \
+            self.map.is_inside(np.maximum(wp_x, t_x + 1),
+                               np.maximum(wp_y, t_y + 1))
+        extent = np.hypot(np.abs(t_x - wp_x) + 1, np.abs(t_y - wp_y) + 1) + 1
+        distance = np.zeros(2 * n)
+        distance[inside] = edt[wp_y[inside], wp_x[inside]]
+        sides = np.flatnonzero(distance <= extent)
+
+        # Get anti-aliased lines to the neighborhood of the orthogonal cell
+        # of all remaining sides at once. The 9 lines of a side are
+        # consecutive, so the cells of side k are stored at
+        # side_offsets[k]:side_offsets[k+1].
+        i, j = [a.ravel() for a in np.meshgrid(np.arange(-1, 2),
+                                               np.arange(-1, 2),
+                                               indexing='ij')]
+        path_x, path_y, offsets = line_aa_batch(
+            np.repeat(wp_x[sides], 9), np.repeat(wp_y[sides], 9),
+            (t_x[sides, None] + i).ravel(), (t_y[sides, None] + j).ravel())
+        side_offsets = offsets[::9]
+        side_ids = np.repeat(sides, np.diff(side_offsets))
+
+        # Distance between waypoint and occupied cells. Cells outside the
+        # map are considered occupied, free cells are ignored.
+        inside = self.map.is_inside(path_x, path_y)
+        occupied = ~inside
+        occupied[inside] = edt[path_y[inside], path_x[inside]] == 0
+        c_x, c_y = self.map.m2w(path_x, path_y)
+        wp_ids = side_ids % n
+        cell_dist = np.where(occupied, np.sqrt((wps.x[wp_ids] - c_x) ** 2 +
+                                               (wps.y[wp_ids] - c_y) ** 2),
+                             np.inf)
+
+        # Closest occupied cell of every side within the maximum width. The
+        # first closest cell on the lines of a side is its border cell.
+        if len(sides) > 0:
+            min_dist = np.minimum.reduceat(cell_dist, side_offsets[:-1])
+            closest = np.flatnonzero(cell_dist == np.repeat(
+                min_dist, np.diff(side_offsets)))
+            closest = closest[np.unique(side_ids[closest],
+                                        return_index=True)[1]]
+            valid = min_dist < max_width
+            closest = closest[valid]
+            width[sides[valid]] = cell_dist[closest]
+            border_cells[sides[valid], 0] = c_x[closest]
+            border_cells[sides[valid], 1] = c_y[closest]
+
+        # Set waypoint attributes with width to the left and right
+        wps.ub[:] = width[:n]
+        wps.lb[:] = -1 * width[n:]
+        # Set border cells of waypoints
+        wps.static_border_cells[:, 0] = border_cells[:n]
+        wps.static_border_cells[:, 1] = border_cells[n:]
+        wps.dynamic_border_cells[:] = wps.static_border_cells
+
+    def _get_min_width(self, wp, wp_cell, t_x, t_y, max_width):
         """
         Compute the minimum distance between the current waypoint and the
         orthogonal cell on the border of the path
         :param wp: current waypoint
+        :param wp_cell: x and y coordinate of waypoint in map coordinates
         :param t_x: x coordinate of border cell in map coordinates
         :param t_y: y coordinate of border cell in map coordinates
         :param max_width: maximum path width in m
@@ -259,32 +516,34 @@ class ReferencePath:
                 tn_x.append(t_x+i)
                 tn_y.append(t_y+j)
 
-        # Get pixel coordinates of waypoint
-        wp_x, wp_y = self.map.w2m(wp.x, wp.y)
+        # No occupied cell within bounding box of all paths
+        if self.map.is_free(min(wp_cell[0], t_x - 1), min(wp_cell[1], t_y - 1),
+                            max(wp_cell[0], t_x + 1), max(wp_cell[1], t_y + 1)):
+            return max_width, self.map.m2w(tn_x[-1], tn_y[-1])
 
         # Get Bresenham paths to all possible cells
-        paths = []
-        for t_x, t_y in zip(tn_x, tn_y):
-            x_list, y_list, _ = line_aa(wp_x, wp_y, t_x, t_y)
-            paths.append(zip(x_list, y_list))
-
-        # Compute minimum distance to border cell
-        min_width = max_width
-        # map inspected cell to world coordinates
-        min_cell = self.map.m2w(t_x, t_y)
-        for path in paths:
-            for cell in path:
-                t_x, t_y = cell[0], cell[1]
-                # If path goes through occupied cell
-                if self.map.data[t_y, t_x] == 0:
-                    # Get world coordinates
-                    c_x, c_y = self.map.m2w(t_x, t_y)
-                    cell_dist = np.sqrt((wp.x - c_x) ** 2 + (wp.y - c_y) ** 2)
-                    if cell_dist < min_width:
-                        min_width = cell_dist
-                        min_cell = (c_x, c_y)
-
-        return min_width, min_cell
+        paths = [line_aa(wp_cell[0], wp_cell[1], t_x, t_y)[:2]
+                 for t_x, t_y in zip(tn_x, tn_y)]
+        path_x = np.hstack([x_list for x_list, _ in paths])
+        path_y = np.hstack([y_list for _, y_list in paths])
+
+        # Get world coordinates of occupied cells on paths. Cells outside
+        # the map are considered occupied.
+        inside = self.map.is_inside(path_x, path_y)
+        occupied = ~inside
+        occupied[inside] = self.map.get_cells(path_x[inside],
+                                              path_y[inside]) == 0
+        c_x, c_y = self.map.m2w(path_x[occupied], path_y[occupied])
+        cell_dist = np.sqrt((wp.x - c_x) ** 2 + (wp.y - c_y) ** 2)
+
+        # Compute minimum distance to border cell. If no occupied cell
+        # within maximum path width, map last inspected cell to world
+        # coordinates
+        if len(cell_dist) == 0 or np.min(cell_dist) >= max_width:
+            return max_width, self.map.m2w(tn_x[-1], tn_y[-1])
+        min_id = np.argmin(cell_dist)
+
+        return cell_dist[min_id], (c_x[min_id], c_y[min_id])
 
     def compute_speed_profile(self, Constraints):
         """
@@ -294,6 +553,18 @@ class ReferencePath:
         curvature of the path
         """
 
+        # Load speed profile from cache
+        if self.cache_dir is not None:
+            # Constraints are hashed by their bytes, the representation of
+            # arrays rounds their entries
+            cache_key = get_cache_key(self.cache_key, *[
+                item for name in sorted(Constraints)
+                for item in (name, np.array(Constraints[name], dtype=float))])
+            cached = load_cache(self.cache_dir, 'speed_profile', cache_key)
+            if cached is not None:
+                self.waypoints.v_ref[:] = cached['v_ref']
+                return
+
         # Set optimization horizon
         N = self.n_waypoints - 1
 
@@ -306,33 +577,21 @@ class ReferencePath:
         # Maximum lateral acceleration
         ay_max = Constraints['ay_max']
 
+        # Distance between waypoints and curvature of waypoints
+        li = self.segment_lengths[1:N+1]
+        ki = self.waypoints.kappa[:N]
+
         # Inequality Matrix
-        D1 = np.zeros((N-1, N))
+        # Banded operator for dynamics of acceleration
+        D1 = sparse.diags([-1 / (2 * li[:N-1]), 1 / (2 * li[:N-1])], [0, 1],
+                          shape=(N-1, N), format='csc')
 
-        # Iterate over horizon
-        for i in range(N):
-
-            # Get information about current waypoint
-            current_waypoint = self.get_waypoint(i)
-            next_waypoint = self.get_waypoint(i+1)
-            # distance between waypoints
-            li = next_waypoint - current_waypoint
-            # curvature of waypoint
-            ki = current_waypoint.kappa
-
-            # Fill operator matrix
-            # dynamics of acceleration
-            if i < N-1:
-                D1[i, i:i+2] = np.array([-1/(2*li), 1/(2*li)])
-
-            # Compute dynamic constraint on velocity
-            v_max_dyn = np.sqrt(ay_max / (np.abs(ki) + self.eps))
-            if v_max_dyn < v_max[i]:
-                v_max[i] = v_max_dyn
+        # Compute dynamic constraint on velocity
+        v_max_dyn = np.sqrt(ay_max / (np.abs(ki) + self.eps))
+        v_max = np.minimum(v_max, v_max_dyn)
 
         # Construct inequality matrix
-        D1 = sparse.csc_matrix(D1)
-        D2 = sparse.eye(N)
+        D2 = sparse.eye(N, format='csc')
         D = sparse.vstack([D1, D2], format='csc')
 
         # Get upper and lower bound vectors for inequality constraints
@@ -349,9 +608,137 @@ class ReferencePath:
         speed_profile = problem.solve().x
 
         # Assign reference velocity to every waypoint
-        for i, wp in enumerate(self.waypoints[:-1]):
-            wp.v_ref = speed_profile[i]
-        self.waypoints[-1].v_ref = self.waypoints[-2].v_ref
+        self.waypoints.v_ref[:-1] = speed_profile
+        self.waypoints.v_ref[-1] = self.waypoints.v_ref[-2]
+
+        # Store speed profile in cache
+        if self.cache_dir is not None:
+            save_cache(self.cache_dir, 'speed_profile', cache_key,
+                       v_ref=self.waypoints.v_ref)
+
+    def update_speed_profile(self, wp_id, n, Constraints):
+        """
+        Re-optimize the speed profile on a window of n waypoints following
+        wp_id. The reference velocity at wp_id is kept fixed and serves as
+        boundary condition together with the existing profile after the
+        window, i.e. the velocities at the first and last waypoint of the
+        window have to be reachable from their neighbors outside the window.
+        Velocity limits are always met. Acceleration limits, including the
+        boundary conditions, are relaxed by slack variables if necessary,
+        e.g. if a lower v_max can not be reached from the fixed velocity
+        preceding the window. Violations are penalized to be as small as
+        possible. A persistent solver is used and warm started with the
+        existing profile as long as the window size does not change.
+        :param wp_id: ID of waypoint preceding the window
+        :param n: number of waypoints in the window
+        :param Constraints: constraints on acceleration and velocity. v_max
+        can be a scalar or an array containing a maximum velocity for every
+        waypoint of the window
+        :return: True if the profile of the window was updated, False if
+        the window is empty or the problem could not be solved
+        """
+
+        # Limit window to end of path if not circular. Last waypoint of the
+        # path copies the reference velocity of the second to last one.
+        if self.circular:
+            n = min(n, self.n_waypoints - 1)
+        else:
+            n = min(n, self.n_waypoints - 2 - wp_id)
+        if n < 1:
+            return False
+
+        # Get preceding waypoint, waypoints of window and, if available,
+        # first waypoint after the window
+        has_next = self.circular or wp_id + n + 1 < self.n_waypoints
+        waypoints = self.get_waypoints(wp_id, n + 1 + has_next)
+        ids = np.mod(np.arange(wp_id + 1, wp_id + n + 1), self.n_waypoints)
+
+        # Distance between waypoints and curvature of waypoints
+        li = np.hypot(np.diff(waypoints.x), np.diff(waypoints.y))
+        ki = waypoints.kappa[1:n+1]
+
+        # Constraints
+        a_min = Constraints['a_min']
+        a_max = Constraints['a_max']
+        v_min = np.ones(n) * Constraints['v_min']
+        v_max = np.ones(n) * Constraints['v_max']
+
+        # Maximum lateral acceleration
+        ay_max = Constraints['ay_max']
+
+        # Compute dynamic constraint on velocity
+        v_max_dyn = np.sqrt(ay_max / (np.abs(ki) + self.eps))
+        v_max = np.minimum(v_max, v_max_dyn)
+        v_min = np.minimum(v_min, v_max)
+
+        # Acceleration operator. Rows correspond to the transition from the
+        # fixed velocity preceding the window, the transitions within the
+        # window and, if available, the transition to the fixed velocity
+        # after the window. Fixed velocities enter the offset.
+        scale = 1 / (2 * li[:n + has_next])
+        D1 = sparse.diags([-scale[1:n], scale[1:n]], [0, 1], shape=(n-1, n))
+        rows = [sparse.csc_matrix(([scale[0]], ([0], [0])), shape=(1, n)),
+                D1]
+        offset = [-waypoints.v_ref[0] * scale[0]] + [0.0] * (n - 1)
+        if has_next:
+            rows.append(sparse.csc_matrix(([-scale[-1]], ([0], [n-1])),
+                                          shape=(1, n)))
+            offset.append(waypoints.v_ref[-1] * scale[-1])
+        D1 = sparse.vstack(rows)
+        offset = np.array(offset)
+        m = D1.shape[0]
+
+        # Inequality Matrix. Decision variables are velocities followed by
+        # one slack variable per acceleration constraint, which widens its
+        # lower and upper bound.
+        I_n, I_m = sparse.eye(n), sparse.eye(m)
+        D = sparse.bmat([[D1, I_m], [D1, -I_m], [I_n, None], [None, I_m]],
+                        format='csc')
+        # Solver stores matrix with sorted indices. Sort to allow for
+        # updates of the matrix values.
+        D.sort_indices()
+
+        # Get upper and lower bound vectors for inequality constraints
+        l = np.hstack([a_min - offset, -np.inf * np.ones(m), v_min,
+                       np.zeros(m)])
+        u = np.hstack([np.inf * np.ones(m), a_max - offset, v_max,
+                       np.inf * np.ones(m)])
+
+        # Set cost vector. Linear and quadratic penalties of slack variables
+        # exceed any gain in velocity, so acceleration limits are only
+        # violated if unavoidable.
+        slack_weight = 100.0
+        q = np.hstack([-1 * v_max, slack_weight * np.ones(m)])
+
+        # Update persistent solver if window size unchanged
+        if self.speed_profile_window == (n, has_next):
+            self.speed_profile_solver.update(q=q, l=l, u=u, Ax=D.data)
+        # Set up new solver otherwise
+        else:
+            P = sparse.block_diag([sparse.eye(n), slack_weight * I_m],
+                                  format='csc')
+            self.speed_profile_solver = osqp.OSQP()
+            self.speed_profile_solver.setup(P=P, q=q, A=D, l=l, u=u,
+                                            eps_abs=1e-5, eps_rel=1e-5,
+                                            verbose=False)
+            self.speed_profile_window = (n, has_next)
+
+        # Warm start with existing profile and solve optimization problem
+        self.speed_profile_solver.warm_start(
+            x=np.hstack([waypoints.v_ref[1:n+1], np.zeros(m)]))
+        results = self.speed_profile_solver.solve()
+
+        # Keep existing profile if problem not solved
+        if results.info.status != 'solved':
+            return False
+
+        # Assign reference velocity to waypoints of window. Velocity limits
+        # are met up to the solver tolerance, hence clip to the limits.
+        self.waypoints.v_ref[ids] = np.clip(results.x[:n], v_min, v_max)
+        if not self.circular and ids[-1] == self.n_waypoints - 2:
+            self.waypoints.v_ref[-1] = self.waypoints.v_ref[-2]
+
+        return True
 
     def get_waypoint(self, wp_id):
         """
@@ -370,6 +757,31 @@ class ReferencePath:
 
         return self.waypoints[wp_id]
 
+    def get_waypoints(self, start, n):
+        """
+        Get n consecutive waypoints starting at start. Circular indexing
+        supported. The columns of the returned store are views on the
+        columns of the path's waypoint store unless the requested range wraps
+        around the end of a circular path.
+        :param start: ID of first waypoint
+        :param n: number of waypoints
+        :return: waypoint store containing requested waypoints
+        """
+
+        # Terminate execution if end of path reached
+        if start + n > self.n_waypoints and not self.circular:
+            print('Reached end of path!')
+            exit(1)
+
+        # Return views if range does not wrap around
+        start = start % self.n_waypoints
+        if start + n <= self.n_waypoints:
+            return self.waypoints.take(slice(start, start + n))
+
+        # Gather waypoints if range wraps around end of circular path
+        ids = np.mod(np.arange(start, start + n), self.n_waypoints)
+        return self.waypoints.take(ids)
+
     def show(self, display_drivable_area=True):
         """
         Display path object on current figure.
@@ -377,6 +789,9 @@ class ReferencePath:
         of drivable area
         """
 
+        # Import plotting library only when needed
+        import matplotlib.pyplot as plt
+
         # Clear figure
         plt.clf()
 
@@ -385,7 +800,7 @@ class ReferencePath:
         plt.yticks([])
 
         # Plot map in gray-scale and set extent to match world coordinates
-        canvas = np.ones(self.map.data.shape)
+        canvas = np.ones((self.map.height, self.map.width))
         # canvas = np.flipud(self.map.data)
         plt.imshow(canvas, cmap='gray',
                    extent=[self.map.origin[0], self.map.origin[0] +
@@ -395,17 +810,17 @@ class ReferencePath:
                    vmax=1.0)
 
         # Get x and y coordinates for all waypoints
-        wp_x = np.array([wp.x for wp in self.waypoints])
-        wp_y = np.array([wp.y for wp in self.waypoints])
+        wp_x = self.waypoints.x
+        wp_y = self.waypoints.y
 
         # Get x and y locations of border cells for upper and lower bound
-        wp_ub_x = np.array([wp.static_border_cells[0][0] for wp in self.waypoints])
-        wp_ub_y = np.array([wp.static_border_cells[0][1] for wp in self.waypoints])
-        wp_lb_x = np.array([wp.static_border_cells[1][0] for wp in self.waypoints])
-        wp_lb_y = np.array([wp.static_border_cells[1][1] for wp in self.waypoints])
+        wp_ub_x = self.waypoints.static_border_cells[:, 0, 0]
+        wp_ub_y = self.waypoints.static_border_cells[:, 0, 1]
+        wp_lb_x = self.waypoints.static_border_cells[:, 1, 0]
+        wp_lb_y = self.waypoints.static_border_cells[:, 1, 1]
 
         # Plot waypoints
-        # colors = [wp.v_ref for wp in self.waypoints]
+        # colors = self.waypoints.v_ref
         plt.scatter(wp_x, wp_y, c=WAYPOINTS, s=10)
 
         # Plot arrows indicating drivable area
@@ -418,18 +833,10 @@ class ReferencePath:
                    headwidth=1, headlength=0)
 
         # Plot border of path
-        bl_x = np.array([wp.static_border_cells[0][0] for wp in
-                         self.waypoints] +
-                        [self.waypoints[0].static_border_cells[0][0]])
-        bl_y = np.array([wp.static_border_cells[0][1] for wp in
-                         self.waypoints] +
-                        [self.waypoints[0].static_border_cells[0][1]])
-        br_x = np.array([wp.static_border_cells[1][0] for wp in
-                         self.waypoints] +
-                        [self.waypoints[0].static_border_cells[1][0]])
-        br_y = np.array([wp.static_border_cells[1][1] for wp in
-                         self.waypoints] +
-                        [self.waypoints[0].static_border_cells[1][1]])
+        bl_x = np.hstack([wp_ub_x, wp_ub_x[0]])
+        bl_y = np.hstack([wp_ub_y, wp_ub_y[0]])
+        br_x = np.hstack([wp_lb_x, wp_lb_x[0]])
+        br_y = np.hstack([wp_lb_y, wp_lb_y[0]])
 
         # If circular path, connect start and end point
         if self.circular:
@@ -444,18 +851,11 @@ class ReferencePath:
 
         # Plot dynamic path constraints
         # Get x and y locations of border cells for upper and lower bound
-        wp_ub_x = np.array(
-            [wp.dynamic_border_cells[0][0] for wp in self.waypoints]+
-                        [self.waypoints[0].static_border_cells[0][0]])
-        wp_ub_y = np.array(
-            [wp.dynamic_border_cells[0][1] for wp in self.waypoints]+
-                        [self.waypoints[0].static_border_cells[0][1]])
-        wp_lb_x = np.array(
-            [wp.dynamic_border_cells[1][0] for wp in self.waypoints]+
-                        [self.waypoints[0].static_border_cells[1][0]])
-        wp_lb_y = np.array(
-            [wp.dynamic_border_cells[1][1] for wp in self.waypoints]+
-                        [self.waypoints[0].static_border_cells[1][1]])
+        dynamic_border_cells = self.waypoints.dynamic_border_cells
+        wp_ub_x = np.hstack([dynamic_border_cells[:, 0, 0], bl_x[0]])
+        wp_ub_y = np.hstack([dynamic_border_cells[:, 0, 1], bl_y[0]])
+        wp_lb_x = np.hstack([dynamic_border_cells[:, 1, 0], br_x[0]])
+        wp_lb_y = np.hstack([dynamic_border_cells[:, 1, 1], br_y[0]])
         plt.plot(wp_ub_x, wp_ub_y, c=PATH_CONSTRAINTS)
         plt.plot(wp_lb_x, wp_lb_y, c=PATH_CONSTRAINTS)
 
@@ -463,59 +863,111 @@ class ReferencePath:
         for obstacle in self.map.obstacles:
              obstacle.show()
 
+    def _compute_cross_sections(self):
+        """
+        Compute the cells on the cross-sections of all waypoints, i.e. the
+        lines between their static border cells, in map coordinates.
+        :return: flat map indices of cells on all cross-sections, offsets of
+        the cross-section of every waypoint into the cell array and bounding
+        boxes of the cross-sections as array of shape (n_waypoints, 4) with
+        rows (x_min, y_min, x_max, y_max) in px
+        """
+
+        # Map coordinates of static border cells
+        border_x, border_y = self.map.w2m(
+            self.waypoints.static_border_cells[:, :, 0],
+            self.waypoints.static_border_cells[:, :, 1])
+
+        # Compute path from upper border cell to lower border cell
+        cells = []
+        bboxes = np.zeros((self.n_waypoints, 4), dtype=int)
+        for wp_id, ((ub_x, lb_x), (ub_y, lb_y)) in enumerate(zip(border_x,
+                                                                 border_y)):
+            x_list, y_list, _ = line_aa(ub_x, ub_y, lb_x, lb_y)
+            cells.append(y_list * self.map.width + x_list)
+            bboxes[wp_id] = (x_list.min(), y_list.min(), x_list.max(),
+                             y_list.max())
+
+        offsets = np.cumsum([0] + [len(c) for c in cells])
+
+        return np.hstack(cells).astype(np.int32), offsets, bboxes
+
+    def _get_free_segments(self, wp, min_width):
+        """
+        Get free path segments of waypoint. Segments are cached per waypoint
+        and only recomputed if the minimum width changed or the map changed
+        within the cross-section of the waypoint.
+        :param wp: waypoint object
+        :param min_width: minimum width of valid segment
+        :return: segment candidates as list of tuples (ub_cell, lb_cell)
+        """
+
+        # Segments computed from the local map are valid for one scan only
+        if self.local_map is not None:
+            return self._compute_free_segments(wp, min_width)
+
+        wp_id = wp.wp_id
+        cached = self.free_segments[wp_id]
+
+        # Reuse cached segments if map unchanged within cross-section
+        if cached is not None and cached[0] == min_width and not \
+                self.map.is_dirty(self.cross_sections[wp_id],
+                                  self.free_segments_version[wp_id]):
+            free_segments = cached[1]
+        else:
+            free_segments = self._compute_free_segments(wp, min_width)
+            self.free_segments[wp_id] = (min_width, free_segments)
+        self.free_segments_version[wp_id] = self.map.version
+
+        return free_segments
+
     def _compute_free_segments(self, wp, min_width):
         """
-        Compute free path segments.
+        Compute free path segments. The cross-section of the waypoint is
+        split at occupied cells of the local map if set, otherwise of the
+        map. Every run of free cells yields a segment from the preceding
+        occupied cell (or the upper border cell) to the terminating occupied
+        cell (or the lower border cell).
         :param wp: waypoint object
         :param min_width: minimum width of valid segment
         :return: segment candidates as list of tuples (ub_cell, lb_cell)
         """
 
-        # Candidate segments
-        free_segments = []
-
-        # Get waypoint's border cells in map coordinates
-        ub_p = self.map.w2m(wp.static_border_cells[0][0],
-                            wp.static_border_cells[0][1])
-        lb_p = self.map.w2m(wp.static_border_cells[1][0],
-                            wp.static_border_cells[1][1])
-
-        # Compute path from left border cell to right border cell
-        x_list, y_list, _ = line_aa(ub_p[0], ub_p[1], lb_p[0], lb_p[1])
-
-        # Initialize upper and lower bound of drivable area to
-        # upper bound of path
-        ub_o, lb_o = ub_p, ub_p
-
-        # Assume occupied path
-        free_cells = False
-
-        # Iterate over path from left border to right border
-        for x, y in zip(x_list[1:], y_list[1:]):
-            # If cell is free, update lower bound
-            if self.map.data[y, x] == 1:
-                # Free cell detected
-                free_cells = True
-                lb_o = (x, y)
-            # If cell is occupied or end of path, end segment. Add segment
-            # to list of candidates. Then, reset upper and lower bound to
-            # current cell.
-            if (self.map.data[y, x] == 0 or (x, y) == lb_p) and free_cells:
-                # Set lower bound to border cell of segment
-                lb_o = (x, y)
-                # Transform upper and lower bound cells to world coordinates
-                ub_o = self.map.m2w(ub_o[0], ub_o[1])
-                lb_o = self.map.m2w(lb_o[0], lb_o[1])
-                # If segment larger than threshold, add to candidates
-                if np.sqrt((ub_o[0]-lb_o[0])**2 + (ub_o[1]-lb_o[1])**2) > \
-                    min_width:
-                    free_segments.append((ub_o, lb_o))
-                # Start new segment
-                ub_o = (x, y)
-                free_cells = False
-            elif self.map.data[y, x] == 0 and not free_cells:
-                ub_o = (x, y)
-                lb_o = (x, y)
+        # Get cells on cross-section from upper to lower border cell
+        cells = self.cross_section_cells[
+                self.cross_section_offsets[wp.wp_id]:
+                self.cross_section_offsets[wp.wp_id + 1]]
+        ub_p, cells = cells[0], cells[1:]
+        if len(cells) == 0:
+            return []
+
+        # Occupied cells and lower border cell end a segment
+        occupancy = self.map if self.local_map is None else self.local_map
+        occupied = occupancy.get_cells(cells % self.map.width,
+                                       cells // self.map.width) == 0
+        end_ids = np.flatnonzero(occupied | (cells == cells[-1]))
+
+        # A segment is found if there are free cells between the previous
+        # end cell and the current end cell (inclusive)
+        n_free = np.cumsum(~occupied)[end_ids]
+        n_free = np.diff(np.hstack([0, n_free]))
+        valid = n_free > 0
+
+        # Upper bound cells are previous end cells, lower bound cells are
+        # current end cells
+        ub_cells = np.hstack([ub_p, cells[end_ids[:-1]]])[valid]
+        lb_cells = cells[end_ids][valid]
+
+        # Transform upper and lower bound cells to world coordinates
+        ub_x, ub_y = self.map.m2w(ub_cells % self.map.width,
+                                  ub_cells // self.map.width)
+        lb_x, lb_y = self.map.m2w(lb_cells % self.map.width,
+                                  lb_cells // self.map.width)
+
+        # If segment larger than threshold, add to candidates
+        valid = np.sqrt((ub_x - lb_x)**2 + (ub_y - lb_y)**2) > min_width
+        free_segments = [((ub_x[i], ub_y[i]), (lb_x[i], lb_y[i]))
+                         for i in np.flatnonzero(valid)]
 
         return free_segments
 
@@ -538,7 +990,7 @@ class ReferencePath:
             wp = self.get_waypoint(wp_id+n)
 
             # Get list of free segments
-            free_segments = self._compute_free_segments(wp, min_width)
+            free_segments = self._get_free_segments(wp, min_width)
 
             # First waypoint in horizon uses largest segment
             if n == 0:
@@ -649,6 +1101,7 @@ class ReferencePath:
 
 
 if __name__ == '__main__':
+    import matplotlib.pyplot as plt
 
     # Select Track | 'Real_Track' or 'Sim_Track'
     path = 'Sim_Track'
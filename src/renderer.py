@@ -0,0 +1,499 @@
+import numpy as np
+import multiprocessing
+import subprocess
+import shutil
+import os
+from reference_path import DRIVABLE_AREA, WAYPOINTS, PATH_CONSTRAINTS
+from map import OBSTACLE
+from spatial_bicycle_models import CAR, CAR_OUTLINE
+from MPC import PREDICTION
+from lidar_model import SCAN
+
+BORDER = '#5E5E5E'
+
+
+#############
+# Snapshots #
+#############
+
+def get_scene(reference_path, car):
+    """
+    Collect static information required to draw the simulation view. Only
+    plain numpy data is stored, so the scene can be sent to another process.
+    Obstacles are part of the dynamic obstacle layer of the map and thus
+    collected in snapshots.
+    :param reference_path: reference path object
+    :param car: car model object
+    :return: dict containing static scene information
+    """
+
+    map = reference_path.map
+    waypoints = reference_path.waypoints
+
+    return {'extent': [map.origin[0], map.origin[0] +
+                       map.width * map.resolution,
+                       map.origin[1], map.origin[1] +
+                       map.height * map.resolution],
+            'map_shape': (map.height, map.width),
+            'wp_x': np.array(waypoints.x),
+            'wp_y': np.array(waypoints.y),
+            'static_border_cells': np.array(waypoints.static_border_cells),
+            'circular': reference_path.circular,
+            'resolution': reference_path.resolution,
+            'car_length': car.length,
+            'car_width': car.width}
+
+
+def get_snapshot(reference_path, car, mpc=None, lidar=None, title=None):
+    """
+    Collect the state of all dynamic elements of the simulation view at the
+    current time step. Arrays are copied, so the snapshot is not affected by
+    subsequent simulation steps.
+    :param reference_path: reference path object
+    :param car: car model object
+    :param mpc: optional MPC object whose prediction is displayed
+    :param lidar: optional lidar model whose measurements are displayed
+    :param title: optional figure title
+    :return: dict containing dynamic scene information
+    """
+
+    snapshot = {'pose': (car.temporal_state.x, car.temporal_state.y,
+                         car.temporal_state.psi),
+                'dynamic_border_cells':
+                    np.array(reference_path.waypoints.dynamic_border_cells),
+                'obstacles': [(obstacle.cx, obstacle.cy, obstacle.radius)
+                              for obstacle in reference_path.map.obstacles],
+                'prediction': None, 'scan': None, 'title': title}
+    if mpc is not None and mpc.current_prediction is not None:
+        snapshot['prediction'] = np.array(mpc.current_prediction)
+    if lidar is not None:
+        snapshot['scan'] = lidar.get_beam_segments(car.temporal_state)
+
+    return snapshot
+
+
+############
+# Renderer #
+############
+
+class Renderer:
+    """
+    Persistent-artist renderer for the simulation view. Static layers (map,
+    waypoints, static borders) are drawn once and cached as a background
+    image. Each step only the car, the obstacles, the dynamic path
+    constraints, the MPC prediction and the lidar beams are redrawn on top
+    of it via blitting.
+    """
+    def __init__(self, scene, display_drivable_area=True, interactive=True):
+        """
+        Constructor for the renderer. Creates a new figure and draws all
+        static layers.
+        :param scene: static scene information, see get_scene
+        :param display_drivable_area: If True, display arrows indicating width
+        of drivable area
+        :param interactive: If True, open a window using pyplot. Otherwise
+        render into an off-screen canvas, e.g. for frame export
+        """
+
+        # Import plotting libraries only when needed
+        import matplotlib.patches as plt_patches
+        from matplotlib.collections import LineCollection, PatchCollection
+
+        self.display_drivable_area = display_drivable_area
+        self.interactive = interactive
+
+        # Create figure and axis
+        if interactive:
+            import matplotlib.pyplot as plt
+            self.fig, self.ax = plt.subplots()
+        else:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            self.fig = Figure()
+            FigureCanvasAgg(self.fig)
+            self.ax = self.fig.add_subplot()
+        self.ax.set_xticks([])
+        self.ax.set_yticks([])
+        self.ax.axis('off')
+
+        # Static artists, recreated whenever the scene changes
+        self.static_artists = []
+        self.scene = None
+
+        # Dynamic artists, drawn on top of the cached background every step
+        self.car_patch = plt_patches.Polygon(np.zeros((4, 2)), closed=True,
+                                             facecolor=CAR,
+                                             edgecolor=CAR_OUTLINE, zorder=20)
+        self.ax.add_patch(self.car_patch)
+        self.ub_line, = self.ax.plot([], [], c=PATH_CONSTRAINTS)
+        self.lb_line, = self.ax.plot([], [], c=PATH_CONSTRAINTS)
+        self.prediction_line, = self.ax.plot([], [], linestyle='',
+                                             marker='o', markersize=5,
+                                             c=PREDICTION, zorder=15)
+        self.scan_lines = LineCollection([], colors=SCAN, zorder=10)
+        self.ax.add_collection(self.scan_lines)
+        self.obstacle_patches = PatchCollection([], color=OBSTACLE, zorder=20)
+        self.ax.add_collection(self.obstacle_patches)
+        self.title = self.ax.set_title('')
+        self.dynamic_artists = [self.ub_line, self.lb_line,
+                                self.scan_lines, self.obstacle_patches,
+                                self.prediction_line, self.car_patch,
+                                self.title]
+        for artist in self.dynamic_artists:
+            artist.set_animated(True)
+
+        # Cached background, invalidated on every full redraw of the canvas
+        self.background = None
+        self.fig.canvas.mpl_connect('draw_event', self._on_draw)
+
+        # Draw static layers
+        self.set_scene(scene)
+
+        # Show figure without blocking
+        if interactive:
+            plt.show(block=False)
+            plt.pause(0.001)
+
+    def set_scene(self, scene):
+        """
+        Draw map, waypoints and static borders. Replaces previously drawn
+        static layers.
+        :param scene: static scene information, see get_scene
+        """
+
+        # Remove outdated static layers
+        for artist in self.static_artists:
+            artist.remove()
+        self.static_artists = []
+        self.scene = scene
+        self.background = None
+
+        ax = self.ax
+
+        # Plot map in gray-scale and set extent to match world coordinates
+        canvas = np.ones(scene['map_shape'])
+        self.static_artists.append(
+            ax.imshow(canvas, cmap='gray', extent=scene['extent'], vmin=0.0,
+                      vmax=1.0))
+
+        # Get x and y coordinates for all waypoints
+        wp_x = scene['wp_x']
+        wp_y = scene['wp_y']
+
+        # Get x and y locations of border cells for upper and lower bound
+        static_border_cells = scene['static_border_cells']
+        wp_ub_x = static_border_cells[:, 0, 0]
+        wp_ub_y = static_border_cells[:, 0, 1]
+        wp_lb_x = static_border_cells[:, 1, 0]
+        wp_lb_y = static_border_cells[:, 1, 1]
+
+        # Plot waypoints
+        self.static_artists.append(ax.scatter(wp_x, wp_y, c=WAYPOINTS, s=10))
+
+        # Plot arrows indicating drivable area
+        if self.display_drivable_area:
+            for b_x, b_y in ((wp_ub_x, wp_ub_y), (wp_lb_x, wp_lb_y)):
+                self.static_artists.append(
+                    ax.quiver(wp_x, wp_y, b_x - wp_x, b_y - wp_y, scale=1,
+                              units='xy', width=0.2*scene['resolution'],
+                              color=DRIVABLE_AREA, headwidth=1,
+                              headlength=0))
+
+        # Plot border of path
+        bl_x = np.hstack([wp_ub_x, wp_ub_x[0]])
+        bl_y = np.hstack([wp_ub_y, wp_ub_y[0]])
+        br_x = np.hstack([wp_lb_x, wp_lb_x[0]])
+        br_y = np.hstack([wp_lb_y, wp_lb_y[0]])
+
+        # If circular path, connect start and end point
+        if scene['circular']:
+            borders = [((bl_x, bl_y), BORDER), ((br_x, br_y), BORDER)]
+        # If not circular, close path at start and end
+        else:
+            borders = [((bl_x[:-1], bl_y[:-1]), OBSTACLE),
+                       ((br_x[:-1], br_y[:-1]), OBSTACLE),
+                       (((bl_x[-2], br_x[-2]), (bl_y[-2], br_y[-2])), OBSTACLE),
+                       (((bl_x[0], br_x[0]), (bl_y[0], br_y[0])), OBSTACLE)]
+        for (x, y), color in borders:
+            self.static_artists.extend(ax.plot(x, y, color=color))
+
+        # Close dynamic constraints at start of path
+        self.border_start = (bl_x[0], bl_y[0], br_x[0], br_y[0])
+
+    def _on_draw(self, event):
+        """
+        Capture background after full redraw of the canvas (initial draw,
+        resize, scene update) and draw dynamic artists on top.
+        :param event: matplotlib draw event
+        """
+
+        canvas = self.fig.canvas
+        self.background = canvas.copy_from_bbox(self.fig.bbox)
+        self._draw_dynamic_layers()
+
+    def _draw_dynamic_layers(self):
+        """
+        Draw all dynamic artists on the current canvas.
+        """
+
+        for artist in self.dynamic_artists:
+            self.fig.draw_artist(artist)
+
+    def draw(self, snapshot):
+        """
+        Update dynamic artists to a snapshot of the simulation and blit them
+        onto the cached background.
+        :param snapshot: dynamic scene information, see get_snapshot
+        """
+
+        # Import plotting library only when needed
+        import matplotlib.patches as plt_patches
+
+        # Update car outline
+        self.car_patch.set_xy(self._car_outline(*snapshot['pose']))
+
+        # Update obstacles
+        self.obstacle_patches.set_paths(
+            [plt_patches.Circle(xy=(cx, cy), radius=radius)
+             for cx, cy, radius in snapshot['obstacles']])
+
+        # Update dynamic path constraints
+        dynamic_border_cells = snapshot['dynamic_border_cells']
+        bl_x, bl_y, br_x, br_y = self.border_start
+        self.ub_line.set_data(np.hstack([dynamic_border_cells[:, 0, 0], bl_x]),
+                              np.hstack([dynamic_border_cells[:, 0, 1], bl_y]))
+        self.lb_line.set_data(np.hstack([dynamic_border_cells[:, 1, 0], br_x]),
+                              np.hstack([dynamic_border_cells[:, 1, 1], br_y]))
+
+        # Update MPC prediction
+        if snapshot['prediction'] is not None:
+            self.prediction_line.set_data(snapshot['prediction'][0],
+                                          snapshot['prediction'][1])
+
+        # Update lidar beams
+        if snapshot['scan'] is not None:
+            self.scan_lines.set_segments(snapshot['scan'])
+
+        # Update title
+        if snapshot['title'] is not None:
+            self.title.set_text(snapshot['title'])
+
+        # Full redraw if no valid background is cached, triggers _on_draw
+        canvas = self.fig.canvas
+        if self.background is None:
+            canvas.draw()
+        # Otherwise restore background and only draw dynamic artists
+        else:
+            canvas.restore_region(self.background)
+            self._draw_dynamic_layers()
+            canvas.blit(self.fig.bbox)
+        if self.interactive:
+            canvas.flush_events()
+
+    def update(self, reference_path, car, mpc=None, lidar=None, title=None):
+        """
+        Draw current state of the simulation.
+        :param reference_path: reference path object
+        :param car: car model object
+        :param mpc: optional MPC object whose prediction is displayed
+        :param lidar: optional lidar model whose measurements are displayed
+        :param title: optional figure title
+        """
+
+        self.draw(get_snapshot(reference_path, car, mpc, lidar, title))
+
+    def get_frame(self):
+        """
+        Get image of the current canvas.
+        :return: RGB image | (height, width, 3)
+        """
+
+        return np.array(self.fig.canvas.buffer_rgba())[:, :, :3]
+
+    def _car_outline(self, x, y, psi):
+        """
+        Compute corners of the car rectangle in world coordinates.
+        :param x: x coordinate of car's center of gravity
+        :param y: y coordinate of car's center of gravity
+        :param psi: yaw angle of the car
+        :return: array of corners | (4, 2)
+        """
+
+        length = self.scene['car_length']
+        width = self.scene['car_width']
+        c, s = np.cos(psi), np.sin(psi)
+        corners = 0.5 * np.array([[-length, -width], [length, -width],
+                                  [length, width], [-length, width]])
+        rotation = np.array([[c, -s], [s, c]])
+        return corners @ rotation.T + np.array([x, y])
+
+
+############
+# Recorder #
+############
+
+class Recorder:
+    """
+    Offline export of the simulation view. Snapshots are streamed to worker
+    processes which render the frames, so recording does not slow down the
+    control loop. Frames are either written as PNG files into a directory or
+    assembled into a GIF or video file by a separate writer process.
+    """
+    def __init__(self, output, reference_path, car, fps=20, n_workers=1,
+                 display_drivable_area=True):
+        """
+        Constructor for the recorder. Starts worker processes.
+        :param output: directory for PNG frames or path of a GIF or video
+        file, e.g. 'animation.gif' or 'animation.mp4'
+        :param reference_path: reference path object
+        :param car: car model object
+        :param fps: frame rate of GIF or video file
+        :param n_workers: number of rendering processes
+        :param display_drivable_area: If True, display arrows indicating width
+        of drivable area
+        """
+
+        # Write PNG frames if output has no file extension
+        extension = os.path.splitext(output)[1].lower()
+        if extension == '':
+            os.makedirs(output, exist_ok=True)
+        elif extension != '.gif' and shutil.which('ffmpeg') is None:
+            print('Writing {} files requires ffmpeg!'.format(extension))
+            exit(1)
+
+        # Create directory of GIF or video file before the simulation runs,
+        # the writer process only opens the file for the first frame
+        elif os.path.dirname(output) != '':
+            os.makedirs(os.path.dirname(output), exist_ok=True)
+
+        # Use fresh interpreters to not inherit plotting state of the
+        # simulation
+        context = multiprocessing.get_context('spawn')
+
+        # Frame writer, assembles rendered frames in order
+        self.frame_queue = None
+        self.writer = None
+        if extension != '':
+            self.frame_queue = context.Queue(maxsize=4*n_workers)
+            self.writer = context.Process(target=_write_frames,
+                                          args=(self.frame_queue, output,
+                                                fps))
+            self.writer.start()
+
+        # Rendering workers sharing a queue of snapshots. Recording blocks
+        # if the workers fall behind, so snapshots do not pile up in memory.
+        scene = get_scene(reference_path, car)
+        self.snapshot_queue = context.Queue(maxsize=4*n_workers)
+        self.workers = []
+        for _ in range(n_workers):
+            worker = context.Process(target=_render_frames,
+                                     args=(self.snapshot_queue,
+                                           self.frame_queue, output, scene,
+                                           display_drivable_area))
+            worker.start()
+            self.workers.append(worker)
+
+        # Number of recorded frames
+        self.n_frames = 0
+
+    def record(self, reference_path, car, mpc=None, lidar=None, title=None):
+        """
+        Record current state of the simulation.
+        :param reference_path: reference path object
+        :param car: car model object
+        :param mpc: optional MPC object whose prediction is displayed
+        :param lidar: optional lidar model whose measurements are displayed
+        :param title: optional figure title
+        """
+
+        snapshot = get_snapshot(reference_path, car, mpc, lidar, title)
+        self.snapshot_queue.put((self.n_frames, snapshot))
+        self.n_frames += 1
+
+    def close(self):
+        """
+        Wait until all recorded frames are rendered and written.
+        """
+
+        for _ in self.workers:
+            self.snapshot_queue.put(None)
+        for worker in self.workers:
+            worker.join()
+        if self.writer is not None:
+            self.frame_queue.put(None)
+            self.writer.join()
+
+
+def _render_frames(snapshot_queue, frame_queue, output, scene,
+                   display_drivable_area):
+    """
+    Worker process rendering snapshots until None is received.
+    :param snapshot_queue: queue of (frame_id, snapshot) tuples
+    :param frame_queue: queue to pass (frame_id, frame) to the writer or None
+    to write PNG files
+    :param output: directory for PNG frames
+    :param scene: static scene information
+    :param display_drivable_area: If True, display arrows indicating width
+    of drivable area
+    """
+
+    from PIL import Image
+
+    renderer = Renderer(scene, display_drivable_area, interactive=False)
+    for frame_id, snapshot in iter(snapshot_queue.get, None):
+        renderer.draw(snapshot)
+        if frame_queue is None:
+            Image.fromarray(renderer.get_frame()).save(
+                os.path.join(output, 'frame_{:05d}.png'.format(frame_id)))
+        else:
+            frame_queue.put((frame_id, renderer.get_frame()))
+
+
+def _write_frames(frame_queue, output, fps):
+    """
+    Writer process assembling frames in order until None is received.
+    Frames are written as soon as all preceding frames are written, GIF
+    frames with their own color table.
+    :param frame_queue: queue of (frame_id, frame) tuples
+    :param output: path of GIF or video file
+    :param fps: frame rate
+    """
+
+    from PIL import GifImagePlugin, Image
+
+    # Frames arriving ahead of their turn
+    pending = {}
+    next_id = 0
+    gif = None
+    ffmpeg = None
+
+    for frame_id, frame in iter(frame_queue.get, None):
+        pending[frame_id] = frame
+        while next_id in pending:
+            frame = pending.pop(next_id)
+            next_id += 1
+            if output.lower().endswith('.gif'):
+                image = Image.fromarray(frame).quantize()
+                if gif is None:
+                    gif = open(output, 'wb')
+                    header, _ = GifImagePlugin.getheader(
+                        image, info={'loop': 0, 'duration': int(1000 / fps)})
+                    gif.writelines(header)
+                gif.writelines(GifImagePlugin.getdata(
+                    image, duration=int(1000 / fps), include_color_table=True))
+                continue
+            if ffmpeg is None:
+                height, width = frame.shape[:2]
+                ffmpeg = subprocess.Popen(
+                    ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo',
+                     '-pix_fmt', 'rgb24', '-s', '{}x{}'.format(width, height),
+                     '-r', str(fps), '-i', '-', '-pix_fmt', 'yuv420p',
+                     output], stdin=subprocess.PIPE)
+            ffmpeg.stdin.write(np.ascontiguousarray(frame).tobytes())
+
+    if gif is not None:
+        gif.write(b';')
+        gif.close()
+    if ffmpeg is not None:
+        ffmpeg.stdin.close()
+        ffmpeg.wait()
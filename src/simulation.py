@@ -1,10 +1,12 @@
-from map import Map, Obstacle
+from map import Map, Obstacle, LocalMap
 import numpy as np
 from reference_path import ReferencePath
 from spatial_bicycle_models import BicycleModel
-import matplotlib.pyplot as plt
 from MPC import MPC
+from lidar_model import LidarModel
 from scipy import sparse
+import sys
+import multiprocessing
 
 
 if __name__ == '__main__':
@@ -12,13 +14,38 @@ if __name__ == '__main__':
     # Select Simulation Mode | 'Sim_Track' or 'Real_Track'
     sim_mode = 'Sim_Track'
 
+    # Run without rendering if requested | python simulation.py --headless
+    headless = '--headless' in sys.argv
+    if not headless:
+        from renderer import Renderer, get_scene
+
+    # Export frames in background processes if requested | python
+    # simulation.py --record animation.gif
+    record = sys.argv[sys.argv.index('--record') + 1] \
+        if '--record' in sys.argv else None
+    if record is not None:
+        from renderer import Recorder
+
+    # Load processed map and reference path from cache if requested |
+    # python simulation.py --cache cache
+    cache_dir = sys.argv[sys.argv.index('--cache') + 1] \
+        if '--cache' in sys.argv else None
+
+    # Compute drivable area from a local map built from the latest lidar
+    # scan instead of the map | python simulation.py --local
+    local = '--local' in sys.argv
+
+    # Count time steps with predicted footprints in collision if requested |
+    # python simulation.py --collisions
+    count_collisions = '--collisions' in sys.argv
+
     # Simulation Environment. Mini-Car on track specifically designed to show-
     # case time-optimal driving.
     if sim_mode == 'Sim_Track':
 
         # Load map file
         map = Map(file_path='maps/sim_map.png', origin=[-1, -2],
-                  resolution=0.005)
+                  resolution=0.005, cache_dir=cache_dir)
 
         # Specify waypoints
         wp_x = [-0.75, -0.25, -0.25, 0.25, 0.25, 1.25, 1.25, 0.75, 0.75, 1.25,
@@ -32,7 +59,7 @@ if __name__ == '__main__':
         # Create smoothed reference path
         reference_path = ReferencePath(map, wp_x, wp_y, path_resolution,
                                        smoothing_distance=5, max_width=0.23,
-                                       circular=True)
+                                       circular=True, cache_dir=cache_dir)
 
         # Add obstacles
         use_obstacles = True
@@ -59,7 +86,7 @@ if __name__ == '__main__':
 
         # Load map file
         map = Map(file_path='maps/real_map.png', origin=(-30.0, -24.0),
-                  resolution=0.06)
+                  resolution=0.06, cache_dir=cache_dir)
 
         # Specify waypoints
         wp_x = [-9.169, 11.9, 7.3, -6.95]
@@ -71,7 +98,7 @@ if __name__ == '__main__':
         # Create smoothed reference path
         reference_path = ReferencePath(map, wp_x, wp_y, path_resolution,
                                        smoothing_distance=5, max_width=1.50,
-                                       circular=False)
+                                       circular=False, cache_dir=cache_dir)
 
         # Add obstacles
         add_obstacles = False
@@ -125,14 +152,38 @@ if __name__ == '__main__':
     # Set simulation time to zero
     t = 0.0
 
+    # Sensor providing scans for the local map
+    if local:
+        lidar = LidarModel(FoV=360, range=1.5, resolution=1.0)
+
     # Logging containers
     x_log = [car.temporal_state.x]
     y_log = [car.temporal_state.y]
     v_log = [0.0]
+    n_collisions = 0
+
+    # Draw static layers of the simulation view once
+    if not headless:
+        renderer = Renderer(get_scene(reference_path, car))
+
+    # Start rendering processes
+    if record is not None:
+        recorder = Recorder(record, reference_path, car, fps=int(1/car.Ts),
+                            n_workers=max(multiprocessing.cpu_count() - 1, 1))
 
     # Until arrival at end of path
     while car.s < reference_path.length:
 
+        # Build local map from current scan of the map
+        if local:
+            ranges = lidar.get_ranges(map, car.temporal_state.x,
+                                      car.temporal_state.y,
+                                      car.temporal_state.psi)
+            reference_path.local_map = LocalMap(
+                map, car.temporal_state.x, car.temporal_state.y,
+                car.temporal_state.psi, lidar.measurements[0], ranges,
+                lidar.range)
+
         # Get control signals
         u = mpc.get_control()
 
@@ -144,20 +195,37 @@ if __name__ == '__main__':
         y_log.append(car.temporal_state.y)
         v_log.append(u[0])
 
+        # Check predicted footprints for collisions
+        if count_collisions:
+            n_collisions += np.any(mpc.check_collision(map))
+
         # Increment simulation time
         t += car.Ts
 
-        # Plot path and drivable area
-        reference_path.show()
+        # Set figure title
+        title = 'MPC Simulation: v(t): {:.2f}, delta(t): {:.2f}, ' \
+                'Duration: {:.2f} s'.format(u[0], u[1], t)
 
-        # Plot car
-        car.show()
+        # Stream snapshot to rendering processes
+        if record is not None:
+            recorder.record(reference_path, car, mpc, title=title)
 
-        # Plot MPC prediction
-        mpc.show_prediction()
+        # Skip rendering in headless mode
+        if headless:
+            continue
 
-        # Set figure title
-        plt.title('MPC Simulation: v(t): {:.2f}, delta(t): {:.2f}, Duration: '
-                  '{:.2f} s'.format(u[0], u[1], t))
-        plt.axis('off')
-        plt.pause(0.001)
+        # Update car, path constraints and MPC prediction
+        renderer.update(reference_path, car, mpc, title=title)
+
+    # Wait for all frames to be written
+    if record is not None:
+        recorder.close()
+
+    # Report result of headless run
+    if headless:
+        print('Simulation finished: Duration: {:.2f} s, Average Speed: '
+              '{:.2f} m/s'.format(t, np.mean(v_log)))
+
+    # Report number of time steps with predicted collisions
+    if count_collisions:
+        print('Predicted Collisions: {}'.format(n_collisions))
@@ -9,8 +9,6 @@ except:
     class ABC(object):
         __metaclass__ = ABCMeta
         pass
-import matplotlib.pyplot as plt
-import matplotlib.patches as plt_patches
 import math
 
 # Colors
@@ -253,13 +251,49 @@ class SpatialBicycleModel(ABC):
 
         return safety_margin
 
+    def get_footprint(self, x, y, psi, n_circles=None):
+        """
+        Approximate the car's rectangle by circles of equal radius centered
+        on its longitudinal axis. Each circle covers an equally long section
+        of the rectangle, hence the circles over-approximate the car. They
+        protrude beyond its sides by radius - width / 2 and beyond its front
+        and rear by up to radius - length / (2 * n_circles). Collision checks
+        based on the footprint are therefore conservative.
+        :param x: x coordinates of car's center of gravity | float or array
+        :param y: y coordinates of car's center of gravity | float or array
+        :param psi: yaw angles of the car | float or array
+        :param n_circles: number of circles, by default chosen from the
+        car's aspect ratio such that sections are at most a quarter of the
+        car's width long and circles protrude beyond its sides by less than
+        4 % of its half width
+        :return: x and y coordinates of circle centers of shape
+        (..., n_circles) and radius of circles
+        """
+
+        # Choose number of circles from aspect ratio of the car
+        if n_circles is None:
+            n_circles = int(np.ceil(4 * self.length / self.width))
+
+        # Offsets of circle centers along longitudinal axis
+        offsets = (np.arange(n_circles) + 0.5) / n_circles * self.length - \
+            self.length / 2
+
+        # Circles covering the respective section of the rectangle
+        radius = np.hypot(self.length / (2 * n_circles), self.width / 2)
+
+        psi = np.asarray(psi, dtype=float)[..., None]
+        c_x = np.asarray(x, dtype=float)[..., None] + offsets * np.cos(psi)
+        c_y = np.asarray(y, dtype=float)[..., None] + offsets * np.sin(psi)
+
+        return c_x, c_y, radius
+
     def get_current_waypoint(self):
         """
         Get closest waypoint on reference path based on car's current location.
         """
 
-        # Compute cumulative path length
-        length_cum = np.cumsum(self.reference_path.segment_lengths)
+        # Get cumulative path length
+        length_cum = self.reference_path.waypoints.s
         # Get first index with distance larger than distance traveled by car
         # so far
         greater_than_threshold = length_cum > self.s
@@ -283,6 +317,10 @@ class SpatialBicycleModel(ABC):
         Display car on current axis.
         """
 
+        # Import plotting libraries only when needed
+        import matplotlib.pyplot as plt
+        import matplotlib.patches as plt_patches
+
         # Get car's center of gravity
         cog = (self.temporal_state.x, self.temporal_state.y)
         # Get current angle with respect to x-axis
@@ -314,6 +352,23 @@ class SpatialBicycleModel(ABC):
     def linearize(self, v_ref, kappa_ref, delta_s):
         pass
 
+    def linearize_horizon(self, v_ref, kappa_ref, delta_s):
+        """
+        Linearize the system equations around provided reference values for
+        all steps of a horizon. Stacks the results of self.linearize. Override
+        in sub-class for a vectorized implementation.
+        :param v_ref: array of velocity references | (N,)
+        :param kappa_ref: array of waypoint curvatures | (N,)
+        :param delta_s: array of distances to next waypoint | (N,)
+        :return: stacked offsets f (N, nx), system matrices A (N, nx, nx)
+        and input matrices B (N, nx, nu)
+        """
+
+        f, A, B = zip(*[self.linearize(v, kappa, ds) for v, kappa, ds in
+                        zip(v_ref, kappa_ref, delta_s)])
+
+        return np.array(f), np.array(A), np.array(B)
+
 
 #################
 # Bicycle Model #
@@ -415,3 +470,37 @@ class BicycleModel(SpatialBicycleModel):
         B = np.stack((b_1, b_2, b_3), axis=0)
 
         return f, A, B
+
+    def linearize_horizon(self, v_ref, kappa_ref, delta_s):
+        """
+        Linearize the system equations around provided reference values for
+        all steps of a horizon at once.
+        :param v_ref: array of velocity references | (N,)
+        :param kappa_ref: array of waypoint curvatures | (N,)
+        :param delta_s: array of distances to next waypoint | (N,)
+        :return: stacked offsets f (N, 3), system matrices A (N, 3, 3) and
+        input matrices B (N, 3, 2)
+        """
+
+        v_ref = np.asarray(v_ref, dtype=float)
+        kappa_ref = np.asarray(kappa_ref, dtype=float)
+        delta_s = np.asarray(delta_s, dtype=float)
+        N = len(delta_s)
+
+        # Construct Jacobian Matrices
+        A = np.zeros((N, 3, 3))
+        A[:, 0, 0] = 1
+        A[:, 0, 1] = delta_s
+        A[:, 1, 0] = -kappa_ref ** 2 * delta_s
+        A[:, 1, 1] = 1
+        A[:, 2, 0] = -kappa_ref / v_ref * delta_s
+        A[:, 2, 2] = 1
+
+        B = np.zeros((N, 3, 2))
+        B[:, 1, 1] = delta_s
+        B[:, 2, 0] = -1 / (v_ref ** 2) * delta_s
+
+        f = np.zeros((N, 3))
+        f[:, 2] = 1 / v_ref * delta_s
+
+        return f, A, B
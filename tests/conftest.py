@@ -0,0 +1,36 @@
+import os
+import sys
+
+import pytest
+
+# Modules of the project are imported from the source directory, which is
+# also the working directory they expect for relative paths of maps
+SRC_DIR = os.path.join(os.path.dirname(os.path.dirname(
+    os.path.abspath(__file__))), 'src')
+sys.path.insert(0, SRC_DIR)
+
+from map import Map  # noqa: E402
+from reference_path import ReferencePath  # noqa: E402
+
+
+@pytest.fixture(autouse=True)
+def src_dir(monkeypatch):
+    monkeypatch.chdir(SRC_DIR)
+
+
+@pytest.fixture
+def reference_path(src_dir):
+    # Circular track of the simulation demo with its speed profile
+    map = Map(file_path='maps/sim_map.png', origin=[-1, -2],
+              resolution=0.005)
+    wp_x = [-0.75, -0.25, -0.25, 0.25, 0.25, 1.25, 1.25, 0.75, 0.75, 1.25,
+            1.25, -0.75, -0.75, -0.25]
+    wp_y = [-1.5, -1.5, -0.5, -0.5, -1.5, -1.5, -1, -1, -0.5, -0.5, 0, 0,
+            -1.5, -1.5]
+    reference_path = ReferencePath(map, wp_x, wp_y, 0.05,
+                                   smoothing_distance=5, max_width=0.23,
+                                   circular=True)
+    reference_path.compute_speed_profile({'a_min': -0.1, 'a_max': 0.5,
+                                          'v_min': 0.0, 'v_max': 1.0,
+                                          'ay_max': 4.0})
+    return reference_path
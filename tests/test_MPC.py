@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+from scipy import sparse
+
+from map import Obstacle
+from MPC import MPC
+from spatial_bicycle_models import BicycleModel
+
+
+# Obstacles of the simulation demo
+DEMO_OBSTACLES = [(0.0, 0.0, 0.05), (-0.8, -0.5, 0.08), (-0.7, -1.5, 0.05),
+                  (-0.3, -1.0, 0.08), (0.27, -1.0, 0.05), (0.78, -1.47, 0.05),
+                  (0.73, -0.9, 0.07), (1.2, 0.0, 0.08), (0.67, -0.05, 0.06)]
+
+
+def run_closed_loop(reference_path, warm_start, n_steps, R):
+    car = BicycleModel(reference_path, length=0.12, width=0.06, Ts=0.05)
+    InputConstraints = {'umin': np.array([0.0, -np.tan(0.66) / car.length]),
+                        'umax': np.array([1.0, np.tan(0.66) / car.length])}
+    StateConstraints = {'xmin': np.array([-np.inf, -np.inf, -np.inf]),
+                        'xmax': np.array([np.inf, np.inf, np.inf])}
+    mpc = MPC(car, 30, sparse.diags([1.0, 0.0, 0.0]), sparse.diags(R),
+              sparse.diags([1.0, 0.0, 0.0]), StateConstraints,
+              InputConstraints, 4.0, warm_start=warm_start)
+
+    controls, n_infeasible = [], 0
+    for _ in range(n_steps):
+        u = mpc.get_control()
+        n_infeasible += mpc.infeasibility_counter > 0
+        controls.append(u)
+        car.drive(u)
+
+    return np.array(controls), n_infeasible
+
+
+def test_warm_and_cold_start_agree(reference_path):
+    # Small weight on the curvature makes the optimal steering angle unique,
+    # otherwise it is only determined up to the tolerance of the solver
+    warm, n_warm = run_closed_loop(reference_path, True, 180, [0.5, 0.01])
+    cold, n_cold = run_closed_loop(reference_path, False, 180, [0.5, 0.01])
+
+    assert n_warm == n_cold == 0
+    assert np.allclose(warm, cold, atol=0.01)
+
+
+@pytest.mark.parametrize('warm_start', [True, False])
+def test_controls_within_bounds_around_obstacles(reference_path, warm_start):
+    # Obstacles of the simulation demo narrow the track so much that some
+    # problems may be infeasible. Controls must never be taken from
+    # solutions of problems the solver did not solve.
+    reference_path.map.add_obstacles([
+        Obstacle(cx=cx, cy=cy, radius=radius)
+        for cx, cy, radius in DEMO_OBSTACLES])
+    controls, _ = run_closed_loop(reference_path, warm_start, 180,
+                                  [0.5, 0.0])
+
+    # Controls contain the steering angle instead of the curvature
+    assert np.all(np.isfinite(controls))
+    assert np.all(controls >= np.array([0.0, -0.66]) - 1e-3)
+    assert np.all(controls <= np.array([1.0, 0.66]) + 1e-3)
+
+
+def test_warm_start_no_more_infeasible_than_cold(reference_path):
+    # Closed loop of the simulation demo. Setting up the solver in every
+    # time step finds a solution in every step.
+    reference_path.map.add_obstacles([
+        Obstacle(cx=cx, cy=cy, radius=radius)
+        for cx, cy, radius in DEMO_OBSTACLES])
+    _, n_warm = run_closed_loop(reference_path, True, 180, [0.5, 0.0])
+    _, n_cold = run_closed_loop(reference_path, False, 180, [0.5, 0.0])
+
+    assert n_warm <= n_cold
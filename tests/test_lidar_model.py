@@ -0,0 +1,135 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pytest
+from PIL import Image
+
+from lidar_model import LidarModel
+from map import Map
+
+
+def test_scan_batch_matches_single_scans():
+    map = Map('maps/real_map.png', origin=(-30.0, -24.0), resolution=0.06)
+    lidar = LidarModel(FoV=360, range=5.0, resolution=1.0)
+    rng = np.random.default_rng(0)
+    free_y, free_x = np.nonzero(map.get_data() == 1)
+    ids = rng.integers(0, len(free_x), 40)
+    x, y = map.m2w(free_x[ids], free_y[ids])
+    psi = rng.uniform(-np.pi, np.pi, len(ids))
+
+    expected = np.array([lidar.get_ranges(map, *pose)
+                         for pose in zip(x, y, psi)])
+    assert np.array_equal(lidar.scan_batch(map, x, y, psi), expected)
+
+    # Worker processes, if there are several CPUs, yield the same ranges
+    ranges = lidar.scan_batch(map, x, y, psi, n_workers=2, chunk_size=16,
+                              min_poses=0)
+    assert np.array_equal(ranges, expected)
+
+
+def ray_march(map, x, y, angles, range, step=1e-3):
+    # Reference ranges marching along every beam from the center of the
+    # sensor's cell. A beam hits every occupied cell it passes through and
+    # measures the distance to the center of the closest one.
+    x, y = map.w2m(x, y)
+    data = map.get_data()
+    t = np.arange(0.0, range / map.resolution, step)
+    ranges = np.full(len(angles), float(range))
+    for beam_id, angle in enumerate(angles):
+        i = np.floor(x + t * np.cos(angle) + 0.5).astype(int)
+        j = np.floor(y + t * np.sin(angle) + 0.5).astype(int)
+        inside = (i >= 0) & (i < map.width) & (j >= 0) & (j < map.height) \
+            & ((i != x) | (j != y))
+        i, j = i[inside], j[inside]
+        occupied = data[j, i] == 0
+        if np.any(occupied):
+            distance = np.min(np.hypot(i[occupied] - x, j[occupied] - y))
+            if distance < range / map.resolution:
+                ranges[beam_id] = distance * map.resolution
+    return ranges
+
+
+@pytest.fixture
+def small_map(tmp_path):
+    # Free 40 x 40 px map with a few obstacles around the sensor at (2, 2).
+    # Headings of beams through cell corners are avoided below, those are
+    # ambiguous in the ray march.
+    image = np.full((40, 40), 255, dtype=np.uint8)
+    image[18:23, 8:11] = 0
+    image[26:30, 22:34] = 0
+    image[5:9, 14:19] = 0
+    image[31:35, 3:7] = 0
+    Image.fromarray(image).save(tmp_path / 'map.png')
+    return Map(str(tmp_path / 'map.png'), origin=(0.0, 0.0), resolution=0.1)
+
+
+@pytest.mark.parametrize('FoV', [360, 270, 90])
+@pytest.mark.parametrize('psi', [0.2, 1.0, np.pi / 2 + 0.1, -2.5])
+def test_scan_matches_ray_march(small_map, FoV, psi):
+    lidar = LidarModel(FoV=FoV, range=1.5, resolution=1.0)
+    car = SimpleNamespace(x=2.0, y=2.0, psi=psi)
+    lidar.scan(car, small_map)
+
+    expected = ray_march(small_map, 2.0, 2.0, lidar.measurements[0] + psi,
+                         1.5)
+    assert np.allclose(lidar.measurements[1], expected)
+    assert np.any(lidar.measurements[1] < 1.5)
+
+
+def test_scan_hits_obstacle_behind_sensor(small_map):
+    # Obstacle at (8..10, 18..22) px straddles the bearing of -pi and pi
+    # relative to the sensor
+    lidar = LidarModel(FoV=360, range=1.5, resolution=1.0)
+    car = SimpleNamespace(x=2.0, y=2.0, psi=0.05)
+    lidar.scan(car, small_map)
+
+    expected = ray_march(small_map, 2.0, 2.0, lidar.measurements[0] + 0.05,
+                         1.5)
+    assert np.allclose(lidar.measurements[1], expected)
+    assert lidar.measurements[1, 0] < 1.5
+    assert lidar.measurements[1, -1] < 1.5
+
+
+def direct_ranges(lidar, map, x, y, psi):
+    # Scan replaced by the polar lookup table, computing the bearings of the
+    # corners of all occupied cells directly, with bearings wrapped to
+    # [-pi, pi). Cells wrapping around the back of the sensor are not hit by
+    # any beam, hence only valid for FoVs below 270 deg.
+    ranges = np.full(lidar.n_measurements, float(lidar.range))
+    x, y = map.w2m(x, y)
+    range_px = int(lidar.range / map.resolution)
+    i, j = map.get_occupied_cells(x - range_px, y - range_px, x + range_px,
+                                  y + range_px)
+
+    offsets = np.arange(-1, 2) / 2
+    dx = i[:, None, None] + offsets[None, :, None] - x
+    dy = j[:, None, None] + offsets[None, None, :] - y
+    cell_angles = (np.arctan2(dy, dx) - psi).reshape(len(i), -1)
+    cell_angles = np.mod(np.pi + cell_angles, 2 * np.pi) - np.pi
+    min_angle = np.min(cell_angles, axis=1)
+    max_angle = np.max(cell_angles, axis=1)
+    cell_distance = np.sqrt((i - x) ** 2 + (j - y) ** 2)
+
+    for beam_id, angle in enumerate(lidar.measurements[0]):
+        hit = (min_angle <= angle) & (angle <= max_angle) & \
+            ~((min_angle < -np.pi / 2) & (max_angle > np.pi / 2))
+        if np.any(hit) and \
+                np.min(cell_distance[hit]) < lidar.range / map.resolution:
+            ranges[beam_id] = np.min(cell_distance[hit]) * map.resolution
+    return ranges
+
+
+@pytest.mark.parametrize('FoV', [240, 180, 60])
+def test_lookup_table_scan_matches_direct_scan(FoV):
+    map = Map('maps/real_map.png', origin=(-30.0, -24.0), resolution=0.06)
+    lidar = LidarModel(FoV=FoV, range=5.0, resolution=0.5)
+    rng = np.random.default_rng(1)
+    free_y, free_x = np.nonzero(map.get_data() == 1)
+    ids = rng.integers(0, len(free_x), 10)
+    x, y = map.m2w(free_x[ids], free_y[ids])
+
+    for pose_x, pose_y in zip(x, y):
+        for psi in [0.1, 0.7, np.pi / 2 + 0.2, -2.0, 3.0]:
+            assert np.allclose(lidar.get_ranges(map, pose_x, pose_y, psi),
+                               direct_ranges(lidar, map, pose_x, pose_y,
+                                             psi))
@@ -0,0 +1,403 @@
+import numpy as np
+import pytest
+from PIL import Image
+from skimage.draw import line_aa
+from skimage.morphology import remove_small_holes
+
+from lidar_model import LidarModel
+from map import LocalMap, Map, Obstacle, line_aa_batch
+
+# Bundled maps with their origin and resolution
+MAPS = [('maps/sim_map.png', (-1.0, -2.0), 0.005),
+        ('maps/real_map.png', (-30.0, -24.0), 0.06)]
+
+
+def test_integrate_scan_single_beam():
+    map = Map('maps/real_map.png', origin=(-30.0, -24.0), resolution=0.06)
+
+    # Single beam along the x axis ending 1 m in front of the sensor
+    x, y = map.m2w(map.width // 2, map.height // 2)
+    ranges = np.array([1.0])
+    map.integrate_scan(x, y, 0.0, np.zeros(1), ranges, max_range=2.0)
+    hit_x, hit_y = map.w2m(x + 1.0, y)
+    sensor_x, sensor_y = map.w2m(x, y)
+
+    # Log-odds lowered along the beam and raised at the endpoint only
+    log_odds = map.log_odds[sensor_y, sensor_x:hit_x + 1]
+    assert np.allclose(log_odds[:-1], -0.4)
+    assert np.isclose(log_odds[-1], 0.85)
+    assert np.count_nonzero(map.log_odds) == len(log_odds)
+    assert np.array_equal(map.scan_cells, [hit_y * map.width + hit_x])
+
+    # Repeated scans saturate at the bounds of the log-odds
+    for _ in range(10):
+        map.integrate_scan(x, y, 0.0, np.zeros(1), ranges, max_range=2.0)
+    log_odds = map.log_odds[sensor_y, sensor_x:hit_x + 1]
+    assert np.allclose(log_odds[:-1], -2.0)
+    assert np.isclose(log_odds[-1], 3.5)
+    assert map.log_odds.min() >= -2.0 and map.log_odds.max() <= 3.5
+
+
+def test_dirty_regions_bounded_history():
+    map = Map('maps/sim_map.png', origin=(-1, -2), resolution=0.005,
+              dirty_history=8)
+    for i in range(20):
+        map.mark_dirty(10 * i, 0, 10 * i + 5, 5)
+
+    # Only the most recent changes are kept
+    assert map.version == 20
+    assert map.dirty_base >= 12
+    assert np.array_equal(map.get_dirty_regions(18),
+                          [[180, 0, 185, 5], [190, 0, 195, 5]])
+    assert len(map.get_dirty_regions(20)) == 0
+    assert map.get_dirty_regions(0) is None
+
+    # Regions changed in known versions are checked exactly, older versions
+    # are considered dirty
+    assert map.is_dirty((190, 0, 190, 0), 18)
+    assert not map.is_dirty((0, 0, 5, 5), 18)
+    assert map.is_dirty((0, 0, 5, 5), 0)
+    assert not map.is_dirty((0, 0, 5, 5), 20)
+
+
+def test_caches_after_trimmed_history():
+    map = Map('maps/sim_map.png', origin=(-1, -2), resolution=0.005,
+              dirty_history=4)
+    map.get_occupancy_pyramid()
+    map.get_signed_distance_field()
+
+    # More changes than kept in the history since the caches were updated
+    obstacles = [Obstacle(cx=-0.5 + 0.1 * i, cy=-1.5, radius=0.03)
+                 for i in range(6)]
+    for obstacle in obstacles:
+        map.add_obstacles([obstacle])
+
+    reference = Map('maps/sim_map.png', origin=(-1, -2), resolution=0.005)
+    reference.add_obstacles([Obstacle(cx=obstacle.cx, cy=obstacle.cy,
+                                      radius=obstacle.radius)
+                             for obstacle in obstacles])
+    for level, expected in zip(map.get_occupancy_pyramid(),
+                               reference.get_occupancy_pyramid()):
+        assert np.array_equal(level, expected)
+    assert np.allclose(map.get_signed_distance_field(),
+                       reference.get_signed_distance_field())
+
+
+def test_local_map_shadows_observed_obstacle():
+    map = Map('maps/sim_map.png', origin=(-1, -2), resolution=0.005)
+    empty_map = Map('maps/sim_map.png', origin=(-1, -2), resolution=0.005)
+    map.add_obstacles([Obstacle(cx=-0.25, cy=-1.0, radius=0.05)])
+    lidar = LidarModel(FoV=360, range=1.5, resolution=1.0)
+    x, y, psi = -0.25, -1.3, np.pi / 2
+    ranges = lidar.get_ranges(map, x, y, psi)
+    local_map = LocalMap(map, x, y, psi, lidar.measurements[0], ranges,
+                         lidar.range, shadow_depth=0.15)
+
+    # Cells of the grid in the global maps
+    size = local_map.data.shape[0]
+    cell_y, cell_x = np.mgrid[local_map.y_min:local_map.y_min + size,
+                              local_map.x_min:local_map.x_min + size]
+    occupied = map.get_cells(cell_x, cell_y) == 0
+    static = empty_map.get_cells(cell_x, cell_y) == 0
+    local = local_map.get_cells(cell_x, cell_y) == 0
+
+    # Obstacle is shadowed up to its outline and the static layer is taken
+    # from the map
+    world_x, world_y = map.m2w(cell_x, cell_y)
+    inner = np.hypot(world_x + 0.25, world_y + 1.0) < 0.05 - 0.01
+    assert np.all(local[occupied & inner])
+    assert np.array_equal(local[static], static[static])
+
+    # Shadow ends at the shadow depth behind the obstacle's surface, which
+    # is 0.25 m to 0.3 m in front of the sensor
+    distances = np.hypot(world_x - x, world_y - y)
+    bearings = np.arctan2(world_y - y, world_x - x) - psi
+    cone = ~static & (np.abs(bearings) < np.radians(12))
+    assert np.any(local[cone & ~occupied & (distances > 0.25 + 0.1)])
+    assert not np.any(local[cone & (distances > 0.3 + 0.15 + 0.01)])
+
+
+def test_rasterize_circles_matches_single_circles():
+    map = Map('maps/sim_map.png', origin=(-1, -2), resolution=0.005)
+
+    # Circles of different radii, partially and entirely outside the map
+    cx = np.array([0.0, -0.99, 0.3, -5.0, 0.5, 0.02])
+    cy = np.array([-1.0, -1.99, -0.5, 0.0, -1.2, -1.0])
+    radius = np.array([0.05, 0.08, 0.05, 0.1, 0.021, 0.0])
+    cells, offsets, regions = map.rasterize_circles(cx, cy, radius)
+    assert len(offsets) == len(cx) + 1 and offsets[-1] == len(cells)
+
+    for i in range(len(cx)):
+        # Cells within radius of the center cell, clipped to the map
+        r = int(np.ceil(radius[i] / map.resolution))
+        center_x, center_y = map.w2m(cx[i], cy[i])
+        y, x = np.mgrid[center_y - r:center_y + r, center_x - r:center_x + r]
+        covered = ((x - center_x) ** 2 + (y - center_y) ** 2 <= r ** 2) & \
+            map.is_inside(x, y)
+        expected = np.sort((y * map.width + x)[covered])
+
+        circle_cells = cells[offsets[i]:offsets[i + 1]]
+        assert np.array_equal(np.sort(circle_cells), expected)
+        if len(circle_cells) > 0:
+            cell_y, cell_x = np.divmod(circle_cells, map.width)
+            assert regions[i, 0] <= cell_x.min() and \
+                regions[i, 2] >= cell_x.max()
+            assert regions[i, 1] <= cell_y.min() and \
+                regions[i, 3] >= cell_y.max()
+
+
+def test_line_aa_batch_matches_line_aa():
+    rng = np.random.default_rng(0)
+    x0, y0, x1, y1 = rng.integers(-40, 40, (4, 500))
+    # Lines consisting of a single cell
+    x1[:10], y1[:10] = x0[:10], y0[:10]
+    x, y, offsets = line_aa_batch(x0, y0, x1, y1)
+
+    for i in range(len(x0)):
+        expected_x, expected_y = line_aa(x0[i], y0[i], x1[i], y1[i])[:2]
+        assert np.array_equal(x[offsets[i]:offsets[i + 1]], expected_x)
+        assert np.array_equal(y[offsets[i]:offsets[i + 1]], expected_y)
+
+
+def test_add_boundary_matches_single_segments():
+    map = Map('maps/sim_map.png', origin=(-1, -2), resolution=0.005)
+
+    # Segments within, partially and entirely outside the map
+    rng = np.random.default_rng(0)
+    start = rng.uniform(-1.5, 2.0, (200, 2))
+    segments = np.stack([start, start + rng.uniform(-0.5, 0.5, (200, 2))],
+                        axis=1)
+    map.add_boundary([((s_x, s_y), (g_x, g_y))
+                      for (s_x, s_y), (g_x, g_y) in segments])
+
+    reference = Map('maps/sim_map.png', origin=(-1, -2), resolution=0.005)
+    for (s_x, s_y), (g_x, g_y) in segments:
+        points_x, points_y = reference.w2m(np.array([s_x, g_x]),
+                                           np.array([s_y, g_y]))
+        x, y = line_aa(points_x[0], points_y[0], points_x[1],
+                       points_y[1])[:2]
+        inside = reference.is_inside(x, y)
+        reference.set_occupied(x[inside], y[inside])
+        if np.any(inside):
+            reference.mark_dirty(x[inside].min(), y[inside].min(),
+                                 x[inside].max(), y[inside].max())
+
+    assert np.array_equal(map.get_data(), reference.get_data())
+    assert map.version == reference.version
+    assert np.array_equal(map.get_dirty_regions(0),
+                          reference.get_dirty_regions(0))
+    assert map.dirty_hash.digest() == reference.dirty_hash.digest()
+
+
+def test_mark_dirty_regions_matches_mark_dirty():
+    regions = np.arange(4 * 30).reshape(30, 4)
+    for sizes in ([30], [3, 5, 1, 20, 1], [12, 12, 6]):
+        map = Map('maps/sim_map.png', origin=(-1, -2), resolution=0.005,
+                  dirty_history=8)
+        reference = Map('maps/sim_map.png', origin=(-1, -2),
+                        resolution=0.005, dirty_history=8)
+        start = 0
+        for size in sizes:
+            map.mark_dirty_regions(regions[start:start + size])
+            for region in regions[start:start + size]:
+                reference.mark_dirty(*region)
+            start += size
+
+            # Same versions and hash, the most recent regions are known
+            assert map.version == reference.version
+            assert map.dirty_hash.digest() == reference.dirty_hash.digest()
+            known = map.get_dirty_regions(map.dirty_base)
+            assert np.array_equal(known, regions[start - len(known):start])
+            assert len(known) >= min(start, 4)
+
+
+@pytest.mark.parametrize('file_path, origin, resolution', MAPS)
+def test_remove_small_holes_matches_skimage(file_path, origin, resolution):
+    raw_data = np.array(Image.open(file_path).getchannel(0))
+    expected = remove_small_holes(np.where(raw_data >= 100, 1, 0),
+                                  area_threshold=5, connectivity=8)
+
+    map = Map(file_path, origin=origin, resolution=resolution)
+    assert np.array_equal(map.data, expected.astype(np.int8))
+
+
+@pytest.mark.parametrize('file_path, origin, resolution', MAPS)
+def test_packed_map_matches_unpacked(file_path, origin, resolution):
+    map = Map(file_path, origin=origin, resolution=resolution)
+    packed = Map(file_path, origin=origin, resolution=resolution,
+                 packed=True)
+    assert np.array_equal(packed.get_data(), map.data)
+
+    rng = np.random.default_rng(0)
+    x = rng.integers(0, map.width, 10000)
+    y = rng.integers(0, map.height, 10000)
+    assert np.array_equal(packed.get_cells(x, y), map.get_cells(x, y))
+    assert np.array_equal(packed.get_cells(x, y), map.data[y, x])
+
+
+@pytest.mark.parametrize('tile_size', [64, 7])
+def test_tiled_map_matches_untiled(tile_size):
+    # Tile sizes do not divide the size of the map of 500 x 500 px
+    map = Map('maps/sim_map.png', origin=(-1.0, -2.0), resolution=0.005)
+    tiled = Map('maps/sim_map.png', origin=(-1.0, -2.0), resolution=0.005,
+                tile_size=tile_size)
+
+    # Tiles are processed on access of single cells and regions
+    rng = np.random.default_rng(0)
+    x = rng.integers(0, map.width, 20)
+    y = rng.integers(0, map.height, 20)
+    assert np.array_equal(tiled.get_cells(x, y), map.get_cells(x, y))
+    assert np.array_equal(tiled.get_window(100, 230, 270, 499),
+                          map.get_window(100, 230, 270, 499))
+    assert not np.all(tiled.tiles_loaded)
+
+    assert np.array_equal(tiled.get_data(), map.data)
+    assert np.all(tiled.tiles_loaded)
+
+
+def check_occupancy_queries(map, rng, n_regions):
+    # Compare queries using the occupancy pyramid against the map data of
+    # random regions. Regions may extend beyond the border of the map.
+    data = map.get_data()
+    for _ in range(n_regions):
+        size = rng.integers(1, 200, 2)
+        x_min, y_min = rng.integers(-50, (map.width, map.height))
+        x_max, y_max = x_min + size[0] - 1, y_min + size[1] - 1
+        window = data[max(y_min, 0):max(y_max + 1, 0),
+                      max(x_min, 0):max(x_max + 1, 0)]
+        inside = x_min >= 0 and y_min >= 0 and x_max < map.width and \
+            y_max < map.height
+
+        assert map.is_free(x_min, y_min, x_max, y_max) == \
+            (inside and not np.any(window == 0))
+
+        x, y = map.get_occupied_cells(x_min, y_min, x_max, y_max)
+        expected_y, expected_x = np.nonzero(window == 0)
+        expected = np.sort((expected_y + max(y_min, 0)) * map.width +
+                           expected_x + max(x_min, 0))
+        assert np.array_equal(np.sort(y * map.width + x), expected)
+
+
+def test_occupancy_pyramid_queries_match_map_data():
+    map = Map('maps/sim_map.png', origin=(-1.0, -2.0), resolution=0.005)
+    rng = np.random.default_rng(0)
+    check_occupancy_queries(map, rng, 300)
+
+    # Regions touching the border of the map
+    data = map.get_data()
+    for x_min, y_min, x_max, y_max in [(0, 0, 499, 499), (0, 0, 0, 0),
+                                       (499, 499, 499, 499), (490, 0, 499, 7),
+                                       (0, 300, 20, 499), (-3, -3, 2, 2)]:
+        x, y = map.get_occupied_cells(x_min, y_min, x_max, y_max)
+        window = data[max(y_min, 0):y_max + 1, max(x_min, 0):x_max + 1]
+        assert len(x) == np.count_nonzero(window == 0)
+        assert map.is_free(x_min, y_min, x_max, y_max) == \
+            (x_min >= 0 and y_min >= 0 and not np.any(window == 0))
+
+    # Pyramid is updated after changes of the dynamic layer
+    obstacles = [Obstacle(cx, cy, radius) for cx, cy, radius in
+                 zip(rng.uniform(-1.0, 1.5, 30), rng.uniform(-2.0, 0.5, 30),
+                     rng.uniform(0.01, 0.1, 30))]
+    map.add_obstacles(obstacles)
+    check_occupancy_queries(map, rng, 300)
+    map.remove_obstacles(obstacles[::2])
+    check_occupancy_queries(map, rng, 300)
+
+
+def test_remove_obstacles_restores_map_data():
+    map = Map('maps/sim_map.png', origin=(-1.0, -2.0), resolution=0.005)
+    data = map.get_data().copy()
+    window = map.get_window(150, 200, 320, 330).copy()
+    rng = np.random.default_rng(0)
+    x = rng.integers(0, map.width, 5000)
+    y = rng.integers(0, map.height, 5000)
+    cells = map.get_cells(x, y)
+
+    # Overlapping obstacles, some of them added twice at the same position
+    obstacles = [Obstacle(0.0, -0.5, 0.1), Obstacle(0.05, -0.45, 0.08),
+                 Obstacle(0.0, -0.5, 0.1), Obstacle(0.3, -0.6, 0.05),
+                 Obstacle(0.32, -0.6, 0.05)]
+    map.add_obstacles(obstacles[:3])
+    map.add_obstacles(obstacles[3:])
+    assert not np.array_equal(map.get_data(), data)
+
+    # Cells covered by remaining obstacles stay occupied
+    map.remove_obstacles([obstacles[0], obstacles[3]])
+    for obstacle in obstacles[1:3] + obstacles[4:]:
+        covered_y, covered_x = np.divmod(map.obstacle_cells[obstacle],
+                                         map.width)
+        assert np.all(map.get_cells(covered_x, covered_y) == 0)
+
+    map.remove_obstacles([obstacles[1], obstacles[2], obstacles[4]])
+    assert np.array_equal(map.get_cells(x, y), cells)
+    assert np.array_equal(map.get_window(150, 200, 320, 330), window)
+    assert np.array_equal(map.get_data(), data)
+
+
+def test_move_obstacle_marks_old_and_new_region_dirty():
+    map = Map('maps/sim_map.png', origin=(-1.0, -2.0), resolution=0.005)
+    data = map.get_data().copy()
+    obstacle = Obstacle(0.0, -0.5, 0.05)
+    map.add_obstacles([obstacle])
+    old_y, old_x = np.divmod(map.obstacle_cells[obstacle], map.width)
+
+    version = map.version
+    map.move_obstacle(obstacle, 0.6, -1.2)
+    new_y, new_x = np.divmod(map.obstacle_cells[obstacle], map.width)
+
+    # Map data only changes at the old and new position
+    changed = np.zeros(data.shape, dtype=bool)
+    changed[old_y, old_x] = True
+    changed[new_y, new_x] = True
+    expected = data.copy()
+    expected[new_y, new_x] = 0
+    assert np.array_equal(map.get_data(), expected)
+
+    # Regions changed since the move cover all changed cells
+    covered = np.zeros(data.shape, dtype=bool)
+    for x_min, y_min, x_max, y_max in map.get_dirty_regions(version):
+        covered[y_min:y_max+1, x_min:x_max+1] = True
+    assert np.all(covered[changed])
+
+
+@pytest.mark.parametrize('file_path, origin, resolution', MAPS)
+def test_w2m_m2w_round_trip(file_path, origin, resolution):
+    map = Map(file_path, origin=origin, resolution=resolution)
+    rng = np.random.default_rng(0)
+
+    # Cell centers map back to their cells, also outside the map
+    dx = rng.integers(-100, map.width + 100, 1000)
+    dy = rng.integers(-100, map.height + 100, 1000)
+    x, y = map.m2w(dx, dy)
+    assert all(np.array_equal(a, b) for a, b in zip(map.w2m(x, y), (dx, dy)))
+
+    # Points lie within half a cell of the center of their cell
+    x = rng.uniform(origin[0] - 1.0, origin[0] + map.width * resolution + 1.0,
+                    1000)
+    y = rng.uniform(origin[1] - 1.0,
+                    origin[1] + map.height * resolution + 1.0, 1000)
+    dx, dy = map.w2m(x, y)
+    cx, cy = map.m2w(dx, dy)
+    assert np.all(np.abs(cx - x) <= resolution / 2 + 1e-9)
+    assert np.all(np.abs(cy - y) <= resolution / 2 + 1e-9)
+
+    # Mask of points inside the map
+    mask_x, mask_y, inside = map.w2m(x, y, return_mask=True)
+    assert np.array_equal(mask_x, dx) and np.array_equal(mask_y, dy)
+    assert np.array_equal(inside, (dx >= 0) & (dx < map.width) &
+                          (dy >= 0) & (dy < map.height))
+    assert np.array_equal(inside, map.is_inside(dx, dy))
+    assert 0 < np.count_nonzero(inside) < len(x)
+
+
+def test_w2m_single_points():
+    map = Map('maps/sim_map.png', origin=(-1.0, -2.0), resolution=0.005)
+
+    # Single points yield ints, the upper border of the map is outside
+    dx, dy, inside = map.w2m(-1.0, -2.0, return_mask=True)
+    assert (dx, dy) == (0, 0) and type(dx) is int and inside
+    dx, dy, inside = map.w2m(-1.0 + 500 * 0.005, -2.0, return_mask=True)
+    assert (dx, dy) == (500, 0) and not inside
+    dx, dy, inside = map.w2m(-1.0 - 1e-6, 0.0, return_mask=True)
+    assert dx == -1 and not inside
+    assert map.is_inside(499, 499) and not map.is_inside(-1, 0)
@@ -0,0 +1,65 @@
+import numpy as np
+
+from monte_carlo import aggregate_results, run_batch
+
+
+def test_aggregate_results():
+    results = [{'lap_time': 10.0, 'finished': True, 'failed': False,
+                'min_clearance': 0.1, 'n_infeasible': 2,
+                'solve_times': np.array([0.001, 0.003])},
+               {'lap_time': 5.0, 'finished': False, 'failed': True,
+                'min_clearance': -0.02, 'n_infeasible': 1,
+                'solve_times': np.array([0.002])}]
+    summary = aggregate_results(results)
+
+    assert summary['n_scenarios'] == 2
+    assert summary['n_finished'] == 1
+    assert summary['n_failed'] == 1
+    assert summary['n_collisions'] == 1
+    assert summary['n_infeasible'] == 3
+    assert summary['mean_lap_time'] == 10.0
+    assert summary['min_clearance'] == -0.02
+    assert np.isclose(summary['mean_solve_time'], 0.002)
+    assert summary['max_solve_time'] == 0.003
+
+
+def test_run_batch_serial_and_pool_agree():
+    # Solve times are not compared and OSQP's time based rho adaption may
+    # perturb the trajectory slightly
+    scenarios = [{'perturbation': (0.0, 0.02, 0.1)},
+                 {'obstacles': [(-0.3, -1.0, 0.08)]}]
+    serial, _ = run_batch(scenarios, n_workers=1)
+    pooled, _ = run_batch(scenarios, n_workers=2)
+
+    for a, b in zip(serial, pooled):
+        assert a['finished'] and b['finished']
+        assert not a['failed'] and not b['failed']
+        assert abs(a['lap_time'] - b['lap_time']) <= 0.1
+        assert abs(a['min_clearance'] - b['min_clearance']) <= 0.01
+
+        # The path is 8.72 m long and the speed limited to 1 m/s. Shorter
+        # lap times mean the car left the track.
+        assert 8.72 <= a['lap_time'] <= 10.0
+
+
+def test_run_batch_open_path_finishes():
+    results, summary = run_batch([{'track': 'Real_Track', 'N': 20}],
+                                 n_workers=1)
+
+    assert results[0]['finished'] and not results[0]['failed']
+    assert summary['n_finished'] == 1
+
+
+def test_run_batch_counts_unsolved_problems():
+    # Obstacles of the simulation demo make some problems infeasible if the
+    # car starts off the center-line
+    obstacles = [(0.0, 0.0, 0.05), (-0.8, -0.5, 0.08), (-0.7, -1.5, 0.05),
+                 (-0.3, -1.0, 0.08), (0.27, -1.0, 0.05), (0.78, -1.47, 0.05),
+                 (0.73, -0.9, 0.07), (1.2, 0.0, 0.08), (0.67, -0.05, 0.06)]
+    results, summary = run_batch([{'obstacles': obstacles,
+                                   'perturbation': (0.0, 0.014, -0.093)}],
+                                 n_workers=1)
+
+    assert results[0]['finished'] and not results[0]['failed']
+    assert 8.72 <= results[0]['lap_time'] <= 10.0
+    assert summary['n_infeasible'] > 0
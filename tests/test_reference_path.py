@@ -0,0 +1,137 @@
+import numpy as np
+import pytest
+from skimage.draw import line_aa
+
+from map import Map, Obstacle
+from monte_carlo import TRACKS
+from reference_path import ReferencePath
+
+CONSTRAINTS = {'a_min': -0.1, 'a_max': 0.5, 'v_min': 0.0, 'v_max': 1.0,
+               'ay_max': 4.0}
+
+
+def get_accelerations(reference_path, wp_id, n):
+    # Acceleration between consecutive waypoints as used by the speed
+    # profile, including the transitions into and out of the window
+    ids = np.arange(wp_id, wp_id + n + 2)
+    v = reference_path.waypoints.v_ref[ids]
+    li = reference_path.segment_lengths[ids[1:]]
+    return np.diff(v) / (2 * li)
+
+
+@pytest.mark.parametrize('a_min', [-2.0, -0.1])
+def test_update_speed_profile_applies_local_v_max(reference_path, a_min):
+    # Slow zone within the window, the profile after the window can not be
+    # reached within the acceleration limits
+    v_max = np.ones(20)
+    v_max[8:12] = 0.3
+    constraints = dict(CONSTRAINTS, a_min=a_min, v_max=v_max)
+    assert reference_path.update_speed_profile(10, 20, constraints)
+
+    v_ref = reference_path.waypoints.v_ref[11:31]
+    assert np.all(v_ref <= v_max + 1e-9)
+    assert np.all(v_ref[8:12] <= 0.3 + 1e-9)
+
+    # Slowing down before the zone meets the acceleration limits if the
+    # window leaves enough room
+    a = get_accelerations(reference_path, 10, 20)
+    if a_min == -2.0:
+        assert np.all(a[:9] >= a_min - 1e-3)
+
+
+def test_update_speed_profile_scalar_v_max(reference_path):
+    assert reference_path.update_speed_profile(10, 20, dict(CONSTRAINTS,
+                                                            v_max=0.6))
+    v_ref = reference_path.waypoints.v_ref[11:31]
+    assert np.all(v_ref <= 0.6 + 1e-9)
+    assert np.all(v_ref >= 0.59)
+
+
+def test_update_speed_profile_empty_window(reference_path):
+    v_ref = reference_path.waypoints.v_ref.copy()
+    assert not reference_path.update_speed_profile(10, 0, CONSTRAINTS)
+    assert np.array_equal(reference_path.waypoints.v_ref, v_ref)
+
+
+@pytest.mark.parametrize('track, max_width', [('Sim_Track', 0.23),
+                                              ('Sim_Track', 0.5),
+                                              ('Real_Track', 1.5),
+                                              ('Real_Track', 4.0)])
+def test_width_distance_transform_matches_line_search(track, max_width):
+    track = TRACKS[track]
+    map = Map(file_path=track['file_path'], origin=track['origin'],
+              resolution=track['resolution'])
+    map.add_obstacles([Obstacle(cx=0.0, cy=0.0, radius=0.05),
+                       Obstacle(cx=-0.3, cy=-1.0, radius=0.08),
+                       Obstacle(cx=7.0, cy=12.0, radius=0.5)])
+    paths = [ReferencePath(map, track['wp_x'], track['wp_y'],
+                           track['path_resolution'],
+                           smoothing_distance=track['smoothing_distance'],
+                           max_width=max_width, circular=track['circular'],
+                           use_distance_transform=use_distance_transform)
+             for use_distance_transform in (False, True)]
+
+    for name in ['lb', 'ub', 'static_border_cells', 'dynamic_border_cells']:
+        assert np.array_equal(getattr(paths[0].waypoints, name),
+                              getattr(paths[1].waypoints, name))
+
+
+def test_speed_profile_cache_distinguishes_close_limits(tmp_path):
+    map = Map(file_path='maps/sim_map.png', origin=[-1, -2],
+              resolution=0.005)
+    wp_x = [-0.75, -0.25, -0.25, 0.25]
+    wp_y = [-1.5, -1.5, -0.5, -0.5]
+    reference_path = ReferencePath(map, wp_x, wp_y, 0.05,
+                                   smoothing_distance=5, max_width=0.23,
+                                   circular=False, cache_dir=str(tmp_path))
+
+    # Limits differing beyond the 8th significant digit are cached
+    # separately
+    for v_max in (0.5, 0.5 + 1e-10):
+        reference_path.compute_speed_profile(dict(CONSTRAINTS, v_max=v_max))
+    assert len(list(tmp_path.glob('speed_profile_*.npz'))) == 2
+
+
+def walk_free_segments(reference_path, wp, min_width):
+    # Free segments found by walking the cells of the cross-section one by
+    # one, as done before the cross-sections were precomputed
+    map = reference_path.map
+    free_segments = []
+    ub_p = map.w2m(*wp.static_border_cells[0])
+    lb_p = map.w2m(*wp.static_border_cells[1])
+    x_list, y_list, _ = line_aa(ub_p[0], ub_p[1], lb_p[0], lb_p[1])
+    ub_o, free_cells = ub_p, False
+    for x, y in zip(x_list[1:], y_list[1:]):
+        occupied = map.get_cells(x, y) == 0
+        if not occupied:
+            free_cells = True
+        if (occupied or (x, y) == lb_p) and free_cells:
+            ub_w, lb_w = map.m2w(*ub_o), map.m2w(x, y)
+            if np.hypot(ub_w[0] - lb_w[0], ub_w[1] - lb_w[1]) > min_width:
+                free_segments.append((ub_w, lb_w))
+            ub_o, free_cells = (x, y), False
+        elif occupied and not free_cells:
+            ub_o = (x, y)
+    return free_segments
+
+
+def test_free_segments_match_cell_walk(reference_path):
+    # Obstacles crossing several cross-sections split them into multiple
+    # free segments
+    reference_path.map.add_obstacles([
+        Obstacle(cx=-0.5, cy=-1.5, radius=0.04),
+        Obstacle(cx=-0.25, cy=-1.0, radius=0.06),
+        Obstacle(cx=0.3, cy=-0.95, radius=0.03),
+        Obstacle(cx=0.2, cy=-1.05, radius=0.03),
+        Obstacle(cx=1.2, cy=0.0, radius=0.08)])
+
+    n_split = 0
+    for wp_id in range(reference_path.n_waypoints):
+        wp = reference_path.waypoints[wp_id]
+        free_segments = reference_path._compute_free_segments(wp, 0.02)
+        expected = walk_free_segments(reference_path, wp, 0.02)
+        assert np.allclose(np.array(free_segments).reshape(-1, 4),
+                           np.array(expected).reshape(-1, 4))
+        assert len(free_segments) == len(expected)
+        n_split += len(free_segments) > 1
+    assert n_split >= 5
@@ -0,0 +1,35 @@
+import numpy as np
+import pytest
+from PIL import Image
+
+from map import Obstacle
+from spatial_bicycle_models import BicycleModel
+
+pytest.importorskip('matplotlib')
+from renderer import Recorder  # noqa: E402
+
+
+def test_record_gif(reference_path, tmp_path):
+    reference_path.map.add_obstacles([Obstacle(cx=0.0, cy=0.0, radius=0.05)])
+    car = BicycleModel(reference_path, length=0.12, width=0.06, Ts=0.05)
+
+    # Directory of the GIF file is created by the recorder, frames are
+    # rendered by two workers and written in order. More frames than fit
+    # into the queues of the recorder.
+    output = str(tmp_path / 'animation' / 'animation.gif')
+    recorder = Recorder(output, reference_path, car, fps=20, n_workers=2)
+    for step in range(12):
+        recorder.record(reference_path, car, title='Step {}'.format(step))
+        car.drive(np.array([1.0, 0.0]))
+    recorder.close()
+
+    gif = Image.open(output)
+    assert gif.n_frames == 12
+    assert gif.info['loop'] == 0
+    assert gif.info['duration'] == 50
+    frames = []
+    for frame_id in range(gif.n_frames):
+        gif.seek(frame_id)
+        frames.append(np.array(gif.convert('RGB')))
+    assert frames[0].shape[2] == 3
+    assert not np.array_equal(frames[0], frames[-1])
@@ -0,0 +1,24 @@
+import numpy as np
+import pytest
+
+from spatial_bicycle_models import BicycleModel
+
+
+@pytest.mark.parametrize('length, width', [(0.12, 0.06), (0.30, 0.20),
+                                           (0.40, 0.05)])
+def test_footprint_covers_car_tightly(reference_path, length, width):
+    car = BicycleModel(reference_path, length=length, width=width, Ts=0.05)
+    x, y, psi = 0.3, -0.2, 0.7
+    c_x, c_y, radius = car.get_footprint(x, y, psi)
+
+    # Every point of the rectangle lies within one of the circles
+    u, v = np.meshgrid(np.linspace(-length / 2, length / 2, 61),
+                       np.linspace(-width / 2, width / 2, 31))
+    p_x = x + u * np.cos(psi) - v * np.sin(psi)
+    p_y = y + u * np.sin(psi) + v * np.cos(psi)
+    distances = np.hypot(p_x.ravel()[:, None] - c_x,
+                         p_y.ravel()[:, None] - c_y)
+    assert np.all(np.min(distances, axis=-1) <= radius + 1e-12)
+
+    # Circles protrude beyond the sides by less than 4 % of the half width
+    assert radius < 1.04 * width / 2